@@ -0,0 +1,316 @@
+"""
+NomadPay Backend API - Analytics Rollups
+Incrementally maintained totals, time buckets and active-user sketches
+"""
+
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import money
+
+logger = logging.getLogger(__name__)
+
+# Bucket key length in an ISO-8601 timestamp for each granularity
+GRANULARITIES = {
+    'minute': 16,
+    'hour': 13,
+    'day': 10
+}
+
+# Bucket width for each granularity
+BUCKET_WIDTHS = {
+    'minute': timedelta(minutes=1),
+    'hour': timedelta(hours=1),
+    'day': timedelta(days=1)
+}
+
+MAX_BUCKETS = 1500
+
+# Minute buckets are only kept for recent dashboards
+MINUTE_RETENTION = timedelta(days=2)
+
+
+def init_schema(conn):
+    """Create rollup tables and backfill them once from existing rows"""
+    # Rollups from before minor units summed REAL amounts; rebuild them
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(rollup_buckets)')}
+    if 'volume' in columns:
+        conn.execute('DROP TABLE rollup_totals')
+        conn.execute('DROP TABLE rollup_buckets')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS rollup_totals (
+            metric TEXT NOT NULL,
+            currency TEXT NOT NULL DEFAULT '',
+            value NOT NULL DEFAULT 0,
+            PRIMARY KEY (metric, currency)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS rollup_buckets (
+            granularity TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            currency TEXT NOT NULL DEFAULT '',
+            tx_count INTEGER NOT NULL DEFAULT 0,
+            volume_minor NOT NULL DEFAULT 0,
+            new_users INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (granularity, bucket, currency)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS activity_sketches (
+            period TEXT PRIMARY KEY,
+            registers BLOB NOT NULL
+        ) WITHOUT ROWID
+    ''')
+
+    if conn.execute("SELECT 1 FROM rollup_totals WHERE metric = 'users'").fetchone():
+        return
+
+    # One-off backfill; afterwards every write path maintains the rollups
+    for created_at, in conn.execute('SELECT created_at FROM users WHERE created_at IS NOT NULL').fetchall():
+        record_signup(conn, str(created_at))
+    for currency, amount, created_at in conn.execute(
+        "SELECT currency, amount_minor, created_at FROM transactions WHERE status = 'completed'"
+    ).fetchall():
+        record_transfer(conn, currency, money.from_db(amount), str(created_at))
+    conn.execute("INSERT OR IGNORE INTO rollup_totals (metric, currency, value) VALUES ('users', '', 0)")
+
+
+def _bucket_keys(created_at):
+    """Bucket keys for a timestamp at every granularity"""
+    timestamp = created_at.replace(' ', 'T')
+    return [(granularity, timestamp[:length]) for granularity, length in GRANULARITIES.items()]
+
+
+def record_transfer(conn, currency, amount, created_at, count=1):
+    """Add completed transfers (count of them, totalling amount minor units) to the rollups
+
+    Runs inside the writer's transaction. Volumes are summed with
+    money_add so 18-decimal currencies cannot overflow SQLite integers.
+    """
+    amount = money.to_db(amount)
+    conn.execute('''
+        INSERT INTO rollup_totals (metric, currency, value) VALUES ('transactions', ?, ?), ('volume', ?, ?)
+        ON CONFLICT (metric, currency) DO UPDATE SET value = money_add(value, excluded.value)
+    ''', (currency, count, currency, amount))
+    conn.executemany('''
+        INSERT INTO rollup_buckets (granularity, bucket, currency, tx_count, volume_minor) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (granularity, bucket, currency) DO UPDATE SET
+            tx_count = tx_count + excluded.tx_count,
+            volume_minor = money_add(volume_minor, excluded.volume_minor)
+    ''', [(granularity, bucket, currency, count, amount) for granularity, bucket in _bucket_keys(created_at)])
+
+
+def record_signup(conn, created_at):
+    """Add one registration to the rollups inside the writer's transaction"""
+    conn.execute('''
+        INSERT INTO rollup_totals (metric, currency, value) VALUES ('users', '', 1)
+        ON CONFLICT (metric, currency) DO UPDATE SET value = value + 1
+    ''')
+    conn.executemany('''
+        INSERT INTO rollup_buckets (granularity, bucket, currency, new_users) VALUES (?, ?, '', 1)
+        ON CONFLICT (granularity, bucket, currency) DO UPDATE SET new_users = new_users + 1
+    ''', _bucket_keys(created_at))
+
+
+def read_totals(conn):
+    """All-time totals from the rollup table (a handful of rows)
+
+    Rows with the same key are added up, so ``rollup_totals`` may be a
+    view over several shards.
+    """
+    totals = {'users': 0, 'transactions': {}, 'volume': {}, 'volume_minor': {}}
+    for metric, currency, value in conn.execute('SELECT metric, currency, value FROM rollup_totals'):
+        if metric == 'users':
+            totals['users'] += int(value)
+        elif metric == 'transactions':
+            totals['transactions'][currency] = totals['transactions'].get(currency, 0) + int(value)
+        elif metric == 'volume':
+            totals['volume_minor'][currency] = totals['volume_minor'].get(currency, 0) + money.from_db(value)
+    for currency, units in totals['volume_minor'].items():
+        totals['volume'][currency] = money.to_number(units, currency)
+    return totals
+
+
+def read_holdings(conn):
+    """Sum of all wallet balances per currency in minor units (one scan of wallets)"""
+    return {
+        currency: money.from_db(total)
+        for currency, total in conn.execute('SELECT currency, money_sum(balance_minor) FROM wallets GROUP BY currency')
+    }
+
+
+def validate_range(granularity, start, end):
+    """Reject unknown granularities and ranges spanning too many buckets"""
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"granularity must be one of: {', '.join(GRANULARITIES)}")
+    if end <= start:
+        raise ValueError('to must be after from')
+    if (end - start) / BUCKET_WIDTHS[granularity] > MAX_BUCKETS:
+        raise ValueError(f'Range spans more than {MAX_BUCKETS} {granularity} buckets')
+
+
+def read_buckets(conn, granularity, start, end, currency=None):
+    """Bucketed counts for every bucket overlapping the start..end datetimes"""
+    validate_range(granularity, start, end)
+    length = GRANULARITIES[granularity]
+    params = [granularity, start.isoformat()[:length], end.isoformat()[:length]]
+    currency_clause = ''
+    if currency:
+        currency_clause = "AND currency IN (?, '')"
+        params.append(currency)
+    rows = conn.execute(f'''
+        SELECT bucket, currency, tx_count, volume_minor, new_users FROM rollup_buckets
+        WHERE granularity = ? AND bucket >= ? AND bucket <= ? {currency_clause}
+        ORDER BY bucket
+    ''', params).fetchall()
+
+    buckets = {}
+    volumes = {}
+    for bucket, row_currency, tx_count, volume, new_users in rows:
+        entry = buckets.setdefault(bucket, {'bucket': bucket, 'new_users': 0, 'transactions': {}, 'volume': {}})
+        entry['new_users'] += new_users
+        if row_currency:
+            # Summed: a view over shards has one row per shard and key
+            entry['transactions'][row_currency] = entry['transactions'].get(row_currency, 0) + tx_count
+            volumes[bucket, row_currency] = volumes.get((bucket, row_currency), 0) + money.from_db(volume)
+    for (bucket, row_currency), units in volumes.items():
+        buckets[bucket]['volume'][row_currency] = money.to_number(units, row_currency)
+    return list(buckets.values())
+
+
+def prune_minute_buckets(conn, now=None):
+    """Drop minute buckets older than the retention window"""
+    cutoff = ((now or datetime.utcnow()) - MINUTE_RETENTION).isoformat()[:GRANULARITIES['minute']]
+    conn.execute("DELETE FROM rollup_buckets WHERE granularity = 'minute' AND bucket < ?", (cutoff,))
+
+
+class HyperLogLog:
+    """HyperLogLog cardinality sketch with 2**p one-byte registers"""
+
+    def __init__(self, p=14, registers=None):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(registers) if registers is not None else bytearray(self.m)
+        self.alpha = 0.7213 / (1 + 1.079 / self.m)
+
+    def add(self, value):
+        """Add a value (hashed with 64-bit BLAKE2b)"""
+        x = int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), 'big')
+        index = x >> (64 - self.p)
+        rest = x & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """Union with another sketch of the same precision"""
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self):
+        """Estimated number of distinct values"""
+        registers = self.registers
+        harmonic = sum(registers.count(r) * 2.0 ** -r for r in set(registers))
+        estimate = self.alpha * self.m * self.m / harmonic
+        zeros = registers.count(0)
+        if estimate <= 2.5 * self.m and zeros:
+            return int(round(self.m * math.log(self.m / zeros)))
+        return int(round(estimate))
+
+
+class ActivityTracker:
+    """Per-day active-user sketches, merged across workers through SQLite.
+
+    ``record`` only touches in-memory registers. A background thread
+    periodically folds them into ``activity_sketches`` with a register-wise
+    max, which is how HyperLogLog sketches union, so every worker's users
+    count once. Reads merge the stored sketch with this worker's unflushed
+    registers. Minute rollup buckets are pruned on each flush, in ``pool``
+    or in each of ``rollup_pools`` (the shards) when given.
+    """
+
+    def __init__(self, pool, precision=14, flush_interval=10.0, rollup_pools=None):
+        self.pool = pool
+        self.rollup_pools = rollup_pools
+        self.precision = precision
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._flusher_pid = None
+
+    def record(self, user_id, day=None):
+        """Mark user_id as active on day (default: today, UTC)"""
+        self._ensure_flusher()
+        day = day or datetime.utcnow().strftime('%Y-%m-%d')
+        with self._lock:
+            sketch = self._pending.get(day)
+            if sketch is None:
+                sketch = self._pending[day] = HyperLogLog(self.precision)
+            sketch.add(user_id)
+
+    def flush(self):
+        """Merge pending sketches into SQLite and prune old minute buckets"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        try:
+            with self.pool.transaction() as conn:
+                for day, sketch in pending.items():
+                    row = conn.execute('SELECT registers FROM activity_sketches WHERE period = ?', (day,)).fetchone()
+                    if row:
+                        sketch.merge(HyperLogLog(self.precision, row[0]))
+                    conn.execute(
+                        'INSERT OR REPLACE INTO activity_sketches (period, registers) VALUES (?, ?)',
+                        (day, bytes(sketch.registers))
+                    )
+                if self.rollup_pools is None:
+                    prune_minute_buckets(conn)
+            for rollup_pool in self.rollup_pools or ():
+                with rollup_pool.transaction() as conn:
+                    prune_minute_buckets(conn)
+        except Exception:
+            # Keep the registers for the next flush; merging is idempotent
+            with self._lock:
+                for day, sketch in pending.items():
+                    current = self._pending.get(day)
+                    if current is not None:
+                        sketch.merge(current)
+                    self._pending[day] = sketch
+            raise
+
+    def count(self, day):
+        """Estimated distinct active users on day"""
+        sketch = HyperLogLog(self.precision)
+        with self.pool.connection() as conn:
+            row = conn.execute('SELECT registers FROM activity_sketches WHERE period = ?', (day,)).fetchone()
+        if row:
+            sketch.merge(HyperLogLog(self.precision, row[0]))
+        with self._lock:
+            if day in self._pending:
+                sketch.merge(self._pending[day])
+        return sketch.count()
+
+    def _ensure_flusher(self):
+        """Start the flush thread once per worker process"""
+        if self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+            self._pending = {}
+        threading.Thread(target=self._flush_loop, name='activity-flusher', daemon=True).start()
+
+    def _flush_loop(self):
+        """Periodically persist sketches"""
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Activity sketch flush failed')
@@ -3,15 +3,54 @@ NomadPay Backend API - Main Application
 Production-ready Flask application with fixed authentication
 """
 
-from flask import Flask, jsonify, request
+from flask import Flask, jsonify, request, g, Response, stream_with_context, make_response
 from flask_cors import CORS
 import os
 import logging
-from datetime import datetime
+from datetime import datetime, timezone
 import sqlite3
-from werkzeug.security import generate_password_hash, check_password_hash
 import jwt
 from datetime import timedelta
+import uuid
+import json
+import urllib.request
+import base64
+import math
+import time
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from database import ConnectionPool
+from passwords import PasswordHasher, HashingUnavailable
+import money
+import ledger
+from ledger import Ledger, LedgerError
+import history
+import cache
+from cache import BalanceCache
+import auth
+import analytics
+import export
+import qr
+from qr import QRImageCache, QRError, NonceStore
+from analytics import ActivityTracker
+from auth import RevocationList, TokenVerifier, RefreshTokenStore, RefreshTokenError, RefreshTokenReused
+from history import InvalidQuery
+import idempotency
+from idempotency import IdempotencyStore, IdempotencyError
+import fx
+from fx import FXRates, FXError, RatesUnavailable
+from metrics import Metrics, TimedConnection
+from profiling import Profiler
+from ratelimit import RateLimiter, retry_after
+import stream
+from stream import StreamHub, StreamUnavailable
+import jobs
+from jobs import JobQueue, JobError
+import audit
+import eventlog
+from eventlog import EventLog
+from sharding import ShardSet, ShardedLedger, ShardMoving
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -32,49 +71,408 @@ CORS(app, supports_credentials=True, origins=[
 # Configuration
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key-change-in-production')
 app.config['DATABASE_URL'] = os.environ.get('DATABASE_URL', 'nomadpay.db')
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 8))
+app.config['DB_POOL_TIMEOUT'] = float(os.environ.get('DB_POOL_TIMEOUT', 5.0))
+app.config['DB_BUSY_TIMEOUT_MS'] = int(os.environ.get('DB_BUSY_TIMEOUT_MS', 5000))
+app.config['DB_CACHE_SIZE_KB'] = int(os.environ.get('DB_CACHE_SIZE_KB', 16384))
+app.config['DB_MMAP_SIZE'] = int(os.environ.get('DB_MMAP_SIZE', 268435456))
+app.config['DB_SYNCHRONOUS'] = os.environ.get('DB_SYNCHRONOUS', 'NORMAL')
+app.config['SHARD_DATABASES'] = [path.strip() for path in os.environ.get('SHARD_DATABASES', '').split(',') if path.strip()]
+app.config['SHARD_RESOLVE_INTERVAL'] = float(os.environ.get('SHARD_RESOLVE_INTERVAL', 10))
+app.config['PASSWORD_HASH_ITERATIONS'] = int(os.environ.get('PASSWORD_HASH_ITERATIONS', 600000))
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+app.config['PASSWORD_HASH_QUEUE'] = int(os.environ.get('PASSWORD_HASH_QUEUE', 32))
+app.config['PASSWORD_HASH_TIMEOUT'] = float(os.environ.get('PASSWORD_HASH_TIMEOUT', 5.0))
+app.config['LEDGER_GROUP_COMMIT'] = os.environ.get('LEDGER_GROUP_COMMIT', 'true').lower() == 'true'
+app.config['LEDGER_MAX_BATCH'] = int(os.environ.get('LEDGER_MAX_BATCH', 64))
+app.config['LEDGER_MAX_WAIT_MS'] = float(os.environ.get('LEDGER_MAX_WAIT_MS', 0))
+app.config['BATCH_MAX_TRANSFERS'] = int(os.environ.get('BATCH_MAX_TRANSFERS', 500))
+app.config['BALANCE_CACHE_SIZE'] = int(os.environ.get('BALANCE_CACHE_SIZE', 10000))
+app.config['BALANCE_CACHE_TTL'] = float(os.environ.get('BALANCE_CACHE_TTL', 30))
+app.config['BALANCE_CACHE_POLL_INTERVAL'] = float(os.environ.get('BALANCE_CACHE_POLL_INTERVAL', 0.5))
+app.config['TOKEN_CACHE_SIZE'] = int(os.environ.get('TOKEN_CACHE_SIZE', 50000))
+app.config['REVOCATION_CAPACITY'] = int(os.environ.get('REVOCATION_CAPACITY', 100000))
+app.config['REVOCATION_POLL_INTERVAL'] = float(os.environ.get('REVOCATION_POLL_INTERVAL', 1.0))
+app.config['REVOCATION_SWEEP_INTERVAL'] = float(os.environ.get('REVOCATION_SWEEP_INTERVAL', 300))
+app.config['REFRESH_SWEEP_INTERVAL'] = float(os.environ.get('REFRESH_SWEEP_INTERVAL', 600))
+app.config['ACTIVITY_FLUSH_INTERVAL'] = float(os.environ.get('ACTIVITY_FLUSH_INTERVAL', 10))
+app.config['QR_CACHE_BYTES'] = int(os.environ.get('QR_CACHE_BYTES', 32 * 1024 * 1024))
+app.config['QR_DEFAULT_TTL'] = int(os.environ.get('QR_DEFAULT_TTL', 86400))
+app.config['QR_MAX_TTL'] = int(os.environ.get('QR_MAX_TTL', 30 * 86400))
+app.config['IDEMPOTENCY_TTL'] = float(os.environ.get('IDEMPOTENCY_TTL', 86400))
+app.config['IDEMPOTENCY_WAIT_TIMEOUT'] = float(os.environ.get('IDEMPOTENCY_WAIT_TIMEOUT', 10))
+app.config['IDEMPOTENCY_CACHE_SIZE'] = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', 10000))
+app.config['FX_RATES_FILE'] = os.environ.get('FX_RATES_FILE', '')
+app.config['FX_BASE_CURRENCY'] = os.environ.get('FX_BASE_CURRENCY', 'USD').upper()
+app.config['FX_REFRESH_INTERVAL'] = float(os.environ.get('FX_REFRESH_INTERVAL', 5))
+app.config['FX_MAX_AGE'] = float(os.environ.get('FX_MAX_AGE', 0))
+app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR', '')
+app.config['METRICS_GAUGE_INTERVAL'] = float(os.environ.get('METRICS_GAUGE_INTERVAL', 5))
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN', '')
+app.config['PROFILE_ENABLED'] = os.environ.get('PROFILE_ENABLED', 'true').lower() == 'true'
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+app.config['PROFILE_SLOW_MS'] = float(os.environ.get('PROFILE_SLOW_MS', 200))
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', '')
+app.config['PROFILE_MAX_CAPTURES'] = int(os.environ.get('PROFILE_MAX_CAPTURES', 50))
+app.config['PROFILE_MAX_STATEMENTS'] = int(os.environ.get('PROFILE_MAX_STATEMENTS', 500))
+app.config['STREAM_MAX_CONNECTIONS'] = int(os.environ.get('STREAM_MAX_CONNECTIONS', 200))
+app.config['STREAM_POLL_INTERVAL'] = float(os.environ.get('STREAM_POLL_INTERVAL', 0.25))
+app.config['STREAM_HEARTBEAT'] = float(os.environ.get('STREAM_HEARTBEAT', 15))
+app.config['STREAM_MAX_DURATION'] = float(os.environ.get('STREAM_MAX_DURATION', 300))
+app.config['STREAM_SERVER'] = os.environ.get('STREAM_SERVER', 'false').lower() == 'true'
+app.config['JOBS_WORKERS'] = int(os.environ.get('JOBS_WORKERS', 2))
+app.config['JOBS_BATCH_SIZE'] = int(os.environ.get('JOBS_BATCH_SIZE', 32))
+app.config['JOBS_POLL_INTERVAL'] = float(os.environ.get('JOBS_POLL_INTERVAL', 1.0))
+app.config['JOBS_FLUSH_INTERVAL'] = float(os.environ.get('JOBS_FLUSH_INTERVAL', 0.05))
+app.config['JOBS_VISIBILITY_TIMEOUT'] = float(os.environ.get('JOBS_VISIBILITY_TIMEOUT', 60))
+app.config['JOBS_BACKOFF_MAX'] = float(os.environ.get('JOBS_BACKOFF_MAX', 300))
+app.config['NOTIFY_WEBHOOK_URL'] = os.environ.get('NOTIFY_WEBHOOK_URL', '')
+app.config['NOTIFY_WEBHOOK_TIMEOUT'] = float(os.environ.get('NOTIFY_WEBHOOK_TIMEOUT', 5))
+app.config['EVENTLOG_DIR'] = os.environ.get('EVENTLOG_DIR', '')
+app.config['EVENTLOG_SEGMENT_MB'] = int(os.environ.get('EVENTLOG_SEGMENT_MB', 64))
+app.config['EVENTLOG_FLUSH_INTERVAL'] = float(os.environ.get('EVENTLOG_FLUSH_INTERVAL', 0.05))
+app.config['RATE_LIMIT_ENABLED'] = os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+app.config['RATE_LIMIT_FILE'] = os.environ.get('RATE_LIMIT_FILE', '')
+app.config['RATE_LIMIT_SLOTS'] = int(os.environ.get('RATE_LIMIT_SLOTS', 65536))
+app.config['RATE_LIMIT_PROXY_HOPS'] = int(os.environ.get('RATE_LIMIT_PROXY_HOPS', 1))
+app.config['RATE_LIMIT_LOGIN_IP'] = os.environ.get('RATE_LIMIT_LOGIN_IP', '30/60')
+app.config['RATE_LIMIT_LOGIN_EMAIL'] = os.environ.get('RATE_LIMIT_LOGIN_EMAIL', '5/60')
+app.config['RATE_LIMIT_REGISTER_IP'] = os.environ.get('RATE_LIMIT_REGISTER_IP', '10/600')
+app.config['RATE_LIMIT_REFRESH_IP'] = os.environ.get('RATE_LIMIT_REFRESH_IP', '60/60')
+app.config['RATE_LIMIT_ADMIN_IP'] = os.environ.get('RATE_LIMIT_ADMIN_IP', '5/600')
+app.config['RATE_LIMIT_ADMIN_EMAIL'] = os.environ.get('RATE_LIMIT_ADMIN_EMAIL', '3/600')
+
+# Database connection pool (one per worker process)
+db_pool_options = {
+    'size': app.config['DB_POOL_SIZE'],
+    'timeout': app.config['DB_POOL_TIMEOUT'],
+    'busy_timeout_ms': app.config['DB_BUSY_TIMEOUT_MS'],
+    'cache_size_kb': app.config['DB_CACHE_SIZE_KB'],
+    'mmap_size': app.config['DB_MMAP_SIZE'],
+    'synchronous': app.config['DB_SYNCHRONOUS'],
+    'factory': TimedConnection if app.config['METRICS_ENABLED'] or app.config['PROFILE_ENABLED'] else sqlite3.Connection
+}
+db = ConnectionPool(app.config['DATABASE_URL'], on_connect=money.register, **db_pool_options)
+
+# With SHARD_DATABASES set, users, wallets and the ledger live in the shard
+# files and DATABASE_URL keeps the user directory and the global tables
+# (tokens, jobs, audit, FX rates, QR nonces, activity)
+shard_set = ShardSet(db, app.config['SHARD_DATABASES'], **db_pool_options) if app.config['SHARD_DATABASES'] else None
+user_pools = shard_set.shards if shard_set is not None else [db]
+
+# Password hashing pool (keeps PBKDF2 off the request thread)
+hasher = PasswordHasher(
+    iterations=app.config['PASSWORD_HASH_ITERATIONS'],
+    max_workers=app.config['PASSWORD_HASH_WORKERS'],
+    max_queue=app.config['PASSWORD_HASH_QUEUE'],
+    timeout=app.config['PASSWORD_HASH_TIMEOUT']
+)
+
+# Token buckets for the auth endpoints, shared by all workers on this host
+rate_limiter = RateLimiter(
+    {
+        'login_ip': app.config['RATE_LIMIT_LOGIN_IP'],
+        'login_email': app.config['RATE_LIMIT_LOGIN_EMAIL'],
+        'register_ip': app.config['RATE_LIMIT_REGISTER_IP'],
+        'refresh_ip': app.config['RATE_LIMIT_REFRESH_IP'],
+        'admin_ip': app.config['RATE_LIMIT_ADMIN_IP'],
+        'admin_email': app.config['RATE_LIMIT_ADMIN_EMAIL'],
+    } if app.config['RATE_LIMIT_ENABLED'] else {},
+    path=app.config['RATE_LIMIT_FILE'] or None,
+    slots=app.config['RATE_LIMIT_SLOTS']
+)
+
+# Ledger with group commit of concurrent transfers (per shard when sharded)
+ledger_options = {
+    'group_commit': app.config['LEDGER_GROUP_COMMIT'],
+    'max_batch': app.config['LEDGER_MAX_BATCH'],
+    'max_wait_ms': app.config['LEDGER_MAX_WAIT_MS']
+}
+if shard_set is not None:
+    transfers = ShardedLedger(shard_set, resolve_interval=app.config['SHARD_RESOLVE_INTERVAL'], **ledger_options)
+else:
+    transfers = Ledger(db, **ledger_options)
+
+# Balance cache, invalidated by ledger commits in this worker and by the
+# balance_changes feed for commits in other workers
+balance_cache = BalanceCache(
+    user_pools,
+    max_entries=app.config['BALANCE_CACHE_SIZE'],
+    ttl=app.config['BALANCE_CACHE_TTL'],
+    poll_interval=app.config['BALANCE_CACHE_POLL_INTERVAL']
+)
+
+@transfers.on_commit
+def invalidate_balances(results):
+    """Drop cached balances for both sides of committed transfers"""
+    user_ids = set()
+    for result in results:
+        user_ids.add(result['sender_id'])
+        user_ids.add(result['recipient_id'])
+    balance_cache.invalidate(user_ids)
+
+# Open /api/wallet/stream connections, woken by commits in this worker and
+# by the balance_changes feed for commits in other workers
+stream_hub = StreamHub(
+    user_pools,
+    poll_interval=app.config['STREAM_POLL_INTERVAL'],
+    max_connections=app.config['STREAM_MAX_CONNECTIONS']
+)
+
+@transfers.on_commit
+def wake_streams(results):
+    """Push committed transfers to both sides' open streams"""
+    user_ids = set()
+    for result in results:
+        user_ids.add(result['sender_id'])
+        user_ids.add(result['recipient_id'])
+    stream_hub.notify(user_ids)
+
+# Access token verification with cached claims and revocation checks
+token_verifier = TokenVerifier(
+    app.config['SECRET_KEY'],
+    RevocationList(
+        db,
+        capacity=app.config['REVOCATION_CAPACITY'],
+        poll_interval=app.config['REVOCATION_POLL_INTERVAL'],
+        sweep_interval=app.config['REVOCATION_SWEEP_INTERVAL']
+    ),
+    max_entries=app.config['TOKEN_CACHE_SIZE']
+)
+
+# Single-use refresh tokens with reuse detection
+refresh_store = RefreshTokenStore(db, sweep_interval=app.config['REFRESH_SWEEP_INTERVAL'])
+
+# Active-user sketches for analytics
+activity = ActivityTracker(
+    db,
+    flush_interval=app.config['ACTIVITY_FLUSH_INTERVAL'],
+    rollup_pools=shard_set.shards if shard_set is not None else None
+)
+
+# Rendered QR images keyed by payload hash
+qr_cache = QRImageCache(max_bytes=app.config['QR_CACHE_BYTES'])
+qr_key = qr.signing_key(app.config['SECRET_KEY'])
+qr_nonces = NonceStore(db)
+
+# Stored responses for Idempotency-Key retries, kept next to the user's
+# wallets so a payment can mark its key applied in its own transaction
+idempotency_stores = [
+    IdempotencyStore(
+        pool,
+        ttl=app.config['IDEMPOTENCY_TTL'],
+        wait_timeout=app.config['IDEMPOTENCY_WAIT_TIMEOUT'],
+        hot_size=app.config['IDEMPOTENCY_CACHE_SIZE']
+    )
+    for pool in user_pools
+]
+
+# Exchange rates for valuing holdings in a base currency
+fx_rates = FXRates(db, refresh_interval=app.config['FX_REFRESH_INTERVAL'], max_age=app.config['FX_MAX_AGE'])
+
+# Background jobs: deferred wallet creation, audit writes and notifications
+job_queue = JobQueue(
+    db,
+    workers=app.config['JOBS_WORKERS'],
+    batch_size=app.config['JOBS_BATCH_SIZE'],
+    poll_interval=app.config['JOBS_POLL_INTERVAL'],
+    flush_interval=app.config['JOBS_FLUSH_INTERVAL'],
+    visibility_timeout=app.config['JOBS_VISIBILITY_TIMEOUT'],
+    backoff_max=app.config['JOBS_BACKOFF_MAX']
+)
+
+# Append-only log of transfers, signups and audit events for replay and
+# verification (see eventlog.py); disabled unless EVENTLOG_DIR is set
+event_log = EventLog(
+    app.config['EVENTLOG_DIR'],
+    segment_bytes=app.config['EVENTLOG_SEGMENT_MB'] * 1024 * 1024,
+    flush_interval=app.config['EVENTLOG_FLUSH_INTERVAL']
+) if app.config['EVENTLOG_DIR'] else None
+
+if event_log is not None:
+    @transfers.on_commit
+    def log_transfers(results):
+        """Append committed transfers to the event log"""
+        event_log.transfers(results)
+
+# Request metrics, summed across workers through per-worker mmap files
+metrics = Metrics(app.config['METRICS_DIR'] or None, gauge_interval=app.config['METRICS_GAUGE_INTERVAL'])
+
+@metrics.register_gauges
+def component_gauges():
+    """Pool and cache gauges for this worker"""
+    pool = db.stats()
+    hashing = hasher.stats()
+    balances = balance_cache.stats()
+    tokens = token_verifier.stats()
+    images = qr_cache.stats()
+    queued = job_queue.depth()
+    return [
+        ('nomadpay_db_pool_in_use', 'Connections checked out', pool['in_use']),
+        ('nomadpay_db_pool_idle', 'Idle pooled connections', pool['idle']),
+        ('nomadpay_db_pool_waits', 'Checkouts that had to wait', pool['waits']),
+        ('nomadpay_db_pool_timeouts', 'Checkouts that timed out', pool['timeouts']),
+        ('nomadpay_password_hash_rejected', 'Hashing jobs rejected by a full queue', hashing['rejected']),
+        ('nomadpay_password_hash_timeouts', 'Hashing jobs that timed out', hashing['timeouts']),
+        ('nomadpay_balance_cache_entries', 'Cached balance sets', balances['size']),
+        ('nomadpay_balance_cache_hit_ratio', 'Balance cache hit ratio', balances['hit_ratio']),
+        ('nomadpay_token_cache_entries', 'Cached token claims', tokens['size']),
+        ('nomadpay_qr_cache_bytes', 'Bytes of cached QR images', images['bytes']),
+        ('nomadpay_idempotency_in_flight', 'Keyed requests in progress',
+         sum(store.stats()['in_flight'] for store in idempotency_stores)),
+        ('nomadpay_stream_connections', 'Open wallet event streams', stream_hub.stats()['connections']),
+        ('nomadpay_jobs_ready', 'Jobs waiting to run', sum(queued['ready'].values())),
+        ('nomadpay_jobs_running', 'Jobs claimed by a worker', sum(queued['running'].values())),
+        ('nomadpay_jobs_dead', 'Jobs that exhausted their retries', sum(queued['dead'].values())),
+        ('nomadpay_jobs_oldest_ready_seconds', 'Age of the oldest waiting job', queued['oldest_ready_age_s']),
+        ('nomadpay_rate_limit_blocked_keys', 'Rate limit keys blocked in memory', rate_limiter.stats()['blocked_keys']),
+        ('nomadpay_eventlog_buffered_bytes', 'Event log bytes waiting for fsync',
+         event_log.stats()['buffered_bytes'] if event_log is not None else 0),
+    ]
+
+if app.config['METRICS_ENABLED']:
+    @app.before_request
+    def start_request_metrics():
+        """Start the request clock and reset the SQL timer"""
+        g.request_started = time.perf_counter()
+        metrics.start_request()
+    
+    @app.after_request
+    def record_request_metrics(response):
+        """Record latency, status class and SQL work for the matched route"""
+        started = g.get('request_started')
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            metrics.observe_request(route, request.method, response.status_code, time.perf_counter() - started)
+        return response
+
+# Opt-in request profiling (X-Profile: <admin access token>, or sampled)
+profiler = Profiler(
+    app.config['PROFILE_DIR'] or None,
+    sample_rate=app.config['PROFILE_SAMPLE_RATE'],
+    slow_ms=app.config['PROFILE_SLOW_MS'],
+    max_captures=app.config['PROFILE_MAX_CAPTURES'],
+    max_statements=app.config['PROFILE_MAX_STATEMENTS']
+)
+
+def profile_requested():
+    """True if the X-Profile header carries a valid admin access token"""
+    token = request.headers.get('X-Profile')
+    if not token:
+        return False
+    try:
+        return token_verifier.verify(token).get('role') == 'admin'
+    except jwt.InvalidTokenError:
+        return False
+
+if app.config['PROFILE_ENABLED']:
+    @app.before_request
+    def start_request_profile():
+        """Profile this request if an admin asked for it or it was sampled"""
+        if 'X-Profile' in request.headers and profile_requested():
+            g.profile = profiler.start('requested')
+        elif profiler.sample_rate and profiler.sample():
+            g.profile = profiler.start('sampled')
+    
+    @app.after_request
+    def finish_request_profile(response):
+        """Store the capture and point admins at it"""
+        session = g.pop('profile', None)
+        if session is not None:
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            capture_id = profiler.finish(session, route, request.method, request.path, response.status_code)
+            if capture_id and session.reason == 'requested':
+                response.headers['X-Profile-Id'] = capture_id
+        return response
+
+def hashing_unavailable_response():
+    """503 response for a saturated or timed-out hashing pool"""
+    response = jsonify({
+        'success': False,
+        'message': 'Service is busy. Please try again shortly.'
+    })
+    response.headers['Retry-After'] = '1'
+    return response, 503
 
 # Database initialization
+def create_tables(conn):
+    """Create every table and index inside the caller's transaction (also used for shard files)"""
+    cursor = conn.cursor()
+    
+    # Create users table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            role TEXT DEFAULT 'user',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Create wallets table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS wallets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            currency TEXT NOT NULL,
+            balance_minor NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    
+    # Create tables owned by feature modules
+    ledger.init_schema(conn)
+    history.init_schema(conn)
+    cache.init_schema(conn)
+    auth.init_schema(conn)
+    auth.init_refresh_schema(conn)
+    analytics.init_schema(conn)
+    export.init_schema(conn)
+    qr.init_schema(conn)
+    idempotency.init_schema(conn)
+    fx.init_schema(conn)
+    jobs.init_schema(conn)
+    audit.init_schema(conn)
+
 def init_database():
     """Initialize the database with required tables"""
     try:
-        conn = sqlite3.connect(app.config['DATABASE_URL'])
-        cursor = conn.cursor()
-        
-        # Create users table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                email TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                role TEXT DEFAULT 'user',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Create wallets table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS wallets (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                currency TEXT NOT NULL,
-                balance DECIMAL(15,2) DEFAULT 0.00,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
+        with db.transaction() as conn:
+            create_tables(conn)
+        if shard_set is not None:
+            shard_set.init_schema(create_tables)
         
-        conn.commit()
-        conn.close()
         logger.info("Database initialized successfully")
         
+        # Replay starts from a checkpoint, so take one before the first event
+        if event_log is not None and eventlog.latest_checkpoint(app.config['EVENTLOG_DIR']) is None:
+            if shard_set is not None:
+                logger.warning("Event log checkpoints cover a single database; not taken with SHARD_DATABASES")
+            else:
+                with db.dedicated() as conn:
+                    eventlog.write_checkpoint(conn, app.config['EVENTLOG_DIR'])
+        
+        if app.config['FX_RATES_FILE']:
+            try:
+                fx_rates.load_file(app.config['FX_RATES_FILE'])
+            except (OSError, ValueError, FXError) as e:
+                logger.warning(f"FX rates file not loaded: {e}")
+        
     except Exception as e:
         logger.error(f"Database initialization error: {e}")
         raise
 
 # Token generation
-def generate_tokens(user_id, email, role='user'):
-    """Generate access and refresh tokens"""
+def generate_tokens(user_id, email, role='user', rotate=None):
+    """Generate access and refresh tokens
+
+    Pass the claims of the refresh token being exchanged as ``rotate`` to
+    consume it and keep the new refresh token in the same family.
+    """
     try:
         # Access token (1 hour expiry)
         access_payload = {
@@ -83,18 +481,30 @@ def generate_tokens(user_id, email, role='user'):
             'role': role,
             'exp': datetime.utcnow() + timedelta(hours=1),
             'iat': datetime.utcnow(),
+            'jti': uuid.uuid4().hex,
             'type': 'access'
         }
         
         # Refresh token (7 days expiry)
+        refresh_jti = uuid.uuid4().hex
         refresh_payload = {
             'user_id': user_id,
             'email': email,
+            'role': role,
             'exp': datetime.utcnow() + timedelta(days=7),
             'iat': datetime.utcnow(),
+            'jti': refresh_jti,
+            'fam': rotate['fam'] if rotate else refresh_jti,
             'type': 'refresh'
         }
         
+        # Record the refresh token so it can only be used once
+        expires_at = refresh_payload['exp'].replace(tzinfo=timezone.utc).timestamp()
+        if rotate:
+            refresh_store.rotate(rotate['jti'], rotate['fam'], refresh_jti, user_id, expires_at)
+        else:
+            refresh_store.issue(refresh_jti, user_id, expires_at)
+        
         access_token = jwt.encode(access_payload, app.config['SECRET_KEY'], algorithm='HS256')
         refresh_token = jwt.encode(refresh_payload, app.config['SECRET_KEY'], algorithm='HS256')
         
@@ -103,32 +513,332 @@ def generate_tokens(user_id, email, role='user'):
             'refresh_token': refresh_token
         }
         
+    except RefreshTokenError:
+        raise
     except Exception as e:
         logger.error(f"Token generation error: {e}")
         raise
 
-# Create default wallets
-def create_default_wallets(user_id):
-    """Create default wallets for new user"""
-    try:
-        conn = sqlite3.connect(app.config['DATABASE_URL'])
-        cursor = conn.cursor()
+# Default wallet currencies for new users
+DEFAULT_CURRENCIES = ['USD', 'EUR', 'BTC', 'ETH']
+
+# Batch payout modes
+BATCH_MODES = ('atomic', 'best_effort')
+
+# Authentication decorator
+def token_required(f=None, query_param=None):
+    """Require a valid access token; exposes its claims as g.user
+
+    ``query_param`` also accepts the token from that query parameter, for
+    clients such as EventSource that cannot set headers.
+    """
+    if f is None:
+        return lambda f: token_required(f, query_param)
+    
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        auth_header = request.headers.get('Authorization', '')
+        if query_param and not auth_header and request.args.get(query_param):
+            auth_header = 'Bearer ' + request.args[query_param]
+        if not auth_header.startswith('Bearer '):
+            return jsonify({
+                'success': False,
+                'message': 'Authentication token is required'
+            }), 401
+        
+        try:
+            payload = token_verifier.verify(auth_header[7:])
+        except jwt.ExpiredSignatureError:
+            return jsonify({
+                'success': False,
+                'message': 'Token has expired'
+            }), 401
+        except jwt.InvalidTokenError:
+            return jsonify({
+                'success': False,
+                'message': 'Invalid token'
+            }), 401
         
-        # Create default wallets for major currencies
-        currencies = ['USD', 'EUR', 'BTC', 'ETH']
-        for currency in currencies:
-            cursor.execute('''
-                INSERT INTO wallets (user_id, currency, balance)
-                VALUES (?, ?, 0.00)
-            ''', (user_id, currency))
+        g.user = payload
+        g.token = auth_header[7:]
+        activity.record(payload['user_id'])
+        return f(*args, **kwargs)
+    return decorated
+
+def blocking_worker():
+    """True under gunicorn's sync worker, which serves requests on the main thread one at a time"""
+    return (
+        request.environ.get('SERVER_SOFTWARE', '').startswith('gunicorn/')
+        and threading.current_thread() is threading.main_thread()
+    )
+
+# Routes a STREAM_SERVER process answers; everything else stays on the API
+# service, so password hashing and SQLite writes never block the gevent hub
+STREAM_SERVER_ENDPOINTS = ('wallet_stream', 'health_check')
+
+if app.config['STREAM_SERVER']:
+    @app.before_request
+    def stream_server_only():
+        """Refuse API routes in the gevent stream process"""
+        if request.endpoint not in STREAM_SERVER_ENDPOINTS:
+            return jsonify({
+                'success': False,
+                'message': 'This server only serves /api/wallet/stream'
+            }), 404
+
+def client_ip():
+    """Client address, skipping RATE_LIMIT_PROXY_HOPS trusted proxies in X-Forwarded-For"""
+    hops = app.config['RATE_LIMIT_PROXY_HOPS']
+    route = request.access_route
+    if hops and request.headers.get('X-Forwarded-For') and len(route) >= hops:
+        return route[-hops]
+    return request.remote_addr or 'unknown'
+
+def rate_limited(*limits):
+    """Throttle a route by named limits ending in '_ip' or '_email' before it does any work"""
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            wait = 0.0
+            for name in limits:
+                if name.endswith('_email'):
+                    data = request.get_json(silent=True)
+                    email = data.get('email') if isinstance(data, dict) else None
+                    if not isinstance(email, str) or not email.strip():
+                        continue
+                    subject = email.lower().strip()
+                else:
+                    subject = client_ip()
+                wait = max(wait, rate_limiter.check(name, subject))
+            if wait:
+                response = jsonify({
+                    'success': False,
+                    'message': 'Too many attempts. Please try again later.'
+                })
+                response.headers['Retry-After'] = retry_after(wait)
+                return response, 429
+            return f(*args, **kwargs)
+        return decorated
+    return decorator
+
+def admin_required(f):
+    """Require a valid access token with the admin role"""
+    @wraps(f)
+    @token_required
+    def decorated(*args, **kwargs):
+        if g.user.get('role') != 'admin':
+            return jsonify({
+                'success': False,
+                'message': 'Admin access required'
+            }), 403
+        return f(*args, **kwargs)
+    return decorated
+
+def idempotent(f):
+    """Execute a keyed POST once and replay its response for retries with the same Idempotency-Key"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            return f(*args, **kwargs)
+        if not key or len(key) > idempotency.MAX_KEY_LENGTH:
+            return jsonify({
+                'success': False,
+                'message': f'Idempotency-Key must be 1-{idempotency.MAX_KEY_LENGTH} characters'
+            }), 400
         
-        conn.commit()
-        conn.close()
-        logger.info(f"Default wallets created for user {user_id}")
+        def handler(claim):
+            g.idempotency_claim = claim
+            response = make_response(f(*args, **kwargs))
+            return response.status_code, response.get_data(as_text=True), response.mimetype
         
-    except Exception as e:
-        logger.error(f"Wallet creation error: {e}")
-        raise
+        try:
+            status, body, content_type, replayed = idempotency_store(g.user['user_id']).execute(
+                f"{g.user['user_id']}:{key}",
+                idempotency.fingerprint(request.method, request.path, request.get_data()),
+                handler
+            )
+        except (IdempotencyError, ShardMoving) as e:
+            return jsonify({
+                'success': False,
+                'message': str(e)
+            }), e.status_code
+        
+        response = Response(body, status=status, mimetype=content_type)
+        if replayed:
+            response.headers['Idempotent-Replayed'] = 'true'
+        return response
+    return decorated
+
+def apply_hooks(*hooks):
+    """Ledger on_apply callback running hooks in the payment's transaction
+
+    Under ``@idempotent`` it first marks the request's Idempotency-Key as
+    applied, so the key commits (or rolls back) together with the payment.
+    """
+    claim = g.get('idempotency_claim')
+    hooks = ([claim.mark_applied] if claim is not None else []) + [hook for hook in hooks if hook is not None]
+    if not hooks:
+        return None
+    
+    def on_apply(conn):
+        for hook in hooks:
+            hook(conn)
+    return on_apply
+
+def abort_hook():
+    """Ledger on_abort callback giving the Idempotency-Key back
+
+    A cross-shard payment marks the key when its debit is prepared; if
+    the transfer is aborted afterwards, the key is released so a retry
+    runs the payment again.
+    """
+    claim = g.get('idempotency_claim')
+    return claim.release if claim is not None else None
+
+# Create default wallets
+def create_default_wallets(conn, user_id):
+    """Create default wallets for new user inside the caller's transaction"""
+    # One multi-row INSERT instead of a round trip per currency
+    placeholders = ', '.join(['(?, ?, 0)'] * len(DEFAULT_CURRENCIES))
+    params = []
+    for currency in DEFAULT_CURRENCIES:
+        params.extend((user_id, currency))
+    conn.execute(f'''
+        INSERT OR IGNORE INTO wallets (user_id, currency, balance_minor)
+        VALUES {placeholders}
+    ''', params)
+
+# Create user with wallets
+def create_user(conn, email, password_hash, role, created_at, user_id=None):
+    """Insert a user and their default wallets; raises sqlite3.IntegrityError on duplicate email
+
+    Pass the ``user_id`` allocated by the shard directory when sharded.
+    """
+    cursor = conn.execute('''
+        INSERT INTO users (id, email, password_hash, role, created_at)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (user_id, email, password_hash, role, created_at))
+    user_id = cursor.lastrowid
+    create_default_wallets(conn, user_id)
+    analytics.record_signup(conn, created_at)
+    return user_id
+
+def idempotency_store(user_id):
+    """Idempotency store on the user's shard (the only store when not sharded)"""
+    if shard_set is None:
+        return idempotency_stores[0]
+    return idempotency_stores[shard_set.shard_of(user_id) or 0]
+
+def user_pool(user_id):
+    """Connection pool holding a user's wallets and ledger entries"""
+    if shard_set is None:
+        return db
+    pool = shard_set.pool_for(user_id)
+    if pool is None:
+        raise ledger.WalletNotFound('User not found')
+    return pool
+
+def find_user_ids(emails):
+    """{email: user_id} for the registered users among emails"""
+    if shard_set is not None:
+        return shard_set.lookup(emails)
+    emails = sorted(set(emails))
+    found = {}
+    with db.connection() as conn:
+        for start in range(0, len(emails), 500):
+            chunk = emails[start:start + 500]
+            found.update(conn.execute(
+                f"SELECT email, id FROM users WHERE email IN ({', '.join('?' * len(chunk))})", chunk
+            ).fetchall())
+    return found
+
+def resolve_emails(user_ids):
+    """Emails of history counterparties living on another shard"""
+    return shard_set.emails(user_ids) if shard_set is not None else {}
+
+@contextmanager
+def admin_connection():
+    """Connection for admin reads, seeing every shard's users and ledger when sharded"""
+    if shard_set is None:
+        with db.connection() as conn:
+            yield conn
+    else:
+        with shard_set.dedicated() as conn:
+            yield conn
+
+def audit_event(event, user_id=None, conn=None, durable=False, ip=None, **data):
+    """Queue an audit log record for the current request
+
+    The job is written in ``conn``'s transaction when given, so the record
+    commits with the change it describes; ``durable`` writes it in a
+    transaction of its own (for changes committed elsewhere). Otherwise
+    it is buffered like notifications, so a crash can lose the last
+    JOBS_FLUSH_INTERVAL of them. ``ip`` is for callers off the request
+    thread (ledger hooks).
+    """
+    record = audit.record(event, user_id, ip or client_ip(), datetime.utcnow().isoformat(), **data)
+    if conn is not None:
+        job_queue.enqueue('audit', record, lane='low', conn=conn)
+    elif durable:
+        with db.transaction() as conn:
+            job_queue.enqueue('audit', record, lane='low', conn=conn)
+    else:
+        job_queue.enqueue('audit', record, lane='low')
+    if event_log is not None:
+        event_log.audit(record)
+
+def transfer_audits(results):
+    """Audit fields of committed transfers"""
+    return [{'reference': result['reference'], 'recipient_id': result['recipient_id'],
+             'amount': result['amount'], 'currency': result['currency']} for result in results]
+
+def payment_audit(event, records):
+    """Ledger on_applied callback queueing a payment's audit records in its transaction
+
+    ``records(results)`` gives the audit fields for the applied transfers.
+    With SHARD_DATABASES the payment commits on a shard while the job
+    table lives in DATABASE_URL, so this returns None and the route calls
+    ``audit_payment`` once the payment has committed.
+    """
+    if shard_set is not None:
+        return None
+    user_id = g.user['user_id']
+    ip = client_ip()
+    
+    def on_applied(conn, results):
+        for data in records(results):
+            audit_event(event, user_id, conn=conn, ip=ip, **data)
+    return on_applied
+
+def audit_payment(event, records, results):
+    """Write a sharded payment's audit records after its commit (see payment_audit)"""
+    if shard_set is None:
+        return
+    for data in records(results):
+        audit_event(event, g.user['user_id'], durable=True, **data)
+
+def notify(user_id, event, **data):
+    """Queue a notification for a user"""
+    job_queue.enqueue('notify', {'user_id': user_id, 'event': event, 'data': data})
+
+@job_queue.handler('audit', batch=True)
+def audit_job(payloads):
+    """Write a batch of audit records"""
+    with db.transaction() as conn:
+        audit.write(conn, payloads)
+
+@job_queue.handler('notify')
+def notify_job(payload):
+    """Deliver a notification to NOTIFY_WEBHOOK_URL (logged when unset)"""
+    url = app.config['NOTIFY_WEBHOOK_URL']
+    if not url:
+        logger.debug(f"Notification {payload['event']} for user {payload['user_id']} (no webhook configured)")
+        return
+    body = json.dumps(payload).encode()
+    req = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'}, method='POST')
+    with urllib.request.urlopen(req, timeout=app.config['NOTIFY_WEBHOOK_TIMEOUT']) as response:
+        response.read()
 
 # Health check endpoint
 @app.route('/health', methods=['GET'])
@@ -160,6 +870,7 @@ def root():
 
 # Authentication routes with FIXED response structure
 @app.route('/api/auth/register', methods=['POST'])
+@rate_limited('register_ip')
 def register():
     """User registration endpoint with FIXED response structure"""
     try:
@@ -189,34 +900,36 @@ def register():
                 'message': 'Password must be at least 8 characters long'
             }), 400
         
-        # Check if user already exists
-        conn = sqlite3.connect(app.config['DATABASE_URL'])
-        cursor = conn.cursor()
+        # Hash before taking the write lock
+        password_hash = hasher.hash(password)
+        created_at = datetime.utcnow().isoformat()
         
-        cursor.execute('SELECT id FROM users WHERE email = ?', (email,))
-        if cursor.fetchone():
-            conn.close()
+        # Create the user, their wallets and the audit record in one
+        # transaction; the UNIQUE constraint on email rejects duplicates.
+        # Sharded, the user commits on their shard and the audit record
+        # in DATABASE_URL right after.
+        try:
+            if shard_set is not None:
+                user_id = shard_set.create_user(
+                    email, lambda conn, user_id: create_user(conn, email, password_hash, 'user', created_at, user_id)
+                )
+                audit_event('register', user_id, durable=True)
+            else:
+                with db.transaction() as conn:
+                    user_id = create_user(conn, email, password_hash, 'user', created_at)
+                    audit_event('register', user_id, conn=conn)
+        except sqlite3.IntegrityError:
             return jsonify({
                 'success': False,
                 'message': 'User already exists with this email'
             }), 409
-        
-        # Create new user
-        password_hash = generate_password_hash(password)
-        cursor.execute('''
-            INSERT INTO users (email, password_hash, role, created_at)
-            VALUES (?, ?, ?, ?)
-        ''', (email, password_hash, 'user', datetime.utcnow().isoformat()))
-        
-        user_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        
-        # Create default wallets
-        create_default_wallets(user_id)
+        job_queue.wake()
+        if event_log is not None:
+            event_log.signup(user_id, created_at)
         
         # Generate tokens
         tokens = generate_tokens(user_id, email, 'user')
+        activity.record(user_id)
         
         # ✅ FIXED: Return correct response structure with access_token and refresh_token
         response_data = {
@@ -228,13 +941,17 @@ def register():
                 'id': str(user_id),
                 'email': email,
                 'role': 'user',
-                'created_at': datetime.utcnow().isoformat()
+                'created_at': created_at
             }
         }
         
+        notify(user_id, 'welcome', email=email)
         logger.info(f"User registered successfully: {email}")
         return jsonify(response_data), 201
         
+    except HashingUnavailable as e:
+        logger.warning(f"Registration deferred: {e}")
+        return hashing_unavailable_response()
     except Exception as e:
         logger.error(f"Registration error: {e}")
         return jsonify({
@@ -243,6 +960,7 @@ def register():
         }), 500
 
 @app.route('/api/auth/login', methods=['POST'])
+@rate_limited('login_ip', 'login_email')
 def login():
     """User login endpoint with FIXED response structure"""
     try:
@@ -258,19 +976,25 @@ def login():
         email = data['email'].lower().strip()
         password = data['password']
         
-        # Find user in database
-        conn = sqlite3.connect(app.config['DATABASE_URL'])
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT id, email, password_hash, role, created_at
-            FROM users WHERE email = ?
-        ''', (email,))
-        
-        user = cursor.fetchone()
-        conn.close()
+        # Find user in database (on their shard, found through the directory)
+        pool = db
+        if shard_set is not None:
+            located = shard_set.locate(email)
+            pool = shard_set.shards[located[1]] if located else None
+        user = None
+        if pool is not None:
+            with pool.connection() as conn:
+                cursor = conn.cursor()
+                
+                cursor.execute('''
+                    SELECT id, email, password_hash, role, created_at
+                    FROM users WHERE email = ?
+                ''', (email,))
+                
+                user = cursor.fetchone()
         
         if not user:
+            audit_event('login_failed', email=email)
             return jsonify({
                 'success': False,
                 'message': 'Invalid email or password'
@@ -279,14 +1003,29 @@ def login():
         user_id, user_email, password_hash, role, created_at = user
         
         # Verify password
-        if not check_password_hash(password_hash, password):
+        if not hasher.verify(password_hash, password):
+            audit_event('login_failed', user_id, email=email)
             return jsonify({
                 'success': False,
                 'message': 'Invalid email or password'
             }), 401
         
+        # Transparently upgrade hashes made with an older work factor
+        if hasher.needs_rehash(password_hash):
+            try:
+                new_hash = hasher.hash(password)
+                with pool.transaction() as conn:
+                    conn.execute(
+                        'UPDATE users SET password_hash = ?, updated_at = ? WHERE id = ? AND password_hash = ?',
+                        (new_hash, datetime.utcnow().isoformat(), user_id, password_hash)
+                    )
+                hasher.record_rehash()
+            except Exception as e:
+                logger.warning(f"Password rehash skipped for user {user_id}: {e}")
+        
         # Generate tokens
         tokens = generate_tokens(user_id, user_email, role)
+        activity.record(user_id)
         
         # ✅ FIXED: Return correct response structure with access_token and refresh_token
         response_data = {
@@ -302,9 +1041,18 @@ def login():
             }
         }
         
+        audit_event('login', user_id)
         logger.info(f"User logged in successfully: {email}")
         return jsonify(response_data), 200
         
+    except HashingUnavailable as e:
+        logger.warning(f"Login deferred: {e}")
+        return hashing_unavailable_response()
+    except ShardMoving as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), e.status_code
     except Exception as e:
         logger.error(f"Login error: {e}")
         return jsonify({
@@ -313,6 +1061,7 @@ def login():
         }), 500
 
 @app.route('/api/auth/refresh', methods=['POST'])
+@rate_limited('refresh_ip')
 def refresh_token():
     """Token refresh endpoint"""
     try:
@@ -328,17 +1077,16 @@ def refresh_token():
         
         # Verify refresh token
         try:
-            payload = jwt.decode(refresh_token, app.config['SECRET_KEY'], algorithms=['HS256'])
-            
-            if payload.get('type') != 'refresh':
-                raise jwt.InvalidTokenError('Invalid token type')
+            payload = token_verifier.verify(refresh_token, token_type='refresh')
+            if not payload.get('jti') or not payload.get('fam'):
+                raise jwt.InvalidTokenError('Refresh token predates rotation')
             
             user_id = payload['user_id']
             email = payload['email']
             role = payload.get('role', 'user')
             
-            # Generate new tokens
-            tokens = generate_tokens(user_id, email, role)
+            # Rotate: consume this refresh token and issue its successor
+            tokens = generate_tokens(user_id, email, role, rotate=payload)
             
             response_data = {
                 'success': True,
@@ -354,7 +1102,14 @@ def refresh_token():
                 'success': False,
                 'message': 'Refresh token has expired'
             }), 401
-        except jwt.InvalidTokenError:
+        except RefreshTokenReused:
+            logger.warning(f"Refresh token reuse detected for user {payload['user_id']}; family revoked")
+            audit_event('refresh_token_reuse', payload['user_id'], durable=True, family=payload['fam'])
+            return jsonify({
+                'success': False,
+                'message': 'Refresh token has already been used. Please log in again.'
+            }), 401
+        except (jwt.InvalidTokenError, RefreshTokenError):
             return jsonify({
                 'success': False,
                 'message': 'Invalid refresh token'
@@ -368,11 +1123,24 @@ def refresh_token():
         }), 500
 
 @app.route('/api/auth/logout', methods=['POST'])
+@token_required
 def logout():
     """User logout endpoint"""
     try:
-        # In a production environment, you would invalidate the tokens
-        # For now, we'll just return a success response
+        # Revoke the access token used for this request
+        token_verifier.revoke(g.token, g.user)
+        
+        # Revoke the refresh token too when the client sends it
+        data = request.get_json(silent=True) or {}
+        if data.get('refresh_token'):
+            try:
+                refresh_claims = token_verifier.verify(data['refresh_token'], token_type='refresh')
+                if refresh_claims['user_id'] == g.user['user_id'] and refresh_claims.get('jti'):
+                    refresh_store.revoke_family(refresh_claims['jti'])
+            except jwt.InvalidTokenError:
+                pass
+        
+        audit_event('logout', g.user['user_id'])
         response_data = {
             'success': True,
             'message': 'Logout successful'
@@ -387,119 +1155,609 @@ def logout():
             'message': 'Logout failed'
         }), 500
 
-# Wallet endpoints (mock implementations for now)
+# Wallet endpoints
+def valuation_table():
+    """Rate table for a portfolio total, or None to omit the total.
+
+    A request that names a ``base`` gets a 503 (RatesUnavailable) rather
+    than a silently missing total when rates are absent or older than
+    FX_MAX_AGE.
+    """
+    if request.args.get('base'):
+        return fx_rates.require()
+    try:
+        return fx_rates.require()
+    except RatesUnavailable:
+        return None
+
+def load_balances(user_id):
+    """Read a user's wallet balances (minor units) from the database"""
+    with user_pool(user_id).connection() as conn:
+        rows = conn.execute(
+            'SELECT currency, balance_minor FROM wallets WHERE user_id = ? ORDER BY id',
+            (user_id,)
+        ).fetchall()
+    return {currency: money.from_db(balance) for currency, balance in rows}
+
 @app.route('/api/wallet/balances', methods=['GET'])
+@token_required
 def get_wallet_balances():
-    """Get wallet balances"""
-    return jsonify({
-        'success': True,
-        'balances': {
-            'USD': 1250.00,
-            'EUR': 890.50,
-            'BTC': 0.05432,
-            'ETH': 2.1234
+    """Get wallet balances
+
+    Includes the portfolio total in ``base`` (default FX_BASE_CURRENCY)
+    while FX rates are loaded and fresh.
+    """
+    try:
+        units = balance_cache.get(g.user['user_id'], load_balances)
+        response = {
+            'success': True,
+            'balances': {currency: money.to_number(value, currency) for currency, value in units.items()}
         }
-    }), 200
+        table = valuation_table()
+        if table is not None:
+            response['total'] = table.valuation(
+                units, request.args.get('base', app.config['FX_BASE_CURRENCY']).upper()
+            )
+        return jsonify(response), 200
+        
+    except (FXError, LedgerError) as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), e.status_code
+    except Exception as e:
+        logger.error(f"Wallet balances error: {e}")
+        return jsonify({
+            'success': False,
+            'message': 'Failed to load wallet balances'
+        }), 500
 
 @app.route('/api/wallet/history', methods=['GET'])
+@token_required
 def get_wallet_history():
-    """Get wallet transaction history"""
-    return jsonify({
-        'success': True,
-        'transactions': [
-            {
-                'id': '1',
-                'type': 'receive',
-                'amount': 500.00,
-                'currency': 'USD',
-                'from': 'john@example.com',
-                'date': '2024-01-15T10:30:00Z'
-            },
-            {
-                'id': '2',
-                'type': 'send',
-                'amount': 250.00,
-                'currency': 'EUR',
-                'to': 'sarah@example.com',
-                'date': '2024-01-14T15:45:00Z'
+    """Get wallet transaction history (cursor paginated)"""
+    try:
+        filters = history.parse_filters(request.args)
+        with user_pool(g.user['user_id']).connection() as conn:
+            entries, next_cursor = history.fetch_entries(conn, g.user['user_id'], filters, resolve_emails)
+        
+        transactions = []
+        for entry in entries:
+            item = {
+                'id': entry['transaction_id'],
+                'type': entry['type'],
+                'amount': entry['amount'],
+                'currency': entry['currency'],
+                'balance_after': entry['balance_after'],
+                'date': entry['date']
             }
-        ]
-    }), 200
+            item['to' if entry['type'] == 'send' else 'from'] = entry['counterparty']
+            transactions.append(item)
+        
+        return jsonify({
+            'success': True,
+            'transactions': transactions,
+            'next_cursor': next_cursor,
+            'has_more': next_cursor is not None
+        }), 200
+        
+    except InvalidQuery as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    except LedgerError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), e.status_code
+    except Exception as e:
+        logger.error(f"Wallet history error: {e}")
+        return jsonify({
+            'success': False,
+            'message': 'Failed to load wallet history'
+        }), 500
+
+@app.route('/api/wallet/stream', methods=['GET'])
+@token_required(query_param='access_token')
+def wallet_stream():
+    """Server-Sent Events of new transactions and balances for the current user
+
+    Send ``Last-Event-ID`` (EventSource does on reconnect) to replay the
+    transactions missed since that event. Refused with 503 under a sync
+    gunicorn worker, where one open stream would block the whole process.
+    """
+    if blocking_worker():
+        return jsonify({
+            'success': False,
+            'message': 'Streaming is not available on this server; poll /api/wallet/balances instead'
+        }), 503
+    user_id = g.user['user_id']
+    jti = auth.token_id(g.user, g.token)
+    expires_at = g.user.get('exp')
+    try:
+        subscription = stream_hub.subscribe(user_id)
+    except StreamUnavailable as e:
+        response = jsonify({
+            'success': False,
+            'message': str(e)
+        })
+        response.headers['Retry-After'] = '5'
+        return response, e.status_code
+    
+    def load_entries(after_id, limit):
+        with user_pool(user_id).connection() as conn:
+            return history.fetch_entries_after(conn, user_id, after_id, limit, resolve_emails)
+    
+    def latest_id():
+        with user_pool(user_id).connection() as conn:
+            return history.latest_entry_id(conn, user_id)
+    
+    def load_stream_balances():
+        return {
+            currency: money.to_number(value, currency)
+            for currency, value in load_balances(user_id).items()
+        }
+    
+    def authorized():
+        # Logout revokes the token; the stream must not outlive it
+        if expires_at is not None and time.time() >= expires_at:
+            return False
+        return not token_verifier.revocations.is_revoked(jti)
+    
+    events = stream.event_stream(
+        stream_hub, subscription,
+        stream.parse_event_id(request.headers.get('Last-Event-ID') or request.args.get('last_event_id')),
+        load_entries, load_stream_balances, latest_id,
+        heartbeat=app.config['STREAM_HEARTBEAT'],
+        max_duration=app.config['STREAM_MAX_DURATION'],
+        authorized=authorized
+    )
+    response = Response(stream_with_context(events), mimetype='text/event-stream')
+    # Covers clients that disconnect before the generator first runs
+    response.call_on_close(lambda: stream_hub.unsubscribe(subscription))
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 # Transaction endpoints
 @app.route('/api/transactions/send', methods=['POST'])
+@token_required
+@idempotent
 def send_transaction():
     """Send money transaction"""
-    data = request.get_json()
-    return jsonify({
-        'success': True,
-        'message': 'Transaction sent successfully',
-        'transaction_id': 'tx_' + str(datetime.utcnow().timestamp()),
-        'amount': data.get('amount', 0),
-        'currency': data.get('currency', 'USD'),
-        'recipient': data.get('recipient', '')
-    }), 200
+    try:
+        data = request.get_json()
+        
+        # Validate input
+        if not data or not data.get('recipient') or data.get('amount') is None:
+            return jsonify({
+                'success': False,
+                'message': 'Recipient and amount are required'
+            }), 400
+        
+        recipient = str(data['recipient']).lower().strip()
+        currency = str(data.get('currency', 'USD')).upper()
+        amount = ledger.parse_amount(data['amount'], currency)
+        
+        # Resolve recipient by email
+        recipient_id = find_user_ids([recipient]).get(recipient)
+        
+        if recipient_id is None:
+            return jsonify({
+                'success': False,
+                'message': 'Recipient not found'
+            }), 404
+        
+        # Debit and credit atomically (batched with concurrent transfers)
+        result = transfers.transfer(
+            g.user['user_id'], recipient_id, currency, amount, description=data.get('description'),
+            on_apply=apply_hooks(), on_applied=payment_audit('transfer', transfer_audits), on_abort=abort_hook()
+        )
+        
+        audit_payment('transfer', transfer_audits, [result])
+        notify(result['recipient_id'], 'payment_received', reference=result['reference'],
+               amount=result['amount'], currency=currency)
+        logger.info(f"Transaction {result['reference']} committed")
+        return jsonify({
+            'success': True,
+            'message': 'Transaction sent successfully',
+            'transaction_id': result['reference'],
+            'amount': result['amount'],
+            'currency': currency,
+            'recipient': recipient,
+            'status': result['status'],
+            'balance': result['sender_balance'],
+            'created_at': result['created_at']
+        }), 200
+        
+    except LedgerError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), e.status_code
+    except Exception as e:
+        logger.error(f"Transaction error: {e}")
+        return jsonify({
+            'success': False,
+            'message': 'Transaction failed. Please try again.'
+        }), 500
+
+@app.route('/api/transactions/batch', methods=['POST'])
+@token_required
+@idempotent
+def send_batch():
+    """Send many transfers in one transaction
+
+    Every item is validated before anything is written. In ``atomic`` mode
+    (the default) one bad item rejects the whole batch; in ``best_effort``
+    mode the valid items are applied and failures are reported per item.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        items = data.get('transfers')
+        mode = data.get('mode', 'atomic')
+        if mode not in BATCH_MODES:
+            return jsonify({
+                'success': False,
+                'message': f"mode must be one of: {', '.join(BATCH_MODES)}"
+            }), 400
+        if not isinstance(items, list) or not items:
+            return jsonify({
+                'success': False,
+                'message': 'transfers must be a non-empty list'
+            }), 400
+        if len(items) > app.config['BATCH_MAX_TRANSFERS']:
+            return jsonify({
+                'success': False,
+                'message': f"A batch may contain at most {app.config['BATCH_MAX_TRANSFERS']} transfers"
+            }), 400
+
+        # Validate every item and resolve recipients with one query
+        parsed = []
+        for item in items:
+            try:
+                if not isinstance(item, dict) or not item.get('recipient') or item.get('amount') is None:
+                    raise ledger.InvalidTransfer('Recipient and amount are required')
+                currency = str(item.get('currency', 'USD')).upper()
+                parsed.append((
+                    str(item['recipient']).lower().strip(), currency,
+                    ledger.parse_amount(item['amount'], currency), item.get('description')
+                ))
+            except LedgerError as e:
+                parsed.append(e)
+        recipients = find_user_ids(item[0] for item in parsed if not isinstance(item, LedgerError))
+
+        outcomes = [None] * len(parsed)
+        batch = []
+        positions = []
+        for index, item in enumerate(parsed):
+            if isinstance(item, LedgerError):
+                outcomes[index] = item
+            elif item[0] not in recipients:
+                outcomes[index] = ledger.WalletNotFound('Recipient not found')
+            else:
+                batch.append((recipients[item[0]], item[1], item[2], item[3]))
+                positions.append(index)
+
+        atomic = mode == 'atomic'
+        batch_audits = lambda applied: [{'mode': mode, 'transfers': len(items), 'applied': len(applied)}]
+        if batch and not (atomic and len(batch) < len(parsed)):
+            applied_outcomes = transfers.transfer_batch(
+                g.user['user_id'], batch, atomic=atomic, on_apply=apply_hooks(),
+                on_applied=payment_audit('batch_payout', batch_audits), on_abort=abort_hook()
+            )
+            for index, outcome in zip(positions, applied_outcomes):
+                outcomes[index] = outcome
+
+        results = []
+        balances = {}
+        for index, outcome in enumerate(outcomes):
+            if isinstance(outcome, dict):
+                balances[outcome['currency']] = outcome['sender_balance']
+                results.append({
+                    'index': index,
+                    'success': True,
+                    'transaction_id': outcome['reference'],
+                    'recipient': parsed[index][0],
+                    'amount': outcome['amount'],
+                    'currency': outcome['currency'],
+                    'status': outcome['status']
+                })
+            else:
+                results.append({
+                    'index': index,
+                    'success': False,
+                    'message': str(outcome) if outcome else 'Not applied because another transfer in the batch failed'
+                })
+
+        errors = [outcome for outcome in outcomes if isinstance(outcome, LedgerError)]
+        committed = [outcome for outcome in outcomes if isinstance(outcome, dict)]
+        applied = len(committed)
+        if committed:
+            audit_payment('batch_payout', batch_audits, committed)
+        else:
+            audit_event('batch_payout', g.user['user_id'], mode=mode, transfers=len(items), applied=0)
+        for outcome in committed:
+            notify(outcome['recipient_id'], 'payment_received', reference=outcome['reference'],
+                   amount=outcome['amount'], currency=outcome['currency'])
+        logger.info(f"Batch of {len(items)} transfers: {applied} applied")
+        return jsonify({
+            'success': not errors,
+            'message': 'Batch applied' if not errors else (
+                'Batch rejected; no transfers were applied' if atomic else 'Batch partially applied'
+            ),
+            'mode': mode,
+            'applied': applied,
+            'failed': len(results) - applied,
+            'results': results,
+            'balances': balances
+        }), (errors[0].status_code if atomic and errors else 200)
+
+    except LedgerError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), e.status_code
+    except Exception as e:
+        logger.error(f"Batch transaction error: {e}")
+        return jsonify({
+            'success': False,
+            'message': 'Batch failed. Please try again.'
+        }), 500
 
 @app.route('/api/transactions/history', methods=['GET'])
+@token_required
 def get_transaction_history():
-    """Get transaction history"""
-    return jsonify({
-        'success': True,
-        'transactions': [
-            {
-                'id': 'tx_1',
-                'type': 'send',
-                'amount': 100.00,
-                'currency': 'USD',
-                'recipient': 'alice@example.com',
-                'status': 'completed',
-                'date': '2024-01-15T12:00:00Z'
-            },
-            {
-                'id': 'tx_2',
-                'type': 'receive',
-                'amount': 75.50,
-                'currency': 'EUR',
-                'sender': 'bob@example.com',
-                'status': 'completed',
-                'date': '2024-01-14T18:30:00Z'
+    """Get transaction history (cursor paginated)"""
+    try:
+        filters = history.parse_filters(request.args)
+        with user_pool(g.user['user_id']).connection() as conn:
+            entries, next_cursor = history.fetch_entries(conn, g.user['user_id'], filters, resolve_emails)
+        
+        transactions = []
+        for entry in entries:
+            item = {
+                'id': entry['transaction_id'],
+                'type': entry['type'],
+                'amount': entry['amount'],
+                'currency': entry['currency'],
+                'status': entry['status'],
+                'description': entry['description'],
+                'date': entry['date']
             }
-        ]
-    }), 200
+            item['recipient' if entry['type'] == 'send' else 'sender'] = entry['counterparty']
+            transactions.append(item)
+        
+        return jsonify({
+            'success': True,
+            'transactions': transactions,
+            'next_cursor': next_cursor,
+            'has_more': next_cursor is not None
+        }), 200
+        
+    except InvalidQuery as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    except LedgerError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), e.status_code
+    except Exception as e:
+        logger.error(f"Transaction history error: {e}")
+        return jsonify({
+            'success': False,
+            'message': 'Failed to load transaction history'
+        }), 500
 
 # QR Code endpoints
 @app.route('/api/qr/generate', methods=['POST'])
+@token_required
 def generate_qr():
-    """Generate QR code for payment"""
-    data = request.get_json()
-    return jsonify({
-        'success': True,
-        'qr_code': 'data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg==',
-        'qr_data': {
-            'amount': data.get('amount', 0),
-            'currency': data.get('currency', 'USD'),
-            'recipient': data.get('recipient', ''),
-            'expires_at': '2024-01-16T12:00:00Z'
-        }
-    }), 200
+    """Generate QR code for payment
+
+    Reusable codes have their expiry rounded up to the hour, so regenerating
+    the same code yields the same payload, a cached image and a stable
+    ETag (send it back as If-None-Match to get a 304).
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        
+        currency = str(data.get('currency', 'USD')).upper()
+        recipient = str(data.get('recipient') or g.user['email']).lower().strip()
+        amount = ledger.parse_amount(data['amount'], currency) if data.get('amount') not in (None, '') else None
+        one_time = bool(data.get('one_time', False))
+        memo = str(data['description'])[:64] if data.get('description') else None
+        fmt = str(data.get('format', 'png')).lower()
+        if fmt not in qr.IMAGE_FORMATS:
+            raise QRError(f"format must be one of: {', '.join(qr.IMAGE_FORMATS)}")
+        try:
+            scale = min(max(int(data.get('scale', 8)), 1), 20)
+            ttl = min(max(int(data.get('expires_in', app.config['QR_DEFAULT_TTL'])), 60), app.config['QR_MAX_TTL'])
+        except (TypeError, ValueError):
+            raise QRError('scale and expires_in must be integers')
+        
+        expires_at = int(time.time()) + ttl
+        if not one_time:
+            expires_at = math.ceil(expires_at / 3600) * 3600
+        
+        payload = qr.encode_payload(
+            qr_key, recipient, currency, expires_at,
+            amount=money.to_string(amount, currency) if amount is not None else None,
+            memo=memo, one_time=one_time
+        )
+        etag, image, cache_hit = qr_cache.get_or_render(payload, fmt, scale)
+        
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+        
+        response = jsonify({
+            'success': True,
+            'qr_code': f'data:{qr.IMAGE_FORMATS[fmt]};base64,' + base64.b64encode(image).decode(),
+            'payload': payload,
+            'qr_data': {
+                'amount': money.to_number(amount, currency) if amount is not None else None,
+                'currency': currency,
+                'recipient': recipient,
+                'description': memo,
+                'one_time': one_time,
+                'expires_at': datetime.utcfromtimestamp(expires_at).isoformat() + 'Z'
+            }
+        })
+        response.set_etag(etag)
+        response.headers['X-Cache'] = 'HIT' if cache_hit else 'MISS'
+        return response, 200
+        
+    except (LedgerError, QRError) as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    except Exception as e:
+        logger.error(f"QR generation error: {e}")
+        return jsonify({
+            'success': False,
+            'message': 'QR generation failed'
+        }), 500
 
 @app.route('/api/qr/scan', methods=['POST'])
+@token_required
+@idempotent
 def scan_qr():
-    """Process scanned QR code"""
-    data = request.get_json()
-    return jsonify({
-        'success': True,
-        'message': 'QR code processed successfully',
-        'payment_data': {
-            'amount': 50.00,
-            'currency': 'USD',
-            'recipient': 'merchant@example.com',
-            'description': 'Coffee purchase'
+    """Process scanned QR code
+
+    Verifies the signed payload and returns the payment details. With
+    ``confirm: true`` the scanner pays the recipient; one-time codes are
+    consumed in the same transaction as the payment.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        payload = data.get('qr_data') or data.get('payload')
+        if not payload or not isinstance(payload, str):
+            return jsonify({
+                'success': False,
+                'message': 'QR code data is required'
+            }), 400
+        
+        fields = qr.decode_payload(qr_key, payload)
+        nonce = fields.get('n')
+        if nonce and qr_nonces.is_used(nonce, fields['e']):
+            raise qr.QRReplayed('QR code has already been used')
+        
+        # Open codes (no amount) take the amount from the payer
+        currency = fields['c']
+        amount = ledger.parse_amount(fields['a'], currency) if 'a' in fields else None
+        if amount is None and data.get('amount') not in (None, ''):
+            amount = ledger.parse_amount(data['amount'], currency)
+        
+        payment_data = {
+            'amount': money.to_number(amount, currency) if amount is not None else None,
+            'currency': currency,
+            'recipient': fields['r'],
+            'description': fields.get('m'),
+            'one_time': nonce is not None,
+            'expires_at': datetime.utcfromtimestamp(fields['e']).isoformat() + 'Z'
         }
-    }), 200
+        
+        if not data.get('confirm'):
+            return jsonify({
+                'success': True,
+                'message': 'QR code processed successfully',
+                'payment_data': payment_data
+            }), 200
+        
+        if amount is None:
+            return jsonify({
+                'success': False,
+                'message': 'Amount is required for this QR code'
+            }), 400
+        
+        recipient_id = find_user_ids([fields['r']]).get(fields['r'])
+        if recipient_id is None:
+            return jsonify({
+                'success': False,
+                'message': 'Recipient not found'
+            }), 404
+        
+        if shard_set is None:
+            consume_nonce = (lambda conn: qr_nonces.consume(conn, nonce, fields['e'])) if nonce else None
+            result = transfers.transfer(
+                g.user['user_id'], recipient_id, currency, amount, description=fields.get('m'),
+                on_apply=apply_hooks(consume_nonce), on_applied=payment_audit('qr_payment', transfer_audits)
+            )
+        else:
+            # The payment commits on a shard, so the nonce is claimed first
+            # and given back only if the payment was definitely rejected
+            if nonce:
+                qr_nonces.claim(nonce, fields['e'])
+            try:
+                result = transfers.transfer(
+                    g.user['user_id'], recipient_id, currency, amount,
+                    description=fields.get('m'), on_apply=apply_hooks(), on_abort=abort_hook()
+                )
+            except LedgerError as e:
+                if nonce and (isinstance(e, ShardMoving) or not isinstance(e, ledger.LedgerUnavailable)):
+                    qr_nonces.release(nonce)
+                raise
+        if nonce:
+            qr_nonces.remember(nonce, fields['e'])
+        
+        audit_payment('qr_payment', transfer_audits, [result])
+        notify(result['recipient_id'], 'payment_received', reference=result['reference'],
+               amount=result['amount'], currency=currency)
+        logger.info(f"QR payment {result['reference']} committed")
+        return jsonify({
+            'success': True,
+            'message': 'Payment sent successfully',
+            'transaction_id': result['reference'],
+            'payment_data': payment_data,
+            'balance': result['sender_balance']
+        }), 200
+        
+    except (QRError, LedgerError) as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), e.status_code
+    except Exception as e:
+        logger.error(f"QR scan error: {e}")
+        return jsonify({
+            'success': False,
+            'message': 'QR code processing failed'
+        }), 500
 
 # Admin endpoints (basic implementations)
+def promote_admin(conn, email):
+    """Give an existing user the admin role; False if they already have it"""
+    cursor = conn.execute(
+        "UPDATE users SET role = 'admin', updated_at = ? WHERE email = ? AND role != 'admin'",
+        (datetime.utcnow().isoformat(), email)
+    )
+    return cursor.rowcount > 0
+
+def create_sharded_admin(email, password_hash, created_at):
+    """(user_id, None) for a new admin on their shard, or (None, promoted) for an existing user"""
+    located = shard_set.locate(email)
+    if located is None:
+        try:
+            return shard_set.create_user(
+                email, lambda conn, user_id: create_user(conn, email, password_hash, 'admin', created_at, user_id)
+            ), None
+        except sqlite3.IntegrityError:
+            # Registered concurrently; promote them instead
+            located = shard_set.locate(email)
+            if located is None:
+                raise
+    with shard_set.shards[located[1]].transaction() as conn:
+        return None, promote_admin(conn, email)
+
 @app.route('/api/admin/create-admin', methods=['POST'])
+@rate_limited('admin_ip', 'admin_email')
 def create_admin_user():
     """Create admin user - for initial setup only"""
     try:
@@ -515,45 +1773,44 @@ def create_admin_user():
         email = data['email'].lower().strip()
         password = data['password']
         
-        # Check if user already exists
-        conn = sqlite3.connect(app.config['DATABASE_URL'])
-        cursor = conn.cursor()
+        # Hash before taking the write lock
+        password_hash = hasher.hash(password)
         
-        cursor.execute('SELECT id, role FROM users WHERE email = ?', (email,))
-        existing_user = cursor.fetchone()
+        # Insert, or promote the existing user, in a single transaction
+        created_at = datetime.utcnow().isoformat()
+        if shard_set is not None:
+            user_id, promoted = create_sharded_admin(email, password_hash, created_at)
+        else:
+            with db.transaction() as conn:
+                try:
+                    user_id = create_user(conn, email, password_hash, 'admin', created_at)
+                except sqlite3.IntegrityError:
+                    user_id = None
+                
+                if user_id is None:
+                    promoted = promote_admin(conn, email)
+                    if promoted:
+                        audit_event('admin_promoted', email=email, conn=conn)
+                else:
+                    audit_event('admin_created', user_id, conn=conn, email=email)
         
-        if existing_user:
-            user_id, current_role = existing_user
-            if current_role == 'admin':
-                conn.close()
+        if user_id is None:
+            if not promoted:
                 return jsonify({
                     'success': True,
                     'message': 'User is already an admin'
                 }), 200
-            else:
-                # Update existing user to admin
-                cursor.execute('UPDATE users SET role = ? WHERE email = ?', ('admin', email))
-                conn.commit()
-                conn.close()
-                return jsonify({
-                    'success': True,
-                    'message': 'User role updated to admin successfully'
-                }), 200
-        
-        # Create new admin user
-        password_hash = generate_password_hash(password)
-        cursor.execute('''
-            INSERT INTO users (email, password_hash, role, created_at)
-            VALUES (?, ?, ?, ?)
-        ''', (email, password_hash, 'admin', datetime.utcnow().isoformat()))
-        
-        user_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        
-        # Create default wallets
-        create_default_wallets(user_id)
+            if shard_set is not None:
+                audit_event('admin_promoted', email=email, durable=True)
+            return jsonify({
+                'success': True,
+                'message': 'User role updated to admin successfully'
+            }), 200
         
+        if event_log is not None:
+            event_log.signup(user_id, created_at)
+        if shard_set is not None:
+            audit_event('admin_created', user_id, email=email, durable=True)
         logger.info(f"Admin user created successfully: {email}")
         return jsonify({
             'success': True,
@@ -565,6 +1822,14 @@ def create_admin_user():
             }
         }), 201
         
+    except HashingUnavailable as e:
+        logger.warning(f"Admin creation deferred: {e}")
+        return hashing_unavailable_response()
+    except ShardMoving as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), e.status_code
     except Exception as e:
         logger.error(f"Admin creation error: {e}")
         return jsonify({
@@ -572,53 +1837,336 @@ def create_admin_user():
             'message': 'Admin creation failed. Please try again.'
         }), 500
 
+def export_response(sql, params, columns, to_record, fmt, name):
+    """Chunked streaming response for an admin export"""
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    response = Response(
+        stream_with_context(export.stream_export(shard_set or db, sql, params, columns, to_record, fmt)),
+        mimetype=mimetype
+    )
+    extension = 'csv' if fmt == 'csv' else 'ndjson'
+    response.headers['Content-Disposition'] = f'attachment; filename={name}.{extension}'
+    return response
+
 @app.route('/api/admin/users', methods=['GET'])
+@admin_required
 def get_admin_users():
-    """Get users for admin dashboard"""
+    """Get users for admin dashboard (paginated, or streamed with ?format=ndjson|csv)
+
+    Filter with ``q`` (email fragment), ``role`` and ``from``/``to``.
+    """
+    try:
+        fmt = export.parse_format(request.args)
+        if fmt != 'json':
+            sql, params, filters = export.users_query(request.args, paginate=False, search_index=shard_set is None)
+            return export_response(sql, params, export.USER_COLUMNS, export.user_row, fmt, 'users')
+        
+        with admin_connection() as conn:
+            sql, params, filters = export.users_query(request.args, conn=conn, search_index=shard_set is None)
+            users, next_cursor = export.fetch_page(conn, sql, params, filters, export.user_row)
+            total, estimated = export.count_users(conn, filters, analytics.read_totals(conn)['users'])
+        
+        return jsonify({
+            'success': True,
+            'users': users,
+            'total': total,
+            'total_is_estimate': estimated,
+            'next_cursor': next_cursor,
+            'has_more': next_cursor is not None
+        }), 200
+        
+    except InvalidQuery as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    except Exception as e:
+        logger.error(f"Admin users error: {e}")
+        return jsonify({
+            'success': False,
+            'message': 'Failed to load users'
+        }), 500
+
+@app.route('/api/admin/transactions', methods=['GET'])
+@admin_required
+def get_admin_transactions():
+    """Get transactions for admin dashboard (paginated, or streamed with ?format=ndjson|csv)"""
+    try:
+        fmt = export.parse_format(request.args)
+        sql, params, filters = export.transactions_query(request.args, paginate=fmt == 'json')
+        if fmt != 'json':
+            return export_response(sql, params, export.TRANSACTION_COLUMNS, export.transaction_row, fmt, 'transactions')
+        
+        with admin_connection() as conn:
+            transactions, next_cursor = export.fetch_page(conn, sql, params, filters, export.transaction_row)
+            total = sum(analytics.read_totals(conn)['transactions'].values())
+        
+        return jsonify({
+            'success': True,
+            'transactions': transactions,
+            'total': total,
+            'next_cursor': next_cursor,
+            'has_more': next_cursor is not None
+        }), 200
+        
+    except InvalidQuery as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    except Exception as e:
+        logger.error(f"Admin transactions error: {e}")
+        return jsonify({
+            'success': False,
+            'message': 'Failed to load transactions'
+        }), 500
+
+@app.route('/api/admin/analytics', methods=['GET'])
+@admin_required
+def get_admin_analytics():
+    """Get analytics for admin dashboard
+
+    Served entirely from rollup tables and activity sketches, so the cost
+    does not grow with the number of users or transactions. Pass
+    ``granularity`` (minute/hour/day) with optional ``from``/``to`` and
+    ``currency`` for a time-bucketed breakdown. Once FX rates are loaded
+    ``total_volume`` is valued in ``base``; ``holdings=true`` adds the
+    value of every wallet (one aggregate scan of the wallets table).
+    """
+    try:
+        today = datetime.utcnow().strftime('%Y-%m-%d')
+        with admin_connection() as conn:
+            totals = analytics.read_totals(conn)
+            holdings = analytics.read_holdings(conn) if request.args.get('holdings') == 'true' else None
+            
+            breakdown = None
+            granularity = request.args.get('granularity')
+            if granularity:
+                try:
+                    end = datetime.fromisoformat(request.args['to']) if request.args.get('to') else datetime.utcnow()
+                    start = datetime.fromisoformat(request.args['from']) if request.args.get('from') else end - timedelta(days=1)
+                    breakdown = analytics.read_buckets(
+                        conn, granularity, start, end,
+                        currency=request.args.get('currency', '').upper() or None
+                    )
+                except ValueError as e:
+                    return jsonify({
+                        'success': False,
+                        'message': str(e)
+                    }), 400
+        
+        response_analytics = {
+            'total_users': totals['users'],
+            'total_transactions': sum(totals['transactions'].values()),
+            'total_volume': totals['volume'].get('USD', 0),
+            'active_users_today': activity.count(today),
+            'transactions_by_currency': totals['transactions'],
+            'volume_by_currency': totals['volume']
+        }
+        table = valuation_table()
+        if table is not None:
+            base = request.args.get('base', app.config['FX_BASE_CURRENCY']).upper()
+            volume = table.valuation(totals['volume_minor'], base)
+            response_analytics['total_volume'] = volume['value']
+            response_analytics['total_volume_currency'] = base
+            response_analytics['fx_version'] = table.version
+        if holdings is not None:
+            response_analytics['holdings_by_currency'] = {
+                currency: money.to_number(units, currency) for currency, units in holdings.items()
+            }
+            if table is not None:
+                response_analytics['holdings_total'] = table.valuation(holdings, base)
+        if breakdown is not None:
+            response_analytics['breakdown'] = breakdown
+        
+        return jsonify({
+            'success': True,
+            'analytics': response_analytics
+        }), 200
+        
+    except FXError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), e.status_code
+    except Exception as e:
+        logger.error(f"Analytics error: {e}")
+        return jsonify({
+            'success': False,
+            'message': 'Failed to load analytics'
+        }), 500
+
+@app.route('/api/admin/fx/rates', methods=['GET'])
+@admin_required
+def get_fx_rates():
+    """Get the current FX rate table"""
+    table = fx_rates.current()
+    if table is None:
+        return jsonify({
+            'success': False,
+            'message': 'FX rates have not been loaded'
+        }), 404
     return jsonify({
         'success': True,
-        'users': [
-            {
-                'id': '1',
-                'email': 'successtest@nomadpay.io',
-                'role': 'user',
-                'status': 'active',
-                'created_at': '2024-01-15T10:00:00Z'
-            }
-        ],
-        'total': 1
+        'fx_rates': table.to_dict()
     }), 200
 
-@app.route('/api/admin/transactions', methods=['GET'])
-def get_admin_transactions():
-    """Get transactions for admin dashboard"""
+@app.route('/api/admin/fx/rates', methods=['POST'])
+@admin_required
+def update_fx_rates():
+    """Publish a new FX rate table
+
+    Body: ``{"base": "USD", "rates": {"EUR": "1.08", "BTC": "65000"}}``
+    giving the price of one unit of each currency in ``base``. With no
+    body the FX_RATES_FILE is reloaded instead. Other workers pick up the
+    new version within FX_REFRESH_INTERVAL seconds.
+    """
+    try:
+        data = request.get_json(silent=True)
+        if data:
+            table = fx_rates.publish(data, source=f"admin:{g.user['email']}")
+        elif app.config['FX_RATES_FILE']:
+            table = fx_rates.load_file(app.config['FX_RATES_FILE'])
+        else:
+            return jsonify({
+                'success': False,
+                'message': 'rates are required'
+            }), 400
+        
+        audit_event('fx_rates_published', g.user['user_id'], durable=True, version=table.version)
+        logger.info(f"FX rates version {table.version} published")
+        return jsonify({
+            'success': True,
+            'fx_rates': table.to_dict()
+        }), 200
+        
+    except FXError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), e.status_code
+    except Exception as e:
+        logger.error(f"FX rates update error: {e}")
+        return jsonify({
+            'success': False,
+            'message': 'Failed to update FX rates'
+        }), 500
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus text exposition for every worker"""
+    if not app.config['METRICS_ENABLED']:
+        return jsonify({
+            'success': False,
+            'message': 'Metrics are disabled'
+        }), 404
+    token = app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization', '') != f'Bearer {token}':
+        return jsonify({
+            'success': False,
+            'message': 'Metrics token required'
+        }), 401
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/admin/profiles', methods=['GET'])
+@admin_required
+def list_profiles():
+    """List stored request profiles, newest first"""
     return jsonify({
         'success': True,
-        'transactions': [
-            {
-                'id': 'tx_1',
-                'user_email': 'successtest@nomadpay.io',
-                'type': 'send',
-                'amount': 100.00,
-                'currency': 'USD',
-                'status': 'completed',
-                'created_at': '2024-01-15T12:00:00Z'
-            }
-        ],
-        'total': 1
+        'profiles': profiler.list(),
+        'profiling': profiler.stats()
     }), 200
 
-@app.route('/api/admin/analytics', methods=['GET'])
-def get_admin_analytics():
-    """Get analytics for admin dashboard"""
+@app.route('/api/admin/profiles/<capture_id>', methods=['GET'])
+@admin_required
+def get_profile(capture_id):
+    """Get one profile with its SQL statements and top functions"""
+    capture = profiler.get(capture_id)
+    if capture is None:
+        return jsonify({
+            'success': False,
+            'message': 'Profile not found'
+        }), 404
     return jsonify({
         'success': True,
-        'analytics': {
-            'total_users': 1,
-            'total_transactions': 1,
-            'total_volume': 100.00,
-            'active_users_today': 1
-        }
+        'profile': capture
+    }), 200
+
+@app.route('/api/admin/profiles/<capture_id>/pstats', methods=['GET'])
+@admin_required
+def download_profile(capture_id):
+    """Download a profile in pstats format"""
+    path = profiler.pstats_path(capture_id)
+    if path is None:
+        return jsonify({
+            'success': False,
+            'message': 'Profile not found'
+        }), 404
+    with open(path, 'rb') as f:
+        data = f.read()
+    return Response(data, mimetype='application/octet-stream', headers={
+        'Content-Disposition': f'attachment; filename=nomadpay-{capture_id}.prof'
+    })
+
+@app.route('/api/admin/jobs', methods=['GET'])
+@admin_required
+def get_jobs():
+    """Job queue depth per lane, this worker's counters and recent dead jobs"""
+    return jsonify({
+        'success': True,
+        'worker_pid': os.getpid(),
+        'depth': job_queue.depth(),
+        'jobs': job_queue.stats(),
+        'dead': job_queue.dead_jobs()
+    }), 200
+
+@app.route('/api/admin/jobs/<int:job_id>/retry', methods=['POST'])
+@admin_required
+def retry_job(job_id):
+    """Requeue a dead job"""
+    try:
+        job_queue.retry_dead(job_id)
+    except JobError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 404
+    return jsonify({
+        'success': True,
+        'message': f'Job {job_id} requeued'
+    }), 200
+
+def idempotency_stats():
+    """Idempotency counters summed over the per-shard stores"""
+    totals = {}
+    for store in idempotency_stores:
+        for name, value in store.stats().items():
+            totals[name] = totals.get(name, 0) + value
+    return totals
+
+@app.route('/api/admin/db/pool', methods=['GET'])
+@admin_required
+def get_db_pool_stats():
+    """Get connection pool statistics for this worker"""
+    return jsonify({
+        'success': True,
+        'worker_pid': os.getpid(),
+        'pool': db.stats(),
+        'password_hashing': hasher.stats(),
+        'balance_cache': balance_cache.stats(),
+        'token_cache': token_verifier.stats(),
+        'refresh_tokens': refresh_store.stats(),
+        'qr_cache': qr_cache.stats(),
+        'qr_nonces': qr_nonces.stats(),
+        'idempotency': idempotency_stats(),
+        'fx_rates': fx_rates.stats(),
+        'rate_limits': rate_limiter.stats(),
+        'streams': stream_hub.stats(),
+        'eventlog': event_log.stats() if event_log is not None else None,
+        'shards': shard_set.stats() if shard_set is not None else None,
+        'sharded_ledger': transfers.stats() if shard_set is not None else None,
+        'profiling': profiler.stats()
     }), 200
 
 # Error handlers
@@ -0,0 +1,38 @@
+"""
+NomadPay Backend API - Audit Log
+Security and money-movement events written in batches by the job queue
+"""
+
+import json
+
+
+def init_schema(conn):
+    """Create the audit log table"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS audit_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            event TEXT NOT NULL,
+            user_id INTEGER,
+            ip TEXT,
+            data TEXT,
+            created_at TEXT NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_audit_log_user
+        ON audit_log (user_id, id)
+    ''')
+
+
+def record(event, user_id=None, ip=None, created_at=None, **data):
+    """Audit job payload for one event"""
+    return {'event': event, 'user_id': user_id, 'ip': ip, 'created_at': created_at, 'data': data}
+
+
+def write(conn, records):
+    """Insert a batch of audit payloads"""
+    conn.executemany(
+        'INSERT INTO audit_log (event, user_id, ip, data, created_at) VALUES (?, ?, ?, ?, ?)',
+        [(r['event'], r['user_id'], r['ip'], json.dumps(r['data'], separators=(',', ':')) if r['data'] else None,
+          r['created_at']) for r in records]
+    )
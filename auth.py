@@ -0,0 +1,418 @@
+"""
+NomadPay Backend API - Token Verification
+Cached JWT claim decoding and a Bloom-filtered revocation list
+"""
+
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import jwt
+
+logger = logging.getLogger(__name__)
+
+
+def init_schema(conn):
+    """Create the revoked token table"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS revoked_tokens (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            jti TEXT UNIQUE NOT NULL,
+            expires_at REAL NOT NULL,
+            revoked_at REAL NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_revoked_tokens_expires
+        ON revoked_tokens (expires_at)
+    ''')
+
+
+def token_id(claims, token):
+    """Revocation key for a token: its jti, or a hash for legacy tokens without one"""
+    return claims.get('jti') or hashlib.sha256(token.encode()).hexdigest()
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter; memory stays constant as keys are added"""
+
+    def __init__(self, capacity, error_rate):
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        """Bit positions for key via double hashing of one digest"""
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        """Set the bits for key"""
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        """False means definitely absent; True means probably present"""
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class RevocationList:
+    """Revoked token ids backed by SQLite with an in-memory Bloom filter.
+
+    A negative Bloom lookup (the common case) answers without touching
+    the database. Positives are confirmed with a point query. Revocations
+    made by other workers are pulled in by tailing the table every
+    ``poll_interval`` seconds. A background thread sweeps expired rows in
+    batches and then rebuilds the filter, so false positives do not
+    accumulate and checks never wait on a write transaction.
+    """
+
+    def __init__(self, pool, capacity=100000, error_rate=0.001,
+                 poll_interval=1.0, sweep_interval=300.0, sweep_batch=1000):
+        self.pool = pool
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.poll_interval = poll_interval
+        self.sweep_interval = sweep_interval
+        self.sweep_batch = sweep_batch
+        self._lock = threading.Lock()
+        self._bloom = None
+        self._last_id = 0
+        self._last_poll = 0.0
+        self._sweeper_pid = None
+        self._stats = {'checks': 0, 'bloom_positives': 0, 'confirmed': 0, 'swept': 0, 'rebuilds': 0}
+
+    def revoke(self, jti, expires_at):
+        """Revoke a token id until its expiry time (unix seconds)"""
+        with self.pool.transaction() as conn:
+            conn.execute(
+                'INSERT OR IGNORE INTO revoked_tokens (jti, expires_at, revoked_at) VALUES (?, ?, ?)',
+                (jti, float(expires_at), time.time())
+            )
+        with self._lock:
+            if self._bloom is not None:
+                self._bloom.add(jti)
+
+    def is_revoked(self, jti):
+        """True if the token id has been revoked"""
+        self._ensure_sweeper()
+        self._refresh()
+        with self._lock:
+            self._stats['checks'] += 1
+            if jti not in self._bloom:
+                return False
+            self._stats['bloom_positives'] += 1
+        with self.pool.connection() as conn:
+            row = conn.execute('SELECT 1 FROM revoked_tokens WHERE jti = ?', (jti,)).fetchone()
+        if row:
+            with self._lock:
+                self._stats['confirmed'] += 1
+        return row is not None
+
+    def _refresh(self):
+        """Load the filter and pull remote revocations when due"""
+        now = time.monotonic()
+        if self._bloom is not None and now - self._last_poll < self.poll_interval:
+            return
+        with self._lock:
+            if self._bloom is not None and now - self._last_poll < self.poll_interval:
+                return
+            self._last_poll = now
+        if self._bloom is None:
+            self._rebuild()
+            return
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                'SELECT id, jti FROM revoked_tokens WHERE id > ? ORDER BY id',
+                (self._last_id,)
+            ).fetchall()
+        with self._lock:
+            for row_id, jti in rows:
+                self._bloom.add(jti)
+                self._last_id = row_id
+
+    def _rebuild(self):
+        """Rebuild the filter from the unexpired rows"""
+        bloom = BloomFilter(self.capacity, self.error_rate)
+        with self.pool.connection() as conn:
+            # Rows revoked after max_id are picked up by the next poll
+            max_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM revoked_tokens').fetchone()[0]
+            for (jti,) in conn.execute(
+                'SELECT jti FROM revoked_tokens WHERE expires_at >= ? AND id <= ?', (time.time(), max_id)
+            ):
+                bloom.add(jti)
+        with self._lock:
+            self._bloom = bloom
+            self._last_id = max_id
+            self._stats['rebuilds'] += 1
+
+    def sweep(self):
+        """Delete expired rows in batches, then rebuild the filter"""
+        removed = 0
+        now = time.time()
+        while True:
+            with self.pool.transaction() as conn:
+                cursor = conn.execute('''
+                    DELETE FROM revoked_tokens WHERE id IN (
+                        SELECT id FROM revoked_tokens WHERE expires_at < ? LIMIT ?
+                    )
+                ''', (now, self.sweep_batch))
+                deleted = cursor.rowcount
+            removed += deleted
+            if deleted < self.sweep_batch:
+                break
+            # Let request writers in between batches
+            time.sleep(0.01)
+        with self._lock:
+            self._stats['swept'] += removed
+        self._rebuild()
+        return removed
+
+    def _ensure_sweeper(self):
+        """Start the background sweeper once per worker process"""
+        if self._sweeper_pid == os.getpid():
+            return
+        with self._lock:
+            if self._sweeper_pid == os.getpid():
+                return
+            self._sweeper_pid = os.getpid()
+        threading.Thread(target=self._sweep_loop, name='revocation-sweeper', daemon=True).start()
+
+    def _sweep_loop(self):
+        """Periodically purge expired revocations and rebuild the filter"""
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception('Revoked token sweep failed')
+
+    def stats(self):
+        """Snapshot of revocation check counters"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats['bloom_bits'] = self._bloom.size if self._bloom is not None else 0
+        return stats
+
+
+class TokenVerifier:
+    """Verifies access tokens, caching decoded claims until they expire.
+
+    Claims are keyed by a SHA-256 of the raw token, so a client polling
+    with the same token skips signature verification and JSON decoding
+    after the first request. Revocation is still checked on every call.
+    """
+
+    def __init__(self, secret, revocations, max_entries=50000, algorithms=('HS256',)):
+        self.secret = secret
+        self.revocations = revocations
+        self.max_entries = max_entries
+        self.algorithms = list(algorithms)
+        self._lock = threading.Lock()
+        self._claims = OrderedDict()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'revoked': 0}
+
+    def verify(self, token, token_type='access'):
+        """Return the token's claims; raises jwt.InvalidTokenError subclasses"""
+        key = hashlib.sha256(token.encode()).digest()
+        now = time.time()
+        with self._lock:
+            entry = self._claims.get(key)
+            if entry is not None and entry[0] > now:
+                self._claims.move_to_end(key)
+                self._stats['hits'] += 1
+                claims = entry[1]
+            else:
+                if entry is not None:
+                    del self._claims[key]
+                claims = None
+                self._stats['misses'] += 1
+
+        if claims is None:
+            claims = jwt.decode(
+                token, self.secret,
+                algorithms=self.algorithms,
+                options={'require': ['exp']}
+            )
+            with self._lock:
+                self._claims[key] = (claims['exp'], claims)
+                while len(self._claims) > self.max_entries:
+                    self._claims.popitem(last=False)
+                    self._stats['evictions'] += 1
+
+        if claims.get('type') != token_type:
+            raise jwt.InvalidTokenError('Invalid token type')
+        if self.revocations.is_revoked(token_id(claims, token)):
+            with self._lock:
+                self._stats['revoked'] += 1
+            raise jwt.InvalidTokenError('Token has been revoked')
+        return claims
+
+    def revoke(self, token, claims):
+        """Revoke a verified token and drop it from the claims cache"""
+        self.revocations.revoke(token_id(claims, token), claims['exp'])
+        with self._lock:
+            self._claims.pop(hashlib.sha256(token.encode()).digest(), None)
+
+    def stats(self):
+        """Snapshot of claims cache counters"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._claims)
+        stats['revocations'] = self.revocations.stats()
+        return stats
+
+
+class RefreshTokenError(Exception):
+    """Raised when a refresh token cannot be rotated"""
+
+
+class RefreshTokenReused(RefreshTokenError):
+    """A rotated refresh token was presented again; its family is revoked"""
+
+
+def init_refresh_schema(conn):
+    """Create the refresh token rotation table"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS refresh_tokens (
+            jti TEXT PRIMARY KEY,
+            family_id TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            expires_at REAL NOT NULL,
+            used_at REAL,
+            revoked INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_refresh_tokens_family
+        ON refresh_tokens (family_id)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_refresh_tokens_expires
+        ON refresh_tokens (expires_at)
+    ''')
+
+
+class RefreshTokenStore:
+    """Single-use refresh tokens grouped into rotation families.
+
+    Every refresh consumes the presented jti with one primary-key UPDATE
+    and inserts its successor in the same transaction. Presenting an
+    already-consumed jti is treated as theft: the whole family is
+    revoked, logging out both the attacker and the legitimate client.
+    """
+
+    def __init__(self, pool, sweep_interval=600.0, sweep_batch=1000):
+        self.pool = pool
+        self.sweep_interval = sweep_interval
+        self.sweep_batch = sweep_batch
+        self._lock = threading.Lock()
+        self._sweeper_pid = None
+        self._stats = {'issued': 0, 'rotated': 0, 'reuse_detected': 0, 'rejected': 0, 'swept': 0}
+
+    def issue(self, jti, user_id, expires_at, family_id=None):
+        """Record a freshly issued refresh token starting a new family"""
+        self._ensure_sweeper()
+        with self.pool.transaction() as conn:
+            conn.execute(
+                'INSERT INTO refresh_tokens (jti, family_id, user_id, expires_at) VALUES (?, ?, ?, ?)',
+                (jti, family_id or jti, user_id, float(expires_at))
+            )
+        self._count('issued')
+
+    def rotate(self, old_jti, family_id, new_jti, user_id, expires_at):
+        """Consume old_jti and record new_jti in the same family"""
+        self._ensure_sweeper()
+        now = time.time()
+        reused = False
+        with self.pool.transaction() as conn:
+            cursor = conn.execute('''
+                UPDATE refresh_tokens SET used_at = ?
+                WHERE jti = ? AND family_id = ? AND user_id = ?
+                  AND used_at IS NULL AND revoked = 0 AND expires_at > ?
+            ''', (now, old_jti, family_id, user_id, now))
+            consumed = cursor.rowcount == 1
+            if consumed:
+                conn.execute(
+                    'INSERT INTO refresh_tokens (jti, family_id, user_id, expires_at) VALUES (?, ?, ?, ?)',
+                    (new_jti, family_id, user_id, float(expires_at))
+                )
+            else:
+                # Slow path only: find out whether this was a replay
+                existing = conn.execute(
+                    'SELECT used_at FROM refresh_tokens WHERE jti = ?', (old_jti,)
+                ).fetchone()
+                if existing is not None and existing[0] is not None:
+                    reused = True
+                    conn.execute('UPDATE refresh_tokens SET revoked = 1 WHERE family_id = ?', (family_id,))
+        if reused:
+            self._count('reuse_detected')
+            raise RefreshTokenReused('Refresh token reuse detected')
+        if not consumed:
+            self._count('rejected')
+            raise RefreshTokenError('Refresh token is not active')
+        self._count('rotated')
+
+    def revoke_family(self, jti):
+        """Revoke every token in the family of jti (used by logout)"""
+        with self.pool.transaction() as conn:
+            conn.execute('''
+                UPDATE refresh_tokens SET revoked = 1
+                WHERE family_id = (SELECT family_id FROM refresh_tokens WHERE jti = ?)
+            ''', (jti,))
+
+    def sweep(self):
+        """Delete expired rows in batches; returns the number removed"""
+        removed = 0
+        now = time.time()
+        while True:
+            with self.pool.transaction() as conn:
+                cursor = conn.execute('''
+                    DELETE FROM refresh_tokens WHERE jti IN (
+                        SELECT jti FROM refresh_tokens WHERE expires_at < ? LIMIT ?
+                    )
+                ''', (now, self.sweep_batch))
+                deleted = cursor.rowcount
+            removed += deleted
+            if deleted < self.sweep_batch:
+                break
+            # Let request writers in between batches
+            time.sleep(0.01)
+        with self._lock:
+            self._stats['swept'] += removed
+        return removed
+
+    def _ensure_sweeper(self):
+        """Start the background sweeper once per worker process"""
+        if self._sweeper_pid == os.getpid():
+            return
+        with self._lock:
+            if self._sweeper_pid == os.getpid():
+                return
+            self._sweeper_pid = os.getpid()
+        threading.Thread(target=self._sweep_loop, name='refresh-sweeper', daemon=True).start()
+
+    def _sweep_loop(self):
+        """Periodically purge expired refresh tokens"""
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception('Refresh token sweep failed')
+
+    def _count(self, key):
+        """Increment a counter"""
+        with self._lock:
+            self._stats[key] += 1
+
+    def stats(self):
+        """Snapshot of rotation counters"""
+        with self._lock:
+            return dict(self._stats)
@@ -0,0 +1,73 @@
+"""
+NomadPay Backend API - Batch Payout Benchmark
+One /api/transactions/batch call vs a loop of /api/transactions/send calls
+
+Usage:
+    python benchmarks/bench_batch.py --recipients 500 --size 100 --rounds 5
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def setup(db_path, recipients, synchronous):
+    """Create a fresh database with one funded merchant and many recipients"""
+    os.environ['DATABASE_URL'] = db_path
+    os.environ['DB_SYNCHRONOUS'] = synchronous
+    os.environ.setdefault('PASSWORD_HASH_ITERATIONS', '1000')
+    import app as nomadpay
+
+    with nomadpay.db.transaction() as conn:
+        merchant_id = nomadpay.create_user(conn, 'merchant@nomadpay.io', 'x', 'user', '2024-01-01T00:00:00')
+        for i in range(recipients):
+            nomadpay.create_user(conn, f'freelancer{i}@nomadpay.io', 'x', 'user', '2024-01-01T00:00:00')
+        conn.execute(
+            "UPDATE wallets SET balance_minor = 10000000000 WHERE user_id = ? AND currency = 'USD'",
+            (merchant_id,)
+        )
+    token = nomadpay.generate_tokens(merchant_id, 'merchant@nomadpay.io')['access_token']
+    return nomadpay, {'Authorization': f'Bearer {token}'}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Batch payout vs per-call loop')
+    parser.add_argument('--recipients', type=int, default=500)
+    parser.add_argument('--size', type=int, default=100, help='transfers per payout')
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--synchronous', default='FULL', help='SQLite synchronous pragma')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        nomadpay, headers = setup(os.path.join(tmp, 'bench.db'), args.recipients, args.synchronous)
+        client = nomadpay.app.test_client()
+        items = [
+            {'recipient': f'freelancer{i % args.recipients}@nomadpay.io', 'amount': '0.01'}
+            for i in range(args.size)
+        ]
+        total = args.size * args.rounds
+
+        started = time.perf_counter()
+        for _ in range(args.rounds):
+            for item in items:
+                response = client.post('/api/transactions/send', json=item, headers=headers)
+                assert response.status_code == 200, response.get_json()
+        loop_rate = total / (time.perf_counter() - started)
+
+        started = time.perf_counter()
+        for _ in range(args.rounds):
+            response = client.post('/api/transactions/batch', json={'transfers': items}, headers=headers)
+            assert response.status_code == 200, response.get_json()
+        batch_rate = total / (time.perf_counter() - started)
+
+        print(f'{args.rounds} payouts x {args.size} transfers, synchronous={args.synchronous}')
+        print(f'  send loop  {loop_rate:10.0f} transfers/s')
+        print(f'  batch      {batch_rate:10.0f} transfers/s  ({batch_rate / loop_rate:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
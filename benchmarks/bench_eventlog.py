@@ -0,0 +1,90 @@
+"""
+NomadPay Backend API - Event Log Benchmark
+Append and fsync throughput of the writer, and replay throughput of segment files
+
+Usage:
+    python benchmarks/bench_eventlog.py --events 2000000 --threads 8
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import eventlog  # noqa: E402
+from eventlog import EventLog  # noqa: E402
+
+CURRENCIES = ('USD', 'EUR', 'BTC', 'ETH')
+
+
+def transfers(count, users, seed, first_id=1):
+    """Synthetic committed-transfer results spread over the last day"""
+    rng = random.Random(seed)
+    start = datetime.utcnow() - timedelta(days=1)
+    for i in range(count):
+        sender = rng.randrange(1, users + 1)
+        yield {
+            'id': first_id + i,
+            'sender_id': sender,
+            'recipient_id': sender % users + 1,
+            'currency': CURRENCIES[i % len(CURRENCIES)],
+            'amount_minor': rng.randrange(1, 10 ** 6),
+            'created_at': (start + timedelta(milliseconds=i * 40)).isoformat()
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Event log append and replay throughput')
+    parser.add_argument('--events', type=int, default=1000000, help='transfer events to write')
+    parser.add_argument('--threads', type=int, default=4, help='threads appending concurrently')
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--flush-interval', type=float, default=0.05)
+    parser.add_argument('--segment-mb', type=int, default=64)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        log = EventLog(tmp, segment_bytes=args.segment_mb * 1024 * 1024, flush_interval=args.flush_interval)
+        per_thread = args.events // args.threads
+        batches = [
+            [eventlog.encode_transfer(result)
+             for result in transfers(per_thread, args.users, seed=t, first_id=t * per_thread + 1)]
+            for t in range(args.threads)
+        ]
+
+        def append(records):
+            for record in records:
+                log.append(record)
+
+        threads = [threading.Thread(target=append, args=(records,)) for records in batches]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        appended = time.perf_counter() - started
+        log.flush()
+        durable = time.perf_counter() - started
+        stats = log.stats()
+        events = per_thread * args.threads
+        print(f'append: {events} events from {args.threads} threads')
+        print(f'  in memory  {appended:6.2f}s  {events / appended * 60 / 1e6:8.1f}M events/min')
+        print(f'  on disk    {durable:6.2f}s  {events / durable * 60 / 1e6:8.1f}M events/min  '
+              f"({stats['bytes'] / 1e6:.0f} MB, {stats['flushes']} fsyncs, "
+              f"avg {stats['fsync_ms_avg']:.2f} ms, max {stats['fsync_ms_max']:.2f} ms, {stats['segments']} segments)")
+
+        started = time.perf_counter()
+        state = eventlog.replay(tmp)
+        elapsed = time.perf_counter() - started
+        print(f"replay: {state.counts['transfers']} events in {elapsed:.2f}s "
+              f'= {state.counts["transfers"] / elapsed * 60 / 1e6:.1f}M events/min '
+              f'({len(state.balances)} wallets, {len(state.buckets)} buckets)')
+
+
+if __name__ == '__main__':
+    main()
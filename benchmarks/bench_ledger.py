@@ -0,0 +1,80 @@
+"""
+NomadPay Backend API - Ledger Throughput Benchmark
+Concurrent senders with and without group commit
+
+Usage:
+    python benchmarks/bench_ledger.py --users 200 --threads 16 --transfers 200
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def setup(db_path, users, synchronous):
+    """Create a fresh database with funded users"""
+    os.environ['DATABASE_URL'] = db_path
+    os.environ['DB_SYNCHRONOUS'] = synchronous
+    import app as nomadpay
+
+    with nomadpay.db.transaction() as conn:
+        for i in range(users):
+            nomadpay.create_user(conn, f'bench{i}@nomadpay.io', 'x', 'user', '2024-01-01T00:00:00')
+        conn.execute("UPDATE wallets SET balance_minor = 100000000 WHERE currency = 'USD'")
+    return nomadpay
+
+
+def run(nomadpay, ledger, users, threads, transfers_per_thread):
+    """Run concurrent senders and return (transfers/s, failures)"""
+    with nomadpay.db.connection() as conn:
+        user_ids = [row[0] for row in conn.execute('SELECT id FROM users')]
+    failures = []
+
+    def sender(seed):
+        rng = random.Random(seed)
+        for _ in range(transfers_per_thread):
+            sender_id, recipient_id = rng.sample(user_ids, 2)
+            try:
+                ledger.transfer(sender_id, recipient_id, 'USD', 1)
+            except Exception as e:
+                failures.append(e)
+
+    workers = [threading.Thread(target=sender, args=(i,)) for i in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    return threads * transfers_per_thread / elapsed, len(failures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Ledger throughput benchmark')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--transfers', type=int, default=200, help='transfers per thread')
+    parser.add_argument('--synchronous', default='FULL', help='SQLite synchronous pragma')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        nomadpay = setup(os.path.join(tmp, 'bench.db'), args.users, args.synchronous)
+        from ledger import Ledger
+
+        print(f'{args.threads} threads x {args.transfers} transfers, synchronous={args.synchronous}')
+        for group_commit in (False, True):
+            ledger = Ledger(nomadpay.db, group_commit=group_commit)
+            rate, failed = run(nomadpay, ledger, args.users, args.threads, args.transfers)
+            stats = ledger.stats()
+            print(f'  group_commit={str(group_commit):5}  {rate:10.0f} transfers/s  '
+                  f'avg_batch={stats["avg_batch"]:6}  failed={failed}')
+
+
+if __name__ == '__main__':
+    main()
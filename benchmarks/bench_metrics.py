@@ -0,0 +1,61 @@
+"""
+NomadPay Backend API - Metrics Overhead Benchmark
+Per-request recording cost and per-statement SQL timing cost
+
+Usage:
+    python benchmarks/bench_metrics.py --iterations 100000
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metrics import Metrics, TimedConnection  # noqa: E402
+
+
+def per_call_us(fn, iterations):
+    """Average microseconds per call"""
+    started = time.perf_counter()
+    for i in range(iterations):
+        fn(i)
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Metrics recording overhead')
+    parser.add_argument('--iterations', type=int, default=100000)
+    parser.add_argument('--routes', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        metrics = Metrics(tmp)
+        routes = [f'/api/route/{i}' for i in range(args.routes)]
+
+        def request(i):
+            metrics.start_request()
+            metrics.observe_request(routes[i % len(routes)], 'GET', 200, 0.003)
+
+        request(0)
+        print('per-request recording (start_request + observe_request):')
+        print(f'  {per_call_us(request, args.iterations):8.2f} us')
+
+        for label, factory in (('plain', sqlite3.Connection), ('timed', TimedConnection)):
+            conn = sqlite3.connect(':memory:', factory=factory, isolation_level=None)
+            conn.execute('CREATE TABLE t (id INTEGER PRIMARY KEY, v INTEGER)')
+            conn.execute('INSERT INTO t (v) VALUES (1)')
+            cost = per_call_us(lambda i: conn.execute('SELECT v FROM t WHERE id = 1').fetchall(), args.iterations)
+            print(f'  {label:5} SELECT by primary key  {cost:8.2f} us/statement')
+            conn.close()
+
+        started = time.perf_counter()
+        text = metrics.render()
+        print(f'render: {(time.perf_counter() - started) * 1000:.2f} ms for {text.count(chr(10))} lines')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+NomadPay Backend API - QR Generation Micro-Benchmark
+Fresh encode + PNG/SVG render vs image cache hit
+
+Usage:
+    python benchmarks/bench_qr.py --iterations 200
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import qr  # noqa: E402
+
+
+def measure(fn, iterations):
+    """Per-call latencies in microseconds"""
+    samples = []
+    for i in range(iterations):
+        started = time.perf_counter()
+        fn(i)
+        samples.append((time.perf_counter() - started) * 1e6)
+    return samples
+
+
+def report(label, samples):
+    """Print p50/p99 for a set of samples"""
+    samples = sorted(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    print(f'  {label:28} p50={statistics.median(samples):10.1f}us  p99={p99:10.1f}us')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='QR encode vs cache-hit latency')
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    key = qr.signing_key('benchmark-secret')
+    expires_at = 1893456000
+
+    for fmt in qr.IMAGE_FORMATS:
+        cache = qr.QRImageCache()
+        print(f'{fmt}:')
+        # Distinct amounts force a miss on every call
+        misses = measure(
+            lambda i: cache.get_or_render(
+                qr.encode_payload(key, 'merchant@nomadpay.io', 'USD', expires_at, amount=f'{i}.00'), fmt
+            ),
+            args.iterations
+        )
+        static = qr.encode_payload(key, 'merchant@nomadpay.io', 'USD', expires_at, amount='5.00')
+        cache.get_or_render(static, fmt)
+        hits = measure(
+            lambda i: cache.get_or_render(
+                qr.encode_payload(key, 'merchant@nomadpay.io', 'USD', expires_at, amount='5.00'), fmt
+            ),
+            args.iterations
+        )
+        report('encode + render (miss)', misses)
+        report('encode + cache hit', hits)
+
+
+if __name__ == '__main__':
+    main()
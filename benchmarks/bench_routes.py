@@ -0,0 +1,516 @@
+"""
+NomadPay Backend API - Route Load Test
+Throughput and p50/p95/p99 latency for every route, via the Flask test client and gunicorn
+
+Usage:
+    python benchmarks/bench_routes.py --users 1000 --transactions 10000 --concurrency 8 --requests 400
+    python benchmarks/bench_routes.py --target gunicorn --workers 4 --save baseline.json
+    python benchmarks/bench_routes.py --compare baseline.json --tolerance 15
+"""
+
+import argparse
+import http.client
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import dataset  # noqa: E402
+
+PERCENTILES = (50, 95, 99)
+
+# name -> (method, build(ctx, state, i) -> (path, body, headers), expected statuses, after(state, body))
+SCENARIOS = {}
+
+
+def scenario(name, method, expect=(200,), after=None):
+    """Register a request builder under a route name"""
+    def register(build):
+        SCENARIOS[name] = (method, build, expect, after)
+        return build
+    return register
+
+
+# Request builders. ctx is shared setup; state is per client thread and
+# holds that thread's preloaded user and its tokens.
+
+@scenario('health', 'GET')
+def _health(ctx, state, i):
+    return '/health', None, {}
+
+
+@scenario('root', 'GET')
+def _root(ctx, state, i):
+    return '/', None, {}
+
+
+@scenario('auth.register', 'POST', expect=(201,))
+def _register(ctx, state, i):
+    email = f"new-{ctx['run']}-{next(ctx['serial'])}@bench.nomadpay.io"
+    return '/api/auth/register', {'email': email, 'password': dataset.PASSWORD}, {}
+
+
+@scenario('auth.login', 'POST')
+def _login(ctx, state, i):
+    return '/api/auth/login', {'email': dataset.email(state['rng'].randint(1, ctx['users'])),
+                               'password': dataset.PASSWORD}, {}
+
+
+def _keep_refresh_token(state, body):
+    # Refresh tokens are single-use; chain each call onto the last one
+    state['refresh'] = body['refresh_token']
+
+
+@scenario('auth.refresh', 'POST', after=_keep_refresh_token)
+def _refresh(ctx, state, i):
+    return '/api/auth/refresh', {'refresh_token': state['refresh']}, {}
+
+
+@scenario('auth.logout', 'POST')
+def _logout(ctx, state, i):
+    # Each logout revokes its token, so every call gets a fresh one
+    tokens = ctx['nomadpay'].generate_tokens(state['user_id'], state['email'])
+    return '/api/auth/logout', {'refresh_token': tokens['refresh_token']}, _bearer(tokens['access_token'])
+
+
+@scenario('wallet.balances', 'GET')
+def _balances(ctx, state, i):
+    return '/api/wallet/balances', None, state['headers']
+
+
+@scenario('wallet.history', 'GET')
+def _wallet_history(ctx, state, i):
+    return '/api/wallet/history?limit=50', None, state['headers']
+
+
+@scenario('transactions.history', 'GET')
+def _transaction_history(ctx, state, i):
+    return '/api/transactions/history?limit=50', None, state['headers']
+
+
+@scenario('transactions.send', 'POST')
+def _send(ctx, state, i):
+    return '/api/transactions/send', {
+        'recipient': dataset.email(_other_user(ctx, state)), 'amount': '0.01', 'currency': 'USD'
+    }, state['headers']
+
+
+@scenario('transactions.batch', 'POST')
+def _batch(ctx, state, i):
+    transfers = [
+        {'recipient': dataset.email(_other_user(ctx, state)), 'amount': '0.01'}
+        for _ in range(ctx['batch_size'])
+    ]
+    return '/api/transactions/batch', {'transfers': transfers}, state['headers']
+
+
+@scenario('qr.generate', 'POST')
+def _qr_generate(ctx, state, i):
+    return '/api/qr/generate', {'amount': f'{1 + i % 50}.00', 'format': 'svg'}, state['headers']
+
+
+@scenario('qr.scan', 'POST')
+def _qr_scan(ctx, state, i):
+    nomadpay = ctx['nomadpay']
+    payload = nomadpay.qr.encode_payload(
+        nomadpay.qr_key, dataset.email(_other_user(ctx, state)), 'USD', int(time.time()) + 3600,
+        amount='0.01', one_time=True
+    )
+    return '/api/qr/scan', {'qr_data': payload, 'confirm': True}, state['headers']
+
+
+@scenario('admin.create_admin', 'POST', expect=(200, 201))
+def _create_admin(ctx, state, i):
+    email = f"admin-{ctx['run']}-{next(ctx['serial'])}@bench.nomadpay.io"
+    return '/api/admin/create-admin', {'email': email, 'password': dataset.PASSWORD}, {}
+
+
+@scenario('admin.users', 'GET')
+def _admin_users(ctx, state, i):
+    return '/api/admin/users?limit=50', None, ctx['admin']
+
+
+@scenario('admin.transactions', 'GET')
+def _admin_transactions(ctx, state, i):
+    return '/api/admin/transactions?limit=50', None, ctx['admin']
+
+
+@scenario('admin.analytics', 'GET')
+def _admin_analytics(ctx, state, i):
+    return '/api/admin/analytics?holdings=true', None, ctx['admin']
+
+
+@scenario('admin.fx.get', 'GET')
+def _fx_get(ctx, state, i):
+    return '/api/admin/fx/rates', None, ctx['admin']
+
+
+@scenario('admin.fx.publish', 'POST')
+def _fx_publish(ctx, state, i):
+    rates = {'base': 'USD', 'rates': {'EUR': f'1.{i % 90 + 10}', 'BTC': '60000', 'ETH': '3000'}}
+    return '/api/admin/fx/rates', rates, ctx['admin']
+
+
+@scenario('admin.profiles', 'GET')
+def _profiles(ctx, state, i):
+    return '/api/admin/profiles', None, ctx['admin']
+
+
+@scenario('admin.profile', 'GET')
+def _profile(ctx, state, i):
+    return f"/api/admin/profiles/{ctx['profile_id']}", None, ctx['admin']
+
+
+@scenario('admin.profile.pstats', 'GET')
+def _profile_pstats(ctx, state, i):
+    return f"/api/admin/profiles/{ctx['profile_id']}/pstats", None, ctx['admin']
+
+
+@scenario('admin.db_pool', 'GET')
+def _db_pool(ctx, state, i):
+    return '/api/admin/db/pool', None, ctx['admin']
+
+
+@scenario('metrics', 'GET')
+def _metrics(ctx, state, i):
+    return '/metrics', None, {}
+
+
+def _bearer(token):
+    """Authorization header for an access token"""
+    return {'Authorization': f'Bearer {token}'}
+
+
+def _other_user(ctx, state):
+    """A random preloaded user other than this thread's own"""
+    while True:
+        user_id = state['rng'].randint(1, ctx['users'])
+        if user_id != state['user_id']:
+            return user_id
+
+
+class TestClientTarget:
+    """Requests through Flask's in-process test client"""
+
+    name = 'testclient'
+
+    def __init__(self, nomadpay):
+        self.app = nomadpay.app
+
+    def client(self):
+        """A client for one thread"""
+        test_client = self.app.test_client()
+
+        def send(method, path, body, headers):
+            response = test_client.open(path, method=method, json=body, headers=headers)
+            return response.status_code, response.data
+
+        return send
+
+    def close(self):
+        pass
+
+
+class GunicornTarget:
+    """Requests over HTTP/1.1 to a gunicorn server on localhost"""
+
+    name = 'gunicorn'
+
+    def __init__(self, env, workers, threads, worker_class):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            self.port = sock.getsockname()[1]
+        command = [
+            sys.executable, '-m', 'gunicorn', 'app:app',
+            '--bind', f'127.0.0.1:{self.port}',
+            '--workers', str(workers), '--threads', str(threads),
+            '--worker-class', worker_class, '--log-level', 'warning'
+        ]
+        self.process = subprocess.Popen(command, cwd=ROOT, env=env)
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                if self.client()('GET', '/health', None, {})[0] == 200:
+                    break
+            except OSError:
+                pass
+            if self.process.poll() is not None or time.monotonic() > deadline:
+                self.close()
+                raise RuntimeError('gunicorn did not start')
+            time.sleep(0.2)
+
+    def client(self):
+        """A keep-alive connection for one thread, reopened when the server closes it"""
+        state = {'conn': None}
+
+        def send(method, path, body, headers):
+            if state['conn'] is None:
+                state['conn'] = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+            headers = dict(headers)
+            payload = None
+            if body is not None:
+                payload = json.dumps(body)
+                headers['Content-Type'] = 'application/json'
+            try:
+                state['conn'].request(method, path, payload, headers)
+                response = state['conn'].getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError):
+                state['conn'].close()
+                state['conn'] = None
+                raise
+            if response.will_close:
+                state['conn'].close()
+                state['conn'] = None
+            return response.status, data
+
+        return send
+
+    def close(self):
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+def percentile(samples, p):
+    """Nearest-rank percentile of sorted samples"""
+    return samples[min(len(samples) - 1, max(0, int(round(p / 100 * len(samples))) - 1))]
+
+
+def run_scenario(target, ctx, states, name, requests):
+    """Drive one route from every client thread; returns its result summary"""
+    method, build, expect, after = SCENARIOS[name]
+    per_thread = max(1, requests // len(states))
+    latencies = [[] for _ in states]
+    errors = [0] * len(states)
+    barrier = threading.Barrier(len(states) + 1)
+
+    def worker(index):
+        state = states[index]
+        send = state['clients'][target.name]
+        barrier.wait()
+        for i in range(per_thread):
+            path, body, headers = build(ctx, state, i)
+            started = time.perf_counter()
+            try:
+                status, data = send(method, path, body, headers)
+            except (http.client.HTTPException, OSError):
+                status, data = None, b''
+            latencies[index].append(time.perf_counter() - started)
+            if status not in expect:
+                errors[index] += 1
+            elif after is not None:
+                after(state, json.loads(data))
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(len(states))]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    samples = sorted(sample for thread_samples in latencies for sample in thread_samples)
+    result = {
+        'requests': len(samples),
+        'errors': sum(errors),
+        'throughput': round(len(samples) / elapsed, 1)
+    }
+    for p in PERCENTILES:
+        result[f'p{p}_ms'] = round(percentile(samples, p) * 1000, 3)
+    return result
+
+
+def setup(args, workdir):
+    """Preload the database, import the app and build shared and per-thread state"""
+    db_path = args.db or os.path.join(workdir, 'bench.db')
+    os.environ['DATABASE_URL'] = db_path
+    os.environ.setdefault('SECRET_KEY', 'benchmark-secret')
+    os.environ.setdefault('METRICS_DIR', os.path.join(workdir, 'metrics'))
+    os.environ.setdefault('PROFILE_DIR', os.path.join(workdir, 'profiles'))
+    os.environ.setdefault('RATE_LIMIT_ENABLED', 'false')
+    if args.hash_iterations:
+        os.environ['PASSWORD_HASH_ITERATIONS'] = str(args.hash_iterations)
+    import app as nomadpay
+
+    with nomadpay.db.connection() as conn:
+        loaded = conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+    if loaded == 0:
+        started = time.perf_counter()
+        dataset.preload(db_path, args.users, args.transactions, nomadpay.hasher.hash(dataset.PASSWORD))
+        print(f'preloaded {args.users} users / {args.transactions} transactions '
+              f'in {time.perf_counter() - started:.1f}s')
+    elif loaded < args.users:
+        raise SystemExit(f'{db_path} has {loaded} users; expected a benchmark dataset with at least {args.users}')
+
+    with nomadpay.db.transaction() as conn:
+        row = conn.execute("SELECT id, email FROM users WHERE role = 'admin' LIMIT 1").fetchone()
+        if row is None:
+            row = (nomadpay.create_user(conn, 'bench-admin@nomadpay.io', nomadpay.hasher.hash(dataset.PASSWORD),
+                                        'admin', datetime.utcnow().isoformat()), 'bench-admin@nomadpay.io')
+    admin_token = nomadpay.generate_tokens(row[0], row[1], 'admin')['access_token']
+    nomadpay.fx_rates.publish({'base': 'USD', 'rates': {'EUR': '1.08', 'BTC': '60000', 'ETH': '3000'}}, 'benchmark')
+
+    ctx = {
+        'nomadpay': nomadpay,
+        'users': args.users,
+        'run': f'{int(time.time())}-{os.getpid()}',
+        'serial': itertools.count(),
+        'batch_size': args.batch_size,
+        'admin': _bearer(admin_token),
+        'admin_token': admin_token,
+        'profile_id': None
+    }
+    states = []
+    for thread in range(args.concurrency):
+        user_id = thread % args.users + 1
+        email = dataset.email(user_id)
+        tokens = nomadpay.generate_tokens(user_id, email)
+        states.append({
+            'thread': thread,
+            'user_id': user_id,
+            'email': email,
+            'headers': _bearer(tokens['access_token']),
+            'refresh': tokens['refresh_token'],
+            'rng': random.Random(args.seed + thread),
+            'clients': {}
+        })
+    return nomadpay, ctx, states
+
+
+def run_target(target, ctx, states, names, requests):
+    """Run every selected route against one target and print a table"""
+    for state in states:
+        state['clients'][target.name] = target.client()
+    # One profiled request gives the profile routes something to serve
+    send = target.client()
+    send('GET', '/health', None, {'X-Profile': ctx['admin_token']})
+    profiles = json.loads(send('GET', '/api/admin/profiles', None, ctx['admin'])[1]).get('profiles') or []
+    ctx['profile_id'] = profiles[0]['id'] if profiles else '0000000000000-0-0'
+
+    print(f'\n{target.name}: {len(states)} clients')
+    print(f"  {'route':24} {'requests':>8} {'errors':>6} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    results = {}
+    for name in names:
+        result = run_scenario(target, ctx, states, name, requests)
+        results[name] = result
+        print(f"  {name:24} {result['requests']:8} {result['errors']:6} {result['throughput']:9.1f} "
+              f"{result['p50_ms']:9.2f} {result['p95_ms']:9.2f} {result['p99_ms']:9.2f}")
+    return results
+
+
+def git_commit():
+    """Current commit hash, if run from a git checkout"""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, current, tolerance):
+    """Print per-route changes against a baseline; returns the number of regressions"""
+    regressions = 0
+    print(f"\nvs baseline {baseline['meta'].get('commit')} ({baseline['meta'].get('date')}), "
+          f'tolerance {tolerance:.0f}%')
+    for target, routes in current['results'].items():
+        for name, result in routes.items():
+            before = baseline['results'].get(target, {}).get(name)
+            if not before:
+                continue
+            throughput = (result['throughput'] / before['throughput'] - 1) * 100 if before['throughput'] else 0.0
+            p99 = (result['p99_ms'] / before['p99_ms'] - 1) * 100 if before['p99_ms'] else 0.0
+            regressed = throughput < -tolerance or p99 > tolerance
+            regressions += regressed
+            print(f"  {target:10} {name:24} req/s {throughput:+7.1f}%  p99 {p99:+7.1f}%"
+                  f"{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-test every route')
+    parser.add_argument('--target', choices=('testclient', 'gunicorn', 'both'), default='both')
+    parser.add_argument('--users', type=int, default=1000, help='preloaded users')
+    parser.add_argument('--transactions', type=int, default=10000, help='preloaded transfers')
+    parser.add_argument('--db', help='reuse (or create) this database instead of a temporary one')
+    parser.add_argument('--concurrency', type=int, default=8, help='client threads')
+    parser.add_argument('--requests', type=int, default=400, help='requests per route')
+    parser.add_argument('--batch-size', type=int, default=20, help='transfers per batch request')
+    parser.add_argument('--routes', help='comma-separated route names (default: all)')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn workers')
+    parser.add_argument('--threads', type=int, default=4, help='gunicorn threads per worker')
+    parser.add_argument('--worker-class', default='gthread')
+    parser.add_argument('--hash-iterations', type=int, help='override PASSWORD_HASH_ITERATIONS')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save', help='write results as a JSON baseline')
+    parser.add_argument('--compare', help='baseline JSON to diff against')
+    parser.add_argument('--tolerance', type=float, default=10.0, help='allowed regression in percent')
+    args = parser.parse_args()
+
+    names = args.routes.split(',') if args.routes else list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown routes: {', '.join(unknown)} (choose from {', '.join(SCENARIOS)})")
+
+    workdir = tempfile.mkdtemp(prefix='nomadpay-bench-')
+    try:
+        nomadpay, ctx, states = setup(args, workdir)
+        report = {
+            'meta': {
+                'commit': git_commit(),
+                'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'users': args.users,
+                'transactions': args.transactions,
+                'concurrency': args.concurrency,
+                'requests': args.requests,
+                'workers': args.workers,
+                'threads': args.threads,
+                'worker_class': args.worker_class,
+                'hash_iterations': nomadpay.app.config['PASSWORD_HASH_ITERATIONS']
+            },
+            'results': {}
+        }
+
+        if args.target in ('testclient', 'both'):
+            report['results']['testclient'] = run_target(TestClientTarget(nomadpay), ctx, states, names, args.requests)
+        if args.target in ('gunicorn', 'both'):
+            target = GunicornTarget(dict(os.environ), args.workers, args.threads, args.worker_class)
+            try:
+                report['results']['gunicorn'] = run_target(target, ctx, states, names, args.requests)
+            finally:
+                target.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print(f'\nsaved {args.save}')
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline, report, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""
+NomadPay Backend API - Shard Scaling Benchmark
+Transfer write throughput of concurrent writer processes against 1..N user shards
+
+Usage:
+    python benchmarks/bench_shards.py --shards 1 2 4 --processes 8 --seconds 10
+    python benchmarks/bench_shards.py --shards 1 4 --cross-shard 0.2 --synchronous NORMAL
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sharding  # noqa: E402
+from sharding import ShardSet, ShardedLedger  # noqa: E402
+from ledger import LedgerError  # noqa: E402
+
+OPENING_BALANCE = 100_000_000
+
+
+def setup(workdir, shard_count, users):
+    """Create a directory and shard files with funded users; returns the paths"""
+    os.environ.setdefault('DATABASE_URL', os.path.join(workdir, 'app.db'))
+    os.environ.setdefault('SECRET_KEY', 'benchmark-secret')
+    os.environ.setdefault('METRICS_DIR', os.path.join(workdir, 'metrics'))
+    import app as nomadpay
+
+    directory = os.path.join(workdir, f'directory-{shard_count}.db')
+    shards = [os.path.join(workdir, f'shard-{shard_count}-{index}.db') for index in range(shard_count)]
+    shard_set = ShardSet(directory, shards)
+    shard_set.init_schema(nomadpay.create_tables)
+
+    def insert(conn, user_id):
+        conn.execute(
+            "INSERT INTO users (id, email, password_hash, role) VALUES (?, ?, 'x', 'user')",
+            (user_id, f'user{user_id}@bench.nomadpay.io')
+        )
+        conn.execute('INSERT INTO wallets (user_id, currency, balance_minor) VALUES (?, ?, ?)',
+                     (user_id, 'USD', OPENING_BALANCE))
+
+    for n in range(1, users + 1):
+        shard_set.create_user(f'user{n}@bench.nomadpay.io', insert)
+    return directory, shards
+
+
+def writer(directory, shards, users, cross_shard, seconds, synchronous, seed, results):
+    """Send transfers until the deadline; report (transfers, cross-shard, failures)"""
+    shard_set = ShardSet(directory, shards, synchronous=synchronous, busy_timeout_ms=30000)
+    ledger = ShardedLedger(shard_set, group_commit=False)
+    rng = random.Random(seed)
+    by_shard = {}
+    for user_id in range(1, users + 1):
+        by_shard.setdefault(sharding.placement(user_id, len(shards)), []).append(user_id)
+    done = cross = failed = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        sender = rng.randint(1, users)
+        home = shard_set.shard_of(sender)
+        if len(shards) > 1 and rng.random() < cross_shard:
+            recipient = rng.choice(by_shard[rng.choice([s for s in by_shard if s != home])])
+            cross += 1
+        else:
+            recipient = rng.choice(by_shard[home])
+            if recipient == sender:
+                continue
+        try:
+            ledger.transfer(sender, recipient, 'USD', 1)
+            done += 1
+        except LedgerError:
+            failed += 1
+    results.put((done, cross, failed))
+
+
+def run(directory, shards, args):
+    """Run the writer processes and return transfers per second"""
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=writer, args=(
+            directory, shards, args.users, args.cross_shard, args.seconds, args.synchronous, seed, results
+        ))
+        for seed in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+    totals = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    done = sum(total[0] for total in totals)
+    cross = sum(total[1] for total in totals)
+    failed = sum(total[2] for total in totals)
+    return done / args.seconds, cross, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Transfer throughput by shard count')
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--processes', type=int, default=8, help='concurrent writer processes')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--cross-shard', type=float, default=0.0, help='fraction of transfers between shards')
+    parser.add_argument('--synchronous', default='FULL', choices=('OFF', 'NORMAL', 'FULL'),
+                        help='SQLite synchronous mode (FULL fsyncs every commit)')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='nomadpay-shards-')
+    try:
+        print(f'{args.processes} writer processes, {args.users} users, {args.cross_shard:.0%} cross-shard, '
+              f'synchronous={args.synchronous}')
+        baseline = None
+        for shard_count in args.shards:
+            directory, shards = setup(workdir, shard_count, args.users)
+            rate, cross, failed = run(directory, shards, args)
+            baseline = baseline or rate
+            print(f'  {shard_count:3} shards  {rate:9.0f} transfers/s  x{rate / baseline:4.2f}  '
+                  f'({cross} cross-shard, {failed} failed)')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+"""
+NomadPay Backend API - Wallet Stream Benchmark
+Concurrent /api/wallet/stream connections per worker and push latency of transfers
+
+Streams are opened on a stream service (STREAM_SERVER=true, gevent by
+default) and transfers are sent through a separate API service, as deployed.
+
+Usage:
+    python benchmarks/bench_stream.py --connections 400 --workers 2
+    python benchmarks/bench_stream.py --connections 64 --worker-class gthread --threads 32
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import selectors
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import dataset  # noqa: E402
+from bench_routes import GunicornTarget, percentile  # noqa: E402
+
+
+def default_worker_class():
+    """gevent when installed, otherwise gunicorn's threaded worker"""
+    try:
+        import gevent  # noqa: F401
+        return 'gevent'
+    except ImportError:
+        return 'gthread'
+
+
+def setup(workdir, users):
+    """Preload users and return the app module and a token per user"""
+    db_path = os.path.join(workdir, 'stream.db')
+    os.environ['DATABASE_URL'] = db_path
+    os.environ.setdefault('SECRET_KEY', 'benchmark-secret')
+    os.environ.setdefault('METRICS_DIR', os.path.join(workdir, 'metrics'))
+    os.environ.setdefault('PROFILE_DIR', os.path.join(workdir, 'profiles'))
+    os.environ.setdefault('RATE_LIMIT_ENABLED', 'false')
+    os.environ.setdefault('PASSWORD_HASH_ITERATIONS', '1000')
+    import app as nomadpay
+
+    dataset.preload(db_path, users, 0, 'x', progress=lambda message: None)
+    tokens = {
+        user_id: nomadpay.generate_tokens(user_id, dataset.email(user_id))['access_token']
+        for user_id in range(1, users + 1)
+    }
+    return nomadpay, tokens
+
+
+class Listener:
+    """Holds many SSE connections on one selector thread and timestamps events"""
+
+    def __init__(self, port):
+        self.port = port
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.connected = 0
+        self.failed = 0
+        self.arrivals = {}
+        self.running = True
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+
+    def open(self, token, timeout):
+        """Open one stream; returns True once its first balance snapshot has arrived"""
+        sock = socket.create_connection(('127.0.0.1', self.port), timeout=timeout)
+        buffer = b''
+        try:
+            sock.sendall(
+                f'GET /api/wallet/stream HTTP/1.1\r\nHost: 127.0.0.1\r\n'
+                f'Authorization: Bearer {token}\r\nAccept: text/event-stream\r\n\r\n'.encode()
+            )
+            while b'event: balances' not in buffer:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                buffer += chunk
+        except OSError:
+            # No free worker thread (or connection slot) picked it up in time
+            buffer = b''
+        if b' 200 ' not in buffer.split(b'\r\n', 1)[0] or b'event: balances' not in buffer:
+            sock.close()
+            with self.lock:
+                self.failed += 1
+            return False
+        sock.setblocking(False)
+        self.selector.register(sock, selectors.EVENT_READ, {'buffer': b''})
+        with self.lock:
+            self.connected += 1
+        return True
+
+    def _loop(self):
+        """Read every stream and record when each transaction event arrives"""
+        while self.running:
+            for key, _ in self.selector.select(timeout=0.2):
+                try:
+                    chunk = key.fileobj.recv(65536)
+                except (BlockingIOError, InterruptedError):
+                    continue
+                except OSError:
+                    chunk = b''
+                now = time.perf_counter()
+                if not chunk:
+                    self.selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                    with self.lock:
+                        self.connected -= 1
+                    continue
+                key.data['buffer'] += chunk
+                *messages, key.data['buffer'] = key.data['buffer'].split(b'\n\n')
+                for message in messages:
+                    if b'event: transaction' not in message:
+                        continue
+                    for line in message.split(b'\n'):
+                        if line.startswith(b'data: '):
+                            reference = json.loads(line[6:])['transaction_id']
+                            with self.lock:
+                                self.arrivals.setdefault(reference, now)
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+
+
+def worker_rss_kb(master_pid):
+    """Resident memory of each gunicorn worker (Linux /proc)"""
+    sizes = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{name}/status') as f:
+                status = dict(line.split(':', 1) for line in f if ':' in line)
+        except OSError:
+            continue
+        if status.get('PPid', '').strip() == str(master_pid) and 'VmRSS' in status:
+            sizes.append(int(status['VmRSS'].split()[0]))
+    return sizes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent wallet streams per worker')
+    parser.add_argument('--connections', type=int, default=1000, help='streams to open')
+    parser.add_argument('--users', type=int, default=1000, help='preloaded users streams are spread over')
+    parser.add_argument('--transfers', type=int, default=200, help='transfers pushed while streams are open')
+    parser.add_argument('--workers', type=int, default=2, help='stream service workers')
+    parser.add_argument('--threads', type=int, default=4, help='gunicorn threads per worker (gthread)')
+    parser.add_argument('--worker-class', default=default_worker_class(), help='stream service worker class')
+    parser.add_argument('--worker-connections', type=int, default=250, help='gevent connections per worker')
+    parser.add_argument('--stream-max', type=int, help='STREAM_MAX_CONNECTIONS (default: the app default)')
+    parser.add_argument('--connect-timeout', type=float, default=5.0)
+    parser.add_argument('--max-failures', type=int, default=20, help='stop opening streams after this many fail')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='nomadpay-stream-')
+    target = api = listener = None
+    try:
+        nomadpay, tokens = setup(workdir, args.users)
+        env = dict(os.environ)
+        if args.stream_max is not None:
+            env['STREAM_MAX_CONNECTIONS'] = str(args.stream_max)
+        api = GunicornTarget(env, 1, args.threads, 'gthread')
+        env['STREAM_SERVER'] = 'true'
+        env['GUNICORN_CMD_ARGS'] = f'--worker-connections {args.worker_connections}'
+        target = GunicornTarget(env, args.workers, args.threads, args.worker_class)
+        listener = Listener(target.port)
+        rng = random.Random(args.seed)
+
+        subscribed = []
+        started = time.perf_counter()
+        for i in range(args.connections):
+            user_id = i % args.users + 1
+            try:
+                if listener.open(tokens[user_id], args.connect_timeout):
+                    subscribed.append(user_id)
+            except OSError:
+                listener.failed += 1
+            if listener.failed >= args.max_failures:
+                break
+        connect_time = time.perf_counter() - started
+        listener.thread.start()
+
+        print(f'{args.worker_class}: {args.workers} workers, {args.threads} threads')
+        print(f'  streams open      {listener.connected} of {args.connections} '
+              f'({listener.connected / args.workers:.0f} per worker, {listener.failed} failed) '
+              f'in {connect_time:.1f}s')
+        rss = worker_rss_kb(target.process.pid)
+        if rss:
+            print(f"  worker RSS        {', '.join(f'{size / 1024:.1f} MB' for size in rss)}")
+
+        if subscribed and args.transfers:
+            sends = {}
+            conn = http.client.HTTPConnection('127.0.0.1', api.port, timeout=args.connect_timeout)
+            recipients = sorted(set(subscribed))
+            for i in range(args.transfers):
+                recipient = rng.choice(recipients)
+                sender = recipient % args.users + 1
+                body = json.dumps({'recipient': dataset.email(recipient), 'amount': '0.01', 'currency': 'USD'})
+                sent_at = time.perf_counter()
+                try:
+                    conn.request('POST', '/api/transactions/send', body, {
+                        'Authorization': f'Bearer {tokens[sender]}', 'Content-Type': 'application/json'
+                    })
+                    response = conn.getresponse()
+                    data = json.loads(response.read())
+                except (http.client.HTTPException, OSError):
+                    print('  transfers         timed out')
+                    break
+                if response.status == 200:
+                    sends[data['transaction_id']] = sent_at
+            deadline = time.monotonic() + 5
+            while time.monotonic() < deadline:
+                with listener.lock:
+                    if all(reference in listener.arrivals for reference in sends):
+                        break
+                time.sleep(0.05)
+            with listener.lock:
+                latencies = sorted(listener.arrivals[ref] - sent for ref, sent in sends.items()
+                                   if ref in listener.arrivals)
+            print(f'  pushed            {len(latencies)} of {len(sends)} transfers')
+            if latencies:
+                print('  push latency      ' + '  '.join(
+                    f'p{p} {percentile(latencies, p) * 1000:.1f} ms' for p in (50, 95, 99)
+                ))
+    finally:
+        if listener is not None:
+            listener.close()
+        if target is not None:
+            target.close()
+        if api is not None:
+            api.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+"""
+NomadPay Backend API - Benchmark Dataset
+Bulk preload of synthetic users, wallets and transfers into a NomadPay database
+
+Usage:
+    python benchmarks/dataset.py /tmp/bench.db --users 1000000 --transactions 10000000
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Preloaded users log in with this password
+PASSWORD = 'benchmark-password'
+
+# Wallets per user, in the order app.create_default_wallets inserts them
+CURRENCIES = ('USD', 'EUR', 'BTC', 'ETH')
+
+# Starting USD/EUR balance of every preloaded wallet (minor units)
+OPENING_BALANCE = 100_000_000
+
+# Tables whose secondary indexes are dropped during the load and rebuilt after
+BULK_TABLES = ('users', 'wallets', 'transactions', 'ledger_entries')
+
+_SEQUENCE = 'WITH RECURSIVE seq(n) AS (SELECT ? UNION ALL SELECT n + 1 FROM seq WHERE n < ?)'
+
+
+def email(n):
+    """Email of the nth preloaded user (1-based, equal to its user id)"""
+    return f'user{n}@bench.nomadpay.io'
+
+
+def preload(path, users, transactions, password_hash, days=90, chunk=100_000, progress=print):
+    """Fill a freshly initialised (empty) database with synthetic data.
+
+    Rows are generated inside SQLite from recursive CTEs, so loading
+    millions of rows costs one statement per chunk. User n gets id n,
+    wallet ids ``(n - 1) * 4 + 1..4`` and is funded in USD and EUR;
+    transfer n moves a small USD or EUR amount between two distinct
+    pseudo-random users. Ledger ``balance_after`` values are synthetic.
+    Analytics rollups are rebuilt from the loaded rows.
+    """
+    if users < 2:
+        raise ValueError('at least two users are required')
+    conn = sqlite3.connect(path, isolation_level=None)
+    try:
+        conn.execute('PRAGMA synchronous = OFF')
+        conn.execute('PRAGMA cache_size = -262144')
+        if conn.execute('SELECT EXISTS (SELECT 1 FROM users)').fetchone()[0]:
+            raise ValueError(f'{path} already has users; preload needs an empty database')
+
+        placeholders = ', '.join('?' * len(BULK_TABLES))
+        indexes = conn.execute(
+            f"SELECT name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL "
+            f"AND tbl_name IN ({placeholders})", BULK_TABLES
+        ).fetchall()
+        for name, _ in indexes:
+            conn.execute(f'DROP INDEX {name}')
+
+        now = int(time.time())
+        start = now - days * 86400
+        stamp = "strftime('%Y-%m-%dT%H:%M:%S', ? + {offset}, 'unixepoch')"
+
+        _chunked(conn, 'users', users, chunk, progress, f'''
+            {_SEQUENCE}
+            INSERT INTO users (id, email, password_hash, role, created_at)
+            SELECT n, 'user' || n || '@bench.nomadpay.io', ?, 'user', {stamp.format(offset='n * ? / ?')}
+            FROM seq
+        ''', lambda lo, hi: (lo, hi, password_hash, start, days * 86400, users))
+
+        currencies = ' UNION ALL '.join(f"SELECT {i + 1}, '{c}'" for i, c in enumerate(CURRENCIES))
+        _chunked(conn, 'wallets', users, chunk, progress, f'''
+            {_SEQUENCE}, currencies(position, currency) AS ({currencies})
+            INSERT INTO wallets (id, user_id, currency, balance_minor)
+            SELECT (n - 1) * {len(CURRENCIES)} + position, n, currency,
+                   CASE WHEN currency IN ('USD', 'EUR') THEN ? ELSE 0 END
+            FROM seq, currencies ORDER BY n, position
+        ''', lambda lo, hi: (lo, hi, OPENING_BALANCE), per_id=len(CURRENCIES))
+
+        # sender = n*7919 mod U; recipient is 1..U-1 places after it, so never the same user
+        _chunked(conn, 'transactions', transactions, chunk, progress, f'''
+            {_SEQUENCE}, pairs(n, sender) AS (SELECT n, (n * 7919) % ? FROM seq)
+            INSERT INTO transactions
+                (id, reference, sender_id, recipient_id, currency, amount_minor, type, status, description, created_at)
+            SELECT n, 'bench-' || n, sender + 1, (sender + 1 + n % (? - 1)) % ? + 1,
+                   CASE n % 2 WHEN 0 THEN 'USD' ELSE 'EUR' END, 1 + (n * 31) % 10000,
+                   'transfer', 'completed', NULL, {stamp.format(offset='n * ? / ?')}
+            FROM pairs
+        ''', lambda lo, hi: (lo, hi, users, users, users, start, days * 86400, transactions))
+
+        wallet = f"(({{side}} - 1) * {len(CURRENCIES)} + CASE currency WHEN 'USD' THEN 1 ELSE 2 END)"
+        _chunked(conn, 'ledger entries', transactions, chunk, progress, f'''
+            INSERT INTO ledger_entries
+                (transaction_id, wallet_id, user_id, currency, amount_minor, balance_after_minor, created_at)
+            SELECT id, {wallet.format(side='sender_id')}, sender_id, currency, -amount_minor, ?, created_at
+            FROM transactions WHERE id BETWEEN ? AND ?
+            UNION ALL
+            SELECT id, {wallet.format(side='recipient_id')}, recipient_id, currency, amount_minor, ?, created_at
+            FROM transactions WHERE id BETWEEN ? AND ?
+        ''', lambda lo, hi: (OPENING_BALANCE, lo, hi, OPENING_BALANCE, lo, hi), per_id=2)
+
+        progress('rebuilding rollups')
+        conn.execute('BEGIN')
+        _rebuild_rollups(conn)
+        conn.execute('COMMIT')
+
+        for name, sql in indexes:
+            progress(f'creating {name}')
+            conn.execute(sql)
+        conn.execute('ANALYZE')
+    finally:
+        conn.close()
+
+
+def _chunked(conn, label, total, chunk, progress, sql, params, per_id=1):
+    """Run an INSERT for ids 1..total in chunk-sized transactions"""
+    started = time.perf_counter()
+    for lo in range(1, total + 1, chunk):
+        hi = min(lo + chunk - 1, total)
+        conn.execute('BEGIN')
+        conn.execute(sql, params(lo, hi))
+        conn.execute('COMMIT')
+    progress(f'{label}: {total * per_id} rows in {time.perf_counter() - started:.1f}s')
+
+
+def _rebuild_rollups(conn):
+    """Recompute analytics rollups from users and transactions"""
+    import analytics
+
+    conn.execute('DELETE FROM rollup_totals')
+    conn.execute('DELETE FROM rollup_buckets')
+    conn.execute("INSERT INTO rollup_totals (metric, currency, value) SELECT 'users', '', COUNT(*) FROM users")
+    conn.execute('''
+        INSERT INTO rollup_totals (metric, currency, value)
+        SELECT 'transactions', currency, COUNT(*) FROM transactions WHERE status = 'completed' GROUP BY currency
+        UNION ALL
+        SELECT 'volume', currency, SUM(amount_minor) FROM transactions WHERE status = 'completed' GROUP BY currency
+    ''')
+    for granularity, length in analytics.GRANULARITIES.items():
+        conn.execute('''
+            INSERT INTO rollup_buckets (granularity, bucket, currency, new_users)
+            SELECT ?, substr(created_at, 1, ?), '', COUNT(*) FROM users GROUP BY 2
+        ''', (granularity, length))
+        conn.execute('''
+            INSERT INTO rollup_buckets (granularity, bucket, currency, tx_count, volume_minor)
+            SELECT ?, substr(created_at, 1, ?), currency, COUNT(*), SUM(amount_minor)
+            FROM transactions WHERE status = 'completed' GROUP BY 2, 3
+        ''', (granularity, length))
+    analytics.prune_minute_buckets(conn)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Preload a NomadPay database for benchmarks')
+    parser.add_argument('path', help='database file (created if missing, must have no users)')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--transactions', type=int, default=10000)
+    parser.add_argument('--days', type=int, default=90, help='spread created_at over this many days')
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = args.path
+    import app as nomadpay
+
+    preload(args.path, args.users, args.transactions, nomadpay.hasher.hash(PASSWORD), days=args.days)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+"""
+NomadPay Backend API - Balance Cache
+In-process LRU/TTL cache of wallet balances with cross-worker invalidation
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def init_schema(conn):
+    """Create the balance change feed shared by all workers"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS balance_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            changed_at REAL NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_balance_changes_changed_at
+        ON balance_changes (changed_at)
+    ''')
+
+
+def record_balance_change(conn, user_ids):
+    """Append users whose wallets changed, inside the writer's transaction"""
+    now = time.time()
+    conn.executemany(
+        'INSERT INTO balance_changes (user_id, changed_at) VALUES (?, ?)',
+        [(user_id, now) for user_id in set(user_ids)]
+    )
+
+
+class BalanceCache:
+    """Read-through cache of per-user balances.
+
+    Writes made by this worker invalidate entries immediately. Writes made
+    by other workers are picked up by tailing the ``balance_changes``
+    table at most once every ``poll_interval`` seconds, so the
+    cross-worker cost is one indexed range scan per interval rather than
+    one query per request. ``ttl`` bounds staleness if polling falls
+    behind the retention window. Old feed rows are pruned by a background
+    thread, so the write lock is never taken on the read path.
+
+    ``pool`` may be a list of pools (one per shard); each has its own feed.
+    """
+
+    def __init__(self, pool, max_entries=10000, ttl=30.0, poll_interval=0.5, retention=300.0):
+        self.pools = list(pool) if isinstance(pool, (list, tuple)) else [pool]
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._last_seq = {}
+        self._generation = 0
+        self._last_poll = 0.0
+        self._pruner_pid = None
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'expirations': 0,
+            'invalidations': 0,
+            'remote_invalidations': 0,
+            'full_flushes': 0,
+            'pruned': 0
+        }
+
+    def get(self, user_id, loader):
+        """Return cached balances for user_id, calling loader(user_id) on a miss"""
+        self._ensure_pruner()
+        self._poll_changes()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(user_id)
+                    self._stats['hits'] += 1
+                    return entry[1]
+                del self._entries[user_id]
+                self._stats['expirations'] += 1
+            self._stats['misses'] += 1
+            generation = self._generation
+
+        balances = loader(user_id)
+
+        with self._lock:
+            # Skip the fill if anything was invalidated while we were
+            # loading; the loaded value may predate that change
+            if generation == self._generation:
+                self._entries[user_id] = (now + self.ttl, balances)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self._stats['evictions'] += 1
+        return balances
+
+    def invalidate(self, user_ids):
+        """Drop entries for users whose balances changed in this worker"""
+        with self._lock:
+            self._generation += 1
+            for user_id in user_ids:
+                if self._entries.pop(user_id, None) is not None:
+                    self._stats['invalidations'] += 1
+
+    def clear(self):
+        """Drop every entry"""
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._stats['full_flushes'] += 1
+
+    def _poll_changes(self):
+        """Apply changes written by other workers since the last poll"""
+        now = time.monotonic()
+        if now - self._last_poll < self.poll_interval:
+            return
+        with self._lock:
+            if now - self._last_poll < self.poll_interval:
+                return
+            self._last_poll = now
+        for index, pool in enumerate(self.pools):
+            self._poll_feed(index, pool)
+
+    def _poll_feed(self, index, pool):
+        """Apply one pool's balance_changes rows since the last poll"""
+        with self._lock:
+            last_seq = self._last_seq.get(index)
+
+        with pool.connection() as conn:
+            if last_seq is None:
+                row = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM balance_changes').fetchone()
+                with self._lock:
+                    self._last_seq[index] = row[0]
+                    self._generation += 1
+                    self._entries.clear()
+                return
+            oldest = conn.execute('SELECT MIN(seq) FROM balance_changes').fetchone()[0]
+            rows = conn.execute(
+                'SELECT seq, user_id FROM balance_changes WHERE seq > ? ORDER BY seq',
+                (last_seq,)
+            ).fetchall()
+
+        with self._lock:
+            if rows or (oldest is not None and oldest > last_seq + 1):
+                self._generation += 1
+            if oldest is not None and oldest > last_seq + 1:
+                # Rows we never saw were pruned: nothing can be trusted
+                self._entries.clear()
+                self._stats['full_flushes'] += 1
+            else:
+                for _, user_id in rows:
+                    if self._entries.pop(user_id, None) is not None:
+                        self._stats['remote_invalidations'] += 1
+            if rows:
+                self._last_seq[index] = rows[-1][0]
+
+    def prune(self):
+        """Delete feed rows older than the retention window; returns the number removed"""
+        removed = 0
+        for pool in self.pools:
+            with pool.transaction() as conn:
+                removed += conn.execute(
+                    'DELETE FROM balance_changes WHERE changed_at < ?',
+                    (time.time() - self.retention,)
+                ).rowcount
+        with self._lock:
+            self._stats['pruned'] += removed
+        return removed
+
+    def _ensure_pruner(self):
+        """Start the background pruner once per worker process"""
+        if self._pruner_pid == os.getpid():
+            return
+        with self._lock:
+            if self._pruner_pid == os.getpid():
+                return
+            self._pruner_pid = os.getpid()
+        threading.Thread(target=self._prune_loop, name='balance-changes-pruner', daemon=True).start()
+
+    def _prune_loop(self):
+        """Periodically delete old balance_changes rows"""
+        while True:
+            time.sleep(self.retention / 4)
+            try:
+                self.prune()
+            except Exception:
+                logger.exception('Balance change feed prune failed')
+
+    def stats(self):
+        """Snapshot of cache counters for sizing"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+        stats['max_entries'] = self.max_entries
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+        return stats
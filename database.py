@@ -0,0 +1,201 @@
+"""
+NomadPay Backend API - Database Connection Pool
+Per-worker SQLite connection reuse with WAL journaling and tuned pragmas
+"""
+
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection could be checked out in time"""
+
+
+class ConnectionPool:
+    """Bounded pool of SQLite connections owned by a single worker process.
+
+    Connections are opened lazily up to ``size`` and handed out LIFO so the
+    hottest connection (warm page cache, prepared statements) is reused
+    first. After a fork (gunicorn ``--preload``) the inherited connections
+    are discarded and the pool starts over in the child. ``on_connect(conn)``
+    runs for every new connection (e.g. to register SQL functions) and
+    ``factory`` picks the connection class (e.g. one that times statements).
+    """
+
+    def __init__(self, path, size=8, timeout=5.0, busy_timeout_ms=5000,
+                 cache_size_kb=16384, mmap_size=268435456,
+                 synchronous='NORMAL', cached_statements=256, on_connect=None,
+                 factory=sqlite3.Connection):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        self.synchronous = synchronous
+        self.cached_statements = cached_statements
+        self.on_connect = on_connect
+        self.factory = factory
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        """Start with an empty pool owned by the current process"""
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+        }
+        self._in_use = 0
+
+    def _connect(self):
+        """Open a new connection and apply the pool's pragmas"""
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.busy_timeout_ms / 1000.0,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+            factory=self.factory
+        )
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout_ms)}')
+        conn.execute(f'PRAGMA synchronous={self.synchronous}')
+        conn.execute(f'PRAGMA cache_size=-{int(self.cache_size_kb)}')
+        conn.execute(f'PRAGMA mmap_size={int(self.mmap_size)}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA foreign_keys=ON')
+        if self.on_connect is not None:
+            self.on_connect(conn)
+        return conn
+
+    def _checkout(self):
+        """Take an idle connection, open a new one, or wait for a release"""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            self._stats['checkouts'] += 1
+            try:
+                conn = self._idle.get_nowait()
+                self._in_use += 1
+                return conn
+            except queue.Empty:
+                pass
+            if self._created < self.size:
+                self._created += 1
+                self._in_use += 1
+                create = True
+            else:
+                self._stats['waits'] += 1
+                create = False
+
+        if create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                    self._in_use -= 1
+                raise
+
+        started = time.perf_counter()
+        try:
+            conn = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            with self._lock:
+                self._stats['timeouts'] += 1
+            raise PoolTimeout(f'No database connection available after {self.timeout}s')
+        waited = time.perf_counter() - started
+        with self._lock:
+            self._in_use += 1
+            self._stats['wait_time_total'] += waited
+            if waited > self._stats['wait_time_max']:
+                self._stats['wait_time_max'] = waited
+        return conn
+
+    def _release(self, conn, pid):
+        """Return a connection to the pool, discarding it if it is unusable"""
+        if pid != os.getpid():
+            return
+        if conn.in_transaction:
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                pass
+        with self._lock:
+            if pid != self._pid:
+                return
+            self._in_use -= 1
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection for the duration of the block"""
+        pid = os.getpid()
+        conn = self._checkout()
+        try:
+            yield conn
+        finally:
+            self._release(conn, pid)
+
+    @contextmanager
+    def transaction(self, immediate=True):
+        """Run the block in a single write transaction, rolling back on error"""
+        with self.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+    @contextmanager
+    def dedicated(self):
+        """Open a connection outside the pool for long-running reads (exports)"""
+        conn = self._connect()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def stats(self):
+        """Snapshot of pool usage for monitoring"""
+        with self._lock:
+            checkouts = self._stats['checkouts']
+            waits = self._stats['waits']
+            return {
+                'size': self.size,
+                'created': self._created,
+                'in_use': self._in_use,
+                'idle': self._idle.qsize(),
+                'checkouts': checkouts,
+                'waits': waits,
+                'timeouts': self._stats['timeouts'],
+                'wait_time_total_ms': round(self._stats['wait_time_total'] * 1000, 3),
+                'wait_time_avg_ms': round(self._stats['wait_time_total'] * 1000 / waits, 3) if waits else 0.0,
+                'wait_time_max_ms': round(self._stats['wait_time_max'] * 1000, 3),
+            }
+
+    def close(self):
+        """Close every idle connection held by this process"""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+                return
+            while True:
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    break
+                conn.close()
+                self._created -= 1
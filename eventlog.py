@@ -0,0 +1,641 @@
+"""
+NomadPay Backend API - Event Log
+Append-only segment files of money-movement and auth events, with replay and verification
+
+Usage:
+    python eventlog.py checkpoint --db nomadpay.db --dir eventlog
+    python eventlog.py verify --db nomadpay.db --dir eventlog
+    python eventlog.py rebuild --db nomadpay.db --dir eventlog
+    python eventlog.py dump --dir eventlog --type audit
+"""
+
+import argparse
+import atexit
+import json
+import logging
+import mmap
+import os
+import socket
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from datetime import datetime
+
+import analytics
+import money
+
+logger = logging.getLogger(__name__)
+
+# Every record is framed as [u32 body length][u32 crc32 of body][body];
+# the body starts with a one-byte record type
+_FRAME = struct.Struct('<II')
+
+TRANSFER = 1
+SIGNUP = 2
+AUDIT = 3
+CHECKPOINT = 10
+CHECKPOINT_BALANCE = 11
+CHECKPOINT_TOTAL = 12
+CHECKPOINT_BUCKET = 13
+
+RECORD_TYPES = {
+    'transfer': TRANSFER,
+    'signup': SIGNUP,
+    'audit': AUDIT
+}
+
+# Fixed layouts so replay is one unpack_from per record. Amounts are
+# signed 128-bit (18-decimal currencies overflow 64 bits) split into
+# low/high halves; timestamps are the ISO strings the rollups bucket on.
+_TRANSFER = struct.Struct('<Bqqq4sQq26s')
+_SIGNUP = struct.Struct('<Bq26s')
+_AUDIT = struct.Struct('<Bq')
+_CHECKPOINT = struct.Struct('<Bqq26s')
+_CHECKPOINT_BALANCE = struct.Struct('<Bq4sQq')
+_CHECKPOINT_TOTAL = struct.Struct('<B16s4sQq')
+_CHECKPOINT_BUCKET = struct.Struct('<B8s26s4sqQqq')
+
+_MASK64 = (1 << 64) - 1
+
+SEGMENT_SUFFIX = '.seg'
+CHECKPOINT_SUFFIX = '.ckpt'
+
+
+class EventLogError(Exception):
+    """Raised for unreadable logs or checkpoints"""
+
+
+def _split(value):
+    """Signed integer -> (low u64, high i64)"""
+    return value & _MASK64, value >> 64
+
+
+def _join(low, high):
+    """Inverse of _split"""
+    return (high << 64) | low
+
+
+def _text(value, size):
+    """Fixed-width ASCII field"""
+    return value.encode('ascii')[:size]
+
+
+def _field(raw):
+    """Strip the padding from a fixed-width field"""
+    return raw.rstrip(b'\0').decode('ascii')
+
+
+def _frame(body):
+    """Length-prefixed, checksummed record"""
+    return _FRAME.pack(len(body), zlib.crc32(body)) + body
+
+
+def encode_transfer(result):
+    """Record for a committed ledger transfer (a result dict from the ledger)"""
+    return _frame(_TRANSFER.pack(
+        TRANSFER, result['id'], result['sender_id'], result['recipient_id'],
+        _text(result['currency'], 4), *_split(result['amount_minor']), _text(result['created_at'], 26)
+    ))
+
+
+def encode_signup(user_id, created_at):
+    """Record for a committed registration"""
+    return _frame(_SIGNUP.pack(SIGNUP, user_id, _text(created_at, 26)))
+
+
+def encode_audit(record):
+    """Record for an audit event (the payload built by audit.record)"""
+    details = {key: value for key, value in record.items() if key != 'user_id'}
+    return _frame(_AUDIT.pack(AUDIT, record.get('user_id') or 0) +
+                  json.dumps(details, separators=(',', ':')).encode())
+
+
+class EventLog:
+    """Buffered writer of segment files for one worker process.
+
+    Appends only copy the record into memory. A flusher thread writes the
+    buffer with one ``write`` and one ``fsync`` every ``flush_interval``
+    seconds (sooner once ``max_buffer_bytes`` are waiting), so durability
+    costs one fsync per interval however many events arrived. Each
+    process writes its own segment files, rotated at ``segment_bytes``,
+    so workers never contend on a file; replay does not depend on the
+    order of records across segments. Records still in the buffer when a
+    process dies are lost; ``verify`` reports the resulting drift.
+    """
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, flush_interval=0.05,
+                 max_buffer_bytes=1024 * 1024):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.flush_interval = flush_interval
+        self.max_buffer_bytes = max_buffer_bytes
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pid = None
+        self._wakeup = None
+        self._buffer = []
+        self._buffered = 0
+        self._fd = None
+        self._segment = None
+        self._segment_size = 0
+        self._segment_count = 0
+        self._stats = {'records': 0, 'bytes': 0, 'flushes': 0, 'fsync_ms_total': 0.0, 'fsync_ms_max': 0.0,
+                       'segments': 0, 'errors': 0}
+
+    def append(self, record):
+        """Queue one encoded record"""
+        self._start()
+        with self._lock:
+            self._buffer.append(record)
+            self._buffered += len(record)
+            self._stats['records'] += 1
+            full = self._buffered >= self.max_buffer_bytes
+        if full:
+            self._wakeup.set()
+
+    def transfers(self, results):
+        """Log committed ledger transfers"""
+        for result in results:
+            self.append(encode_transfer(result))
+
+    def signup(self, user_id, created_at):
+        """Log a committed registration"""
+        self.append(encode_signup(user_id, created_at))
+
+    def audit(self, record):
+        """Log an audit event"""
+        self.append(encode_audit(record))
+
+    def _start(self):
+        """Start the flusher once per worker process"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._wakeup = threading.Event()
+            self._buffer = []
+            self._buffered = 0
+            self._fd = None
+            self._segment_count = 0
+        os.makedirs(self.directory, exist_ok=True)
+        # The flusher is a daemon thread; write what is left on a clean exit
+        atexit.register(self.flush)
+        threading.Thread(target=self._flush_loop, name='eventlog-flusher', daemon=True).start()
+
+    def _flush_loop(self):
+        """Write and fsync the buffer every flush_interval"""
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except OSError:
+                with self._lock:
+                    self._stats['errors'] += 1
+                logger.exception('Event log flush failed')
+                time.sleep(self.flush_interval)
+
+    def flush(self):
+        """Write buffered records to the current segment and fsync it"""
+        with self._flush_lock:
+            with self._lock:
+                records, self._buffer = self._buffer, []
+                self._buffered = 0
+            if not records:
+                return
+            data = b''.join(records)
+            try:
+                if self._fd is None or self._segment_size >= self.segment_bytes:
+                    self._rotate()
+                os.write(self._fd, data)
+                started = time.perf_counter()
+                os.fsync(self._fd)
+                fsync_ms = (time.perf_counter() - started) * 1000
+            except OSError:
+                # Keep the records for the next attempt
+                with self._lock:
+                    self._buffer[:0] = records
+                    self._buffered += len(data)
+                raise
+            self._segment_size += len(data)
+            with self._lock:
+                self._stats['bytes'] += len(data)
+                self._stats['flushes'] += 1
+                self._stats['fsync_ms_total'] += fsync_ms
+                self._stats['fsync_ms_max'] = max(self._stats['fsync_ms_max'], fsync_ms)
+
+    def _rotate(self):
+        """Close the current segment and start a new one"""
+        if self._fd is not None:
+            os.close(self._fd)
+        self._segment_count += 1
+        # Sortable by creation time; host and pid keep writers apart
+        name = f'{time.time_ns():020d}-{socket.gethostname()}-{os.getpid()}-{self._segment_count:06d}{SEGMENT_SUFFIX}'
+        self._segment = os.path.join(self.directory, name)
+        self._fd = os.open(self._segment, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o640)
+        self._segment_size = 0
+        with self._lock:
+            self._stats['segments'] += 1
+
+    def stats(self):
+        """Snapshot of writer counters for this worker"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['buffered_bytes'] = self._buffered
+        flushes = stats['flushes']
+        stats['fsync_ms_avg'] = round(stats.pop('fsync_ms_total') / flushes, 3) if flushes else 0.0
+        stats['fsync_ms_max'] = round(stats['fsync_ms_max'], 3)
+        stats['segment'] = os.path.basename(self._segment) if self._segment else None
+        return stats
+
+
+def segments(directory):
+    """Segment paths in creation order"""
+    if not os.path.isdir(directory):
+        return []
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.endswith(SEGMENT_SUFFIX)]
+
+
+def read_records(path, check=True):
+    """Yield (record type, buffer, body start, body end) from a segment or checkpoint via mmap.
+
+    Bodies are decoded in place with ``unpack_from(buffer, start)`` and
+    must not be used after the next record is requested. Stops at a torn
+    tail (a record cut short by a crash, or one failing its checksum);
+    the returned generator's value is the number of unreadable trailing
+    bytes.
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            view = memoryview(data)
+            try:
+                offset = 0
+                unpack = _FRAME.unpack_from
+                crc32 = zlib.crc32
+                while offset + 8 <= size:
+                    length, checksum = unpack(data, offset)
+                    end = offset + 8 + length
+                    if end > size:
+                        break
+                    if check:
+                        body = view[offset + 8:end]
+                        valid = crc32(body) == checksum
+                        body.release()
+                        if not valid:
+                            break
+                    yield data[offset + 8], data, offset + 8, end
+                    offset = end
+                return size - offset
+            finally:
+                view.release()
+
+
+class ReplayState:
+    """Balances and rollups accumulated from a checkpoint plus later events"""
+
+    def __init__(self):
+        self.last_tx_id = 0
+        self.last_user_id = 0
+        self.checkpoint = None
+        self.balances = {}
+        self.totals = {}
+        self.buckets = {}
+        self._deltas = {}
+        self._minutes = {}
+        self.counts = {'transfers': 0, 'signups': 0, 'audit': 0, 'skipped': 0, 'torn_bytes': 0, 'segments': 0}
+
+    def load_checkpoint(self, path):
+        """Start from a checkpoint file"""
+        header = None
+        for kind, data, start, _ in read_records(path):
+            if kind == CHECKPOINT:
+                _, self.last_tx_id, self.last_user_id, created_at = _CHECKPOINT.unpack_from(data, start)
+                header = _field(created_at)
+            elif kind == CHECKPOINT_BALANCE:
+                _, user_id, currency, low, high = _CHECKPOINT_BALANCE.unpack_from(data, start)
+                self.balances[(user_id, _field(currency))] = _join(low, high)
+            elif kind == CHECKPOINT_TOTAL:
+                _, metric, currency, low, high = _CHECKPOINT_TOTAL.unpack_from(data, start)
+                self.totals[(_field(metric), _field(currency))] = _join(low, high)
+            elif kind == CHECKPOINT_BUCKET:
+                _, granularity, bucket, currency, tx_count, low, high, new_users = _CHECKPOINT_BUCKET.unpack_from(data, start)
+                self.buckets[(_field(granularity), _field(bucket), _field(currency))] = [
+                    tx_count, _join(low, high), new_users
+                ]
+        if header is None:
+            raise EventLogError(f'{path} is not a complete checkpoint')
+        self.checkpoint = os.path.basename(path)
+
+    def apply_segment(self, path):
+        """Fold one segment's events into the state.
+
+        The hot loop keeps raw bytes and only aggregates per wallet and per
+        minute; ``finish`` decodes those and rolls minutes up into hour and
+        day buckets and totals, so each event costs three dict updates.
+        """
+        deltas = self._deltas
+        minutes = self._minutes
+        delta = deltas.get
+        minute = minutes.get
+        last_tx_id = self.last_tx_id
+        last_user_id = self.last_user_id
+        unpack_transfer = _TRANSFER.unpack_from
+        unpack_signup = _SIGNUP.unpack_from
+        counts = self.counts
+        transfers = signups = audits = skipped = 0
+        records = read_records(path)
+        while True:
+            try:
+                kind, data, start, _ = next(records)
+            except StopIteration as stop:
+                counts['torn_bytes'] += stop.value or 0
+                break
+            if kind == TRANSFER:
+                _, tx_id, sender_id, recipient_id, currency, low, high, created_at = unpack_transfer(data, start)
+                if tx_id <= last_tx_id:
+                    skipped += 1
+                    continue
+                amount = (high << 64) | low if high else low
+                key = (sender_id, currency)
+                deltas[key] = delta(key, 0) - amount
+                key = (recipient_id, currency)
+                deltas[key] = delta(key, 0) + amount
+                key = (created_at[:16], currency)
+                bucket = minute(key)
+                if bucket is None:
+                    minutes[key] = [1, amount, 0]
+                else:
+                    bucket[0] += 1
+                    bucket[1] += amount
+                transfers += 1
+            elif kind == SIGNUP:
+                _, user_id, created_at = unpack_signup(data, start)
+                if user_id <= last_user_id:
+                    skipped += 1
+                    continue
+                key = (created_at[:16], b'')
+                bucket = minute(key)
+                if bucket is None:
+                    minutes[key] = [0, 0, 1]
+                else:
+                    bucket[2] += 1
+                signups += 1
+            elif kind == AUDIT:
+                audits += 1
+        counts['transfers'] += transfers
+        counts['signups'] += signups
+        counts['audit'] += audits
+        counts['skipped'] += skipped
+        counts['segments'] += 1
+
+    def finish(self):
+        """Merge the aggregated events into balances, totals and buckets"""
+        balances = self.balances
+        for (user_id, currency), amount in self._deltas.items():
+            key = (user_id, _field(currency))
+            balances[key] = balances.get(key, 0) + amount
+        totals = self.totals
+        buckets = self.buckets
+        granularities = list(analytics.GRANULARITIES.items())
+        for (minute, currency), (tx_count, volume, new_users) in self._minutes.items():
+            minute = _field(minute).replace(' ', 'T')
+            currency = _field(currency)
+            if currency:
+                totals[('transactions', currency)] = totals.get(('transactions', currency), 0) + tx_count
+                totals[('volume', currency)] = totals.get(('volume', currency), 0) + volume
+            if new_users:
+                totals[('users', '')] = totals.get(('users', ''), 0) + new_users
+            for granularity, length in granularities:
+                key = (granularity, minute[:length], currency)
+                bucket = buckets.setdefault(key, [0, 0, 0])
+                bucket[0] += tx_count
+                bucket[1] += volume
+                bucket[2] += new_users
+        self._deltas = {}
+        self._minutes = {}
+
+    def minute_cutoff(self, now=None):
+        """Oldest minute bucket the database still keeps"""
+        cutoff = (now or datetime.utcnow()) - analytics.MINUTE_RETENTION
+        return cutoff.isoformat()[:analytics.GRANULARITIES['minute']]
+
+
+def latest_checkpoint(directory):
+    """Path of the newest checkpoint, or None"""
+    if not os.path.isdir(directory):
+        return None
+    names = sorted(name for name in os.listdir(directory) if name.endswith(CHECKPOINT_SUFFIX))
+    return os.path.join(directory, names[-1]) if names else None
+
+
+def replay(directory):
+    """Rebuild state from the newest checkpoint and every segment"""
+    state = ReplayState()
+    checkpoint = latest_checkpoint(directory)
+    if checkpoint is not None:
+        state.load_checkpoint(checkpoint)
+    for path in segments(directory):
+        state.apply_segment(path)
+    state.finish()
+    return state
+
+
+def write_checkpoint(conn, directory):
+    """Snapshot balances and rollups into a new checkpoint file; returns its path.
+
+    Reads happen in one read transaction, so the snapshot is consistent
+    with ``last_tx_id``/``last_user_id``. Replay skips logged transfers
+    and signups at or below those ids, wherever they appear in the log,
+    so the checkpoint can be taken while workers keep writing.
+    """
+    os.makedirs(directory, exist_ok=True)
+    conn.execute('BEGIN')
+    try:
+        last_tx_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM transactions").fetchone()[0]
+        last_user_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM users").fetchone()[0]
+        created_at = datetime.utcnow().isoformat()
+        name = f'{time.time_ns():020d}-tx{last_tx_id}{CHECKPOINT_SUFFIX}'
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_frame(_CHECKPOINT.pack(CHECKPOINT, last_tx_id, last_user_id, _text(created_at, 26))))
+            rows = conn.execute(
+                'SELECT user_id, currency, balance_minor FROM wallets WHERE balance_minor != 0'
+            )
+            for user_id, currency, balance in rows:
+                f.write(_frame(_CHECKPOINT_BALANCE.pack(
+                    CHECKPOINT_BALANCE, user_id, _text(currency, 4), *_split(money.from_db(balance))
+                )))
+            for metric, currency, value in conn.execute('SELECT metric, currency, value FROM rollup_totals'):
+                f.write(_frame(_CHECKPOINT_TOTAL.pack(
+                    CHECKPOINT_TOTAL, _text(metric, 16), _text(currency, 4), *_split(money.from_db(value))
+                )))
+            for granularity, bucket, currency, tx_count, volume, new_users in conn.execute(
+                'SELECT granularity, bucket, currency, tx_count, volume_minor, new_users FROM rollup_buckets'
+            ):
+                f.write(_frame(_CHECKPOINT_BUCKET.pack(
+                    CHECKPOINT_BUCKET, _text(granularity, 8), _text(bucket, 26), _text(currency, 4),
+                    tx_count, *_split(money.from_db(volume)), new_users
+                )))
+            f.flush()
+            os.fsync(f.fileno())
+    finally:
+        conn.execute('COMMIT')
+    path = os.path.join(directory, name)
+    os.rename(temp_path, path)
+    return path
+
+
+def _database_state(conn, cutoff):
+    """Balances, totals and retained buckets as stored in SQLite"""
+    balances = {
+        (user_id, currency): money.from_db(balance)
+        for user_id, currency, balance in conn.execute('SELECT user_id, currency, balance_minor FROM wallets')
+    }
+    totals = {
+        (metric, currency): money.from_db(value)
+        for metric, currency, value in conn.execute('SELECT metric, currency, value FROM rollup_totals')
+    }
+    buckets = {
+        (granularity, bucket, currency): [tx_count, money.from_db(volume), new_users]
+        for granularity, bucket, currency, tx_count, volume, new_users in conn.execute(
+            "SELECT granularity, bucket, currency, tx_count, volume_minor, new_users FROM rollup_buckets "
+            "WHERE granularity != 'minute' OR bucket >= ?", (cutoff,)
+        )
+    }
+    return balances, totals, buckets
+
+
+def verify(conn, state, limit=20):
+    """Compare replayed state with SQLite; returns (mismatch count, sample of mismatches)"""
+    cutoff = state.minute_cutoff()
+    balances, totals, buckets = _database_state(conn, cutoff)
+    mismatches = []
+
+    def compare(kind, stored, replayed, empty, skip=None):
+        for key in stored.keys() | replayed.keys():
+            if skip is not None and skip(key):
+                continue
+            expected, actual = replayed.get(key, empty), stored.get(key, empty)
+            if expected != actual:
+                mismatches.append({'kind': kind, 'key': list(key), 'log': expected, 'database': actual})
+
+    compare('balance', balances, state.balances, 0)
+    compare('total', totals, state.totals, 0)
+    compare('bucket', buckets, state.buckets, [0, 0, 0],
+            skip=lambda key: key[0] == 'minute' and key[1] < cutoff)
+    return len(mismatches), mismatches[:limit]
+
+
+def rebuild(conn, state):
+    """Overwrite wallet balances and rollups with the replayed state in one transaction"""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('UPDATE wallets SET balance_minor = 0')
+        conn.executemany(
+            'UPDATE wallets SET balance_minor = ? WHERE user_id = ? AND currency = ?',
+            ((money.to_db(amount), user_id, currency)
+             for (user_id, currency), amount in state.balances.items() if amount)
+        )
+        conn.execute('DELETE FROM rollup_totals')
+        conn.executemany(
+            'INSERT INTO rollup_totals (metric, currency, value) VALUES (?, ?, ?)',
+            ((metric, currency, money.to_db(value)) for (metric, currency), value in state.totals.items())
+        )
+        conn.execute('DELETE FROM rollup_buckets')
+        conn.executemany(
+            'INSERT INTO rollup_buckets (granularity, bucket, currency, tx_count, volume_minor, new_users) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            ((granularity, bucket, currency, tx_count, money.to_db(volume), new_users)
+             for (granularity, bucket, currency), (tx_count, volume, new_users) in state.buckets.items())
+        )
+        analytics.prune_minute_buckets(conn)
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+
+def dump(directory, record_type=None, out=sys.stdout):
+    """Write log records as JSON lines (checkpoints excluded)"""
+    wanted = RECORD_TYPES.get(record_type) if record_type else None
+    for path in segments(directory):
+        for kind, data, start, end in read_records(path):
+            if wanted is not None and kind != wanted:
+                continue
+            if kind == TRANSFER:
+                _, tx_id, sender_id, recipient_id, currency, low, high, created_at = _TRANSFER.unpack_from(data, start)
+                record = {'type': 'transfer', 'transaction_id': tx_id, 'sender_id': sender_id,
+                          'recipient_id': recipient_id, 'currency': _field(currency),
+                          'amount_minor': str(_join(low, high)), 'created_at': _field(created_at)}
+            elif kind == SIGNUP:
+                _, user_id, created_at = _SIGNUP.unpack_from(data, start)
+                record = {'type': 'signup', 'user_id': user_id, 'created_at': _field(created_at)}
+            elif kind == AUDIT:
+                _, user_id = _AUDIT.unpack_from(data, start)
+                record = {'type': 'audit', 'user_id': user_id or None}
+                record.update(json.loads(data[start + _AUDIT.size:end]))
+            else:
+                continue
+            out.write(json.dumps(record) + '\n')
+
+
+def _connect(path):
+    """Direct connection for the command-line tool"""
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute('PRAGMA busy_timeout = 30000')
+    return conn
+
+
+def main():
+    parser = argparse.ArgumentParser(description='NomadPay event log tools')
+    parser.add_argument('command', choices=('checkpoint', 'verify', 'rebuild', 'dump'))
+    parser.add_argument('--dir', default=os.environ.get('EVENTLOG_DIR') or 'eventlog', help='event log directory')
+    parser.add_argument('--db', default=os.environ.get('DATABASE_URL', 'nomadpay.db'), help='SQLite database')
+    parser.add_argument('--type', choices=sorted(RECORD_TYPES), help='dump only this record type')
+    parser.add_argument('--force', action='store_true', help='rebuild even if verification passes')
+    args = parser.parse_args()
+
+    if args.command == 'dump':
+        dump(args.dir, args.type)
+        return
+    conn = _connect(args.db)
+    try:
+        if args.command == 'checkpoint':
+            print(write_checkpoint(conn, args.dir))
+            return
+
+        started = time.perf_counter()
+        state = replay(args.dir)
+        elapsed = time.perf_counter() - started
+        events = state.counts['transfers'] + state.counts['signups'] + state.counts['audit'] + state.counts['skipped']
+        print(f"replayed {events} events from {state.counts['segments']} segments "
+              f"(checkpoint {state.checkpoint or 'none'}) in {elapsed:.2f}s "
+              f"= {events / elapsed * 60 / 1e6 if elapsed else 0:.1f}M events/min")
+        print(json.dumps(state.counts))
+        if state.counts['torn_bytes']:
+            print(f"warning: {state.counts['torn_bytes']} bytes of torn or corrupt records were skipped")
+
+        count, sample = verify(conn, state)
+        for mismatch in sample:
+            print(json.dumps(mismatch, default=str))
+        print(f'{count} mismatches')
+        if args.command == 'verify':
+            sys.exit(1 if count else 0)
+        if count or args.force:
+            rebuild(conn, state)
+            print('rebuilt wallet balances and rollups from the log; restart workers to drop cached balances')
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
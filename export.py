@@ -0,0 +1,331 @@
+"""
+NomadPay Backend API - Admin Listings and Streaming Export
+Keyset-paginated admin queries with constant-memory NDJSON/CSV output
+"""
+
+import csv
+import io
+import json
+import logging
+import sqlite3
+
+import history
+import money
+from history import InvalidQuery
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ('json', 'ndjson', 'csv')
+
+EXPORT_BATCH_SIZE = 1000
+
+TRANSACTION_TYPES = ('transfer',)
+TRANSACTION_STATUSES = ('completed', 'pending', 'failed')
+USER_ROLES = ('user', 'admin')
+
+TRANSACTION_COLUMNS = ['id', 'user_email', 'recipient_email', 'type', 'amount', 'currency', 'status', 'created_at']
+USER_COLUMNS = ['id', 'email', 'role', 'status', 'created_at']
+
+# Email fragments shorter than one trigram match as a prefix of the email
+MIN_SEARCH_LENGTH = 3
+MAX_SEARCH_LENGTH = 254
+
+# Fragments matching more users than this (e.g. a common domain) are
+# matched row by row while walking the created_at index, which finds a
+# page sooner than sorting every match from the trigram index
+BROAD_MATCHES = 2000
+
+# Filtered user totals are counted exactly up to COUNT_CAP matches and
+# estimated from evenly spaced id windows beyond that
+COUNT_CAP = 1000
+SAMPLE_WINDOWS = 16
+SAMPLE_WIDTH = 1000
+
+# False when this SQLite build lacks FTS5 trigram support
+_email_index = True
+
+
+def init_schema(conn):
+    """Create the indexes admin listings walk in created_at order"""
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_transactions_created
+        ON transactions (created_at, id)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_transactions_currency_created
+        ON transactions (currency, created_at, id)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_users_created
+        ON users (created_at, id)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_users_role_created
+        ON users (role, created_at, id)
+    ''')
+    init_search_schema(conn)
+
+
+def init_search_schema(conn):
+    """Create the trigram index on users.email and the triggers that keep it in sync
+
+    An external-content FTS5 table stores only the index, not a second
+    copy of the emails. Existing users are indexed once, when the table
+    is first created.
+    """
+    global _email_index
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users_email_fts'"
+    ).fetchone()
+    try:
+        conn.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS users_email_fts
+            USING fts5(email, content='users', content_rowid='id', tokenize='trigram')
+        ''')
+    except sqlite3.OperationalError as e:
+        _email_index = False
+        logger.warning(f"Email search index unavailable ({e}); user search will scan the users table")
+        return
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_email_fts_insert AFTER INSERT ON users BEGIN
+            INSERT INTO users_email_fts (rowid, email) VALUES (new.id, new.email);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_email_fts_delete AFTER DELETE ON users BEGIN
+            INSERT INTO users_email_fts (users_email_fts, rowid, email) VALUES ('delete', old.id, old.email);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_email_fts_update AFTER UPDATE OF email ON users BEGIN
+            INSERT INTO users_email_fts (users_email_fts, rowid, email) VALUES ('delete', old.id, old.email);
+            INSERT INTO users_email_fts (rowid, email) VALUES (new.id, new.email);
+        END
+    ''')
+    if not exists:
+        conn.execute("INSERT INTO users_email_fts (users_email_fts) VALUES ('rebuild')")
+
+
+def parse_format(args):
+    """Output format requested with ?format="""
+    fmt = args.get('format', 'json').lower()
+    if fmt not in EXPORT_FORMATS:
+        raise InvalidQuery(f"format must be one of: {', '.join(EXPORT_FORMATS)}")
+    return fmt
+
+
+def _choice(args, name, choices):
+    """Optional enumerated filter"""
+    value = args.get(name)
+    if value and value not in choices:
+        raise InvalidQuery(f"{name} must be one of: {', '.join(choices)}")
+    return value or None
+
+
+def _keyset_clauses(alias, filters, clauses, params):
+    """Date range and cursor conditions shared by every admin listing"""
+    if filters['date_from']:
+        clauses.append(f'{alias}.created_at >= ?')
+        params.append(filters['date_from'])
+    if filters['date_to']:
+        clauses.append(f'{alias}.created_at < ?')
+        params.append(filters['date_to'])
+    if filters['cursor']:
+        clauses.append(f'({alias}.created_at, {alias}.id) < (?, ?)')
+        params.extend(filters['cursor'])
+
+
+def transactions_query(args, paginate=True):
+    """SQL, params and filters for the admin transaction listing"""
+    filters = history.parse_filters(args, types=TRANSACTION_TYPES)
+    filters['status'] = _choice(args, 'status', TRANSACTION_STATUSES)
+    clauses = []
+    params = []
+    if filters['currency']:
+        clauses.append('t.currency = ?')
+        params.append(filters['currency'])
+    if filters['type']:
+        clauses.append('t.type = ?')
+        params.append(filters['type'])
+    if filters['status']:
+        clauses.append('t.status = ?')
+        params.append(filters['status'])
+    _keyset_clauses('t', filters, clauses, params)
+
+    sql = f'''
+        SELECT t.id, t.created_at, t.reference, s.email, r.email, t.type, t.amount_minor, t.currency, t.status
+        FROM transactions t
+        LEFT JOIN users s ON s.id = t.sender_id
+        LEFT JOIN users r ON r.id = t.recipient_id
+        {'WHERE ' + ' AND '.join(clauses) if clauses else ''}
+        ORDER BY t.created_at DESC, t.id DESC
+    '''
+    if paginate:
+        sql += ' LIMIT ?'
+        params.append(filters['limit'] + 1)
+    return sql, params, filters
+
+
+def transaction_row(row):
+    """Admin transaction record from a transactions_query row"""
+    _, created_at, reference, sender_email, recipient_email, tx_type, amount, currency, status = row
+    return {
+        'id': reference,
+        'user_email': sender_email,
+        'recipient_email': recipient_email,
+        'type': tx_type,
+        'amount': money.to_number(money.from_db(amount), currency),
+        'currency': currency,
+        'status': status,
+        'created_at': created_at
+    }
+
+
+def _is_broad(conn, match):
+    """True if the trigram index has more than BROAD_MATCHES hits for the phrase"""
+    hits = conn.execute(
+        'SELECT COUNT(*) FROM (SELECT 1 FROM users_email_fts WHERE users_email_fts MATCH ? LIMIT ?)',
+        (match, BROAD_MATCHES + 1)
+    ).fetchone()[0]
+    return hits > BROAD_MATCHES
+
+
+def _email_clause(fragment, clauses, params, conn=None, search_index=True):
+    """Case-insensitive email search condition"""
+    match = '"' + fragment.replace('"', '""') + '"'
+    if len(fragment) < MIN_SEARCH_LENGTH:
+        # Too short for a trigram, and matches most users anyway: checked
+        # per row while walking the created_at index
+        clauses.append('substr(u.email, 1, ?) = ?')
+        params.extend((len(fragment), fragment))
+    elif search_index and _email_index and (conn is None or not _is_broad(conn, match)):
+        clauses.append('u.id IN (SELECT rowid FROM users_email_fts WHERE users_email_fts MATCH ?)')
+        params.append(match)
+    else:
+        clauses.append("u.email LIKE ? ESCAPE '\\'")
+        params.append('%' + fragment.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+
+
+def users_query(args, paginate=True, conn=None, search_index=True):
+    """SQL, params and filters for the admin user listing
+
+    ``q`` finds users whose email contains the fragment (any position,
+    via the trigram index) or, below three characters, starts with it.
+    Given ``conn``, fragments with many matches are checked per row
+    instead (see BROAD_MATCHES). Pass ``search_index=False`` when
+    ``users`` is a view over shards, which the index does not cover.
+    ``filters['where']`` keeps the conditions without the cursor for
+    ``count_users``.
+    """
+    filters = history.parse_filters(args, types=())
+    filters['role'] = _choice(args, 'role', USER_ROLES)
+    filters['q'] = args.get('q', '').strip().lower() or None
+    if filters['q'] and len(filters['q']) > MAX_SEARCH_LENGTH:
+        raise InvalidQuery(f'q must be at most {MAX_SEARCH_LENGTH} characters')
+    clauses = []
+    params = []
+    if filters['q']:
+        _email_clause(filters['q'], clauses, params, conn, search_index)
+    if filters['role']:
+        clauses.append('u.role = ?')
+        params.append(filters['role'])
+    where_clauses, where_params = list(clauses), list(params)
+    _keyset_clauses('u', dict(filters, cursor=None), where_clauses, where_params)
+    filters['where'] = (where_clauses, where_params)
+    _keyset_clauses('u', filters, clauses, params)
+
+    sql = f'''
+        SELECT u.id, u.created_at, u.email, u.role
+        FROM users u
+        {'WHERE ' + ' AND '.join(clauses) if clauses else ''}
+        ORDER BY u.created_at DESC, u.id DESC
+    '''
+    if paginate:
+        sql += ' LIMIT ?'
+        params.append(filters['limit'] + 1)
+    return sql, params, filters
+
+
+def user_row(row):
+    """Admin user record from a users_query row"""
+    user_id, created_at, email, role = row
+    return {
+        'id': str(user_id),
+        'email': email,
+        'role': role,
+        'status': 'active',
+        'created_at': created_at
+    }
+
+
+def count_users(conn, filters, total_users):
+    """(total, is_estimate) for a filtered user listing without counting the whole table
+
+    Unfiltered listings use the signup rollup. Otherwise matches are
+    counted exactly up to COUNT_CAP; past that the match rate inside
+    SAMPLE_WINDOWS evenly spaced id ranges is scaled to ``total_users``.
+    The windows are fixed, so the estimate is stable from page to page.
+    """
+    clauses, params = filters['where']
+    if not clauses:
+        return total_users, False
+    where = ' AND '.join(clauses)
+    matched = conn.execute(
+        f'SELECT COUNT(*) FROM (SELECT 1 FROM users u WHERE {where} LIMIT ?)', params + [COUNT_CAP + 1]
+    ).fetchone()[0]
+    if matched <= COUNT_CAP:
+        return matched, False
+
+    # Separate MIN and MAX so each is a single rowid seek, not an index scan
+    low = conn.execute('SELECT MIN(id) FROM users').fetchone()[0]
+    high = conn.execute('SELECT MAX(id) FROM users').fetchone()[0]
+    step = max((high - low + 1) // SAMPLE_WINDOWS, SAMPLE_WIDTH)
+    sampled = hits = 0
+    for start in list(range(low, high + 1, step))[:SAMPLE_WINDOWS]:
+        rows, matches = conn.execute(
+            f'SELECT COUNT(*), COALESCE(SUM({where}), 0) FROM users u WHERE u.id BETWEEN ? AND ?',
+            params + [start, start + SAMPLE_WIDTH - 1]
+        ).fetchone()
+        sampled += rows
+        hits += matches
+    if not sampled:
+        return matched, True
+    return max(matched, round(total_users * hits / sampled)), True
+
+
+def fetch_page(conn, sql, params, filters, to_record):
+    """Run a paginated listing query; returns (records, next_cursor)"""
+    rows = conn.execute(sql, params).fetchall()
+    has_more = len(rows) > filters['limit']
+    rows = rows[:filters['limit']]
+    next_cursor = history.encode_cursor(rows[-1][1], rows[-1][0]) if has_more else None
+    return [to_record(row) for row in rows], next_cursor
+
+
+def stream_export(pool, sql, params, columns, to_record, fmt, batch_size=EXPORT_BATCH_SIZE):
+    """Generator of NDJSON or CSV chunks for an unbounded listing.
+
+    Rows are pulled from a dedicated connection with ``fetchmany`` and
+    encoded one batch at a time, so memory stays flat however many rows
+    match. The connection is closed when the generator finishes or the
+    client disconnects. A dedicated connection is used so a slow download
+    does not hold one of the pool's request connections.
+    """
+    with pool.dedicated() as conn:
+        cursor = conn.execute(sql, params)
+        if fmt == 'csv':
+            buffer = io.StringIO()
+            writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction='ignore')
+            writer.writeheader()
+            yield buffer.getvalue()
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            if fmt == 'csv':
+                buffer = io.StringIO()
+                writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction='ignore')
+                writer.writerows(to_record(row) for row in rows)
+                yield buffer.getvalue()
+            else:
+                yield ''.join(json.dumps(to_record(row), separators=(',', ':')) + '\n' for row in rows)
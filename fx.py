@@ -0,0 +1,234 @@
+"""
+NomadPay Backend API - FX Rates
+Versioned exchange-rate matrix and batch valuation of multi-currency holdings
+"""
+
+import json
+import logging
+import threading
+import time
+from decimal import Decimal, InvalidOperation, ROUND_HALF_EVEN, localcontext
+from operator import mul
+
+import money
+from money import CURRENCY_SCALES
+
+logger = logging.getLogger(__name__)
+
+# Working precision for cross rates; 18-decimal minor units need headroom
+RATE_PRECISION = 50
+
+
+class FXError(Exception):
+    """Raised for malformed rate tables or unsupported conversions"""
+    status_code = 400
+
+
+class RatesUnavailable(FXError):
+    """No rate table has been loaded yet, or the newest one is too old"""
+    status_code = 503
+
+
+def init_schema(conn):
+    """Create the append-only rate table history"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS fx_rates (
+            version INTEGER PRIMARY KEY AUTOINCREMENT,
+            base TEXT NOT NULL,
+            rates TEXT NOT NULL,
+            source TEXT,
+            created_at REAL NOT NULL
+        )
+    ''')
+
+
+def parse_rates(data):
+    """Validate {"base": ..., "rates": {currency: price in base}}; returns (base, rates)"""
+    if not isinstance(data, dict) or not isinstance(data.get('rates'), dict):
+        raise FXError('rates must be an object of currency: rate')
+    base = str(data.get('base', 'USD')).upper()
+    rates = {}
+    for currency, rate in data['rates'].items():
+        currency = str(currency).upper()
+        if currency not in CURRENCY_SCALES:
+            raise FXError(f'Unsupported currency: {currency}')
+        try:
+            value = Decimal(str(rate))
+        except (InvalidOperation, ValueError):
+            raise FXError(f'Rate for {currency} must be a number')
+        if not value.is_finite() or value <= 0:
+            raise FXError(f'Rate for {currency} must be greater than zero')
+        rates[currency] = value
+    rates.setdefault(base, Decimal(1))
+    if base not in CURRENCY_SCALES or rates[base] != 1:
+        raise FXError('base must be a supported currency with a rate of 1')
+    return base, rates
+
+
+class RateTable:
+    """Immutable snapshot of one rate table version.
+
+    ``matrix[i][j]`` is the value of one minor unit of ``currencies[i]``
+    in minor units of ``currencies[j]``, with the currency scales folded
+    in. Valuing a holdings vector into a base currency is then a single
+    dot product against that base's column, with one rounding at the end.
+    """
+
+    __slots__ = ('version', 'base', 'rates', 'created_at', 'currencies', 'index', 'matrix', 'columns')
+
+    def __init__(self, version, base, rates, created_at):
+        self.version = version
+        self.base = base
+        self.rates = rates
+        self.created_at = created_at
+        self.currencies = tuple(sorted(rates))
+        self.index = {currency: i for i, currency in enumerate(self.currencies)}
+        with localcontext() as ctx:
+            ctx.prec = RATE_PRECISION
+            unit_values = [
+                rates[currency].scaleb(-CURRENCY_SCALES[currency]) for currency in self.currencies
+            ]
+            self.matrix = [
+                [value / unit_values[j] for j in range(len(self.currencies))] for value in unit_values
+            ]
+        self.columns = {
+            currency: tuple(row[j] for row in self.matrix) for j, currency in enumerate(self.currencies)
+        }
+
+    def vector(self, units_by_currency):
+        """Holdings aligned to this table's currency order; returns (vector, unpriced currencies)"""
+        vector = [0] * len(self.currencies)
+        unpriced = []
+        for currency, units in units_by_currency.items():
+            i = self.index.get(currency)
+            if i is None:
+                if units:
+                    unpriced.append(currency)
+            else:
+                vector[i] = units
+        return vector, unpriced
+
+    def value(self, vector, base):
+        """Total of a holdings vector in base minor units"""
+        column = self.columns.get(base)
+        if column is None:
+            raise FXError(f'No rate for {base}')
+        with localcontext() as ctx:
+            ctx.prec = RATE_PRECISION
+            total = sum(map(mul, vector, column), Decimal(0))
+            return int(total.to_integral_value(ROUND_HALF_EVEN))
+
+    def valuation(self, units_by_currency, base):
+        """JSON-ready total of holdings in base"""
+        vector, unpriced = self.vector(units_by_currency)
+        total = self.value(vector, base)
+        return {
+            'currency': base,
+            'value': money.to_number(total, base),
+            'fx_version': self.version,
+            'unpriced': unpriced
+        }
+
+    def to_dict(self):
+        """Rate table as served by the admin API"""
+        return {
+            'version': self.version,
+            'base': self.base,
+            'rates': {currency: str(rate) for currency, rate in sorted(self.rates.items())},
+            'created_at': self.created_at
+        }
+
+
+class FXRates:
+    """Current rate table for this worker.
+
+    Tables are published to ``fx_rates`` (one row per version) so every
+    worker converges on the newest one: ``current()`` checks the latest
+    version at most once per ``refresh_interval`` and rebuilds the matrix
+    only when it changed. ``require()`` also refuses a table published
+    more than ``max_age`` seconds ago (0 disables the check).
+    """
+
+    def __init__(self, pool, refresh_interval=5.0, max_age=0.0):
+        self.pool = pool
+        self.refresh_interval = refresh_interval
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._table = None
+        self._next_check = 0.0
+        self._stats = {'checks': 0, 'reloads': 0, 'published': 0, 'stale': 0}
+
+    def current(self):
+        """Latest RateTable, or None if none has been published"""
+        now = time.monotonic()
+        if now >= self._next_check:
+            with self._lock:
+                if now >= self._next_check:
+                    self._next_check = now + self.refresh_interval
+                    self._stats['checks'] += 1
+                    self._refresh()
+        return self._table
+
+    def require(self):
+        """Latest RateTable; raises RatesUnavailable if none is loaded or it is stale"""
+        table = self.current()
+        if table is None:
+            raise RatesUnavailable('FX rates have not been loaded')
+        if self.max_age and time.time() - table.created_at > self.max_age:
+            self._count('stale')
+            raise RatesUnavailable('FX rates are out of date')
+        return table
+
+    def _refresh(self):
+        """Load the newest version if it differs from the one in memory (lock held)"""
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                'SELECT version, base, rates, created_at FROM fx_rates ORDER BY version DESC LIMIT 1'
+            ).fetchone()
+        if row is None or (self._table is not None and self._table.version == row[0]):
+            return
+        version, base, rates, created_at = row
+        self._table = RateTable(version, base, {c: Decimal(r) for c, r in json.loads(rates).items()}, created_at)
+        self._stats['reloads'] += 1
+
+    def publish(self, data, source='admin'):
+        """Validate and store a new rate table version; returns the RateTable"""
+        base, rates = parse_rates(data)
+        created_at = time.time()
+        with self.pool.transaction() as conn:
+            cursor = conn.execute(
+                'INSERT INTO fx_rates (base, rates, source, created_at) VALUES (?, ?, ?, ?)',
+                (base, json.dumps({c: str(r) for c, r in rates.items()}, sort_keys=True), source, created_at)
+            )
+        table = RateTable(cursor.lastrowid, base, rates, created_at)
+        with self._lock:
+            if self._table is None or table.version > self._table.version:
+                self._table = table
+            self._stats['published'] += 1
+        return table
+
+    def load_file(self, path):
+        """Publish rates from a JSON file unless they match the current table"""
+        with open(path) as f:
+            data = json.load(f)
+        base, rates = parse_rates(data)
+        table = self.current()
+        if table is not None and table.base == base and table.rates == rates:
+            return table
+        logger.info(f'Loading FX rates from {path}')
+        return self.publish(data, source=f'file:{path}')
+
+    def _count(self, name):
+        """Increment a counter"""
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self):
+        """Snapshot of rate table counters"""
+        table = self._table
+        with self._lock:
+            stats = dict(self._stats)
+        stats['version'] = table.version if table else None
+        stats['currencies'] = len(table.currencies) if table else 0
+        stats['age'] = round(time.time() - table.created_at, 1) if table else None
+        return stats
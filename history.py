@@ -0,0 +1,183 @@
+"""
+NomadPay Backend API - Transaction History
+Keyset-paginated history queries over the ledger
+"""
+
+import base64
+import binascii
+import json
+from datetime import datetime
+
+import money
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+ENTRY_TYPES = ('send', 'receive')
+
+
+class InvalidQuery(Exception):
+    """Raised for malformed paging or filter parameters"""
+
+
+def init_schema(conn):
+    """Create the composite indexes the history queries seek on"""
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_ledger_entries_user_created
+        ON ledger_entries (user_id, created_at, id)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_ledger_entries_user_currency_created
+        ON ledger_entries (user_id, currency, created_at, id)
+    ''')
+    # Event streams read a user's entries by id
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_ledger_entries_user
+        ON ledger_entries (user_id)
+    ''')
+
+
+def encode_cursor(created_at, row_id):
+    """Opaque cursor pointing just past the given row"""
+    raw = json.dumps([created_at, row_id], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor; raises InvalidQuery on tampered input"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if not isinstance(created_at, str) or not isinstance(row_id, int):
+            raise ValueError('bad cursor shape')
+        return created_at, row_id
+    except (ValueError, TypeError, binascii.Error):
+        raise InvalidQuery('Invalid cursor')
+
+
+def parse_date(value, name):
+    """Validate an ISO-8601 date/datetime filter"""
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).replace(tzinfo=None).isoformat()
+    except ValueError:
+        raise InvalidQuery(f'{name} must be an ISO-8601 date')
+
+
+def parse_filters(args, types=ENTRY_TYPES):
+    """Extract paging and filter options from request query parameters"""
+    try:
+        limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise InvalidQuery('limit must be an integer')
+    if limit < 1:
+        raise InvalidQuery('limit must be positive')
+
+    entry_type = args.get('type')
+    if entry_type and entry_type not in types:
+        raise InvalidQuery(f"type must be one of: {', '.join(types)}")
+
+    cursor = args.get('cursor')
+    return {
+        'limit': min(limit, MAX_PAGE_SIZE),
+        'cursor': decode_cursor(cursor) if cursor else None,
+        'currency': args.get('currency', '').upper() or None,
+        'type': entry_type or None,
+        'date_from': parse_date(args['from'], 'from') if args.get('from') else None,
+        'date_to': parse_date(args['to'], 'to') if args.get('to') else None
+    }
+
+
+def fetch_entries(conn, user_id, filters, resolve_emails=None):
+    """Return one page of a user's ledger entries, newest first.
+
+    The WHERE clause always leads with user_id (and currency when given)
+    so SQLite seeks straight into the composite index and walks it
+    backwards from the cursor position. Page N therefore costs the same
+    as page 1. ``resolve_emails(user_ids)`` names counterparties whose
+    users row is not in this database (another shard).
+    """
+    clauses = ['e.user_id = ?']
+    params = [user_id]
+    if filters['currency']:
+        clauses.append('e.currency = ?')
+        params.append(filters['currency'])
+    if filters['type'] == 'send':
+        clauses.append('e.user_id = t.sender_id')
+    elif filters['type'] == 'receive':
+        clauses.append('e.user_id = t.recipient_id')
+    if filters['date_from']:
+        clauses.append('e.created_at >= ?')
+        params.append(filters['date_from'])
+    if filters['date_to']:
+        clauses.append('e.created_at < ?')
+        params.append(filters['date_to'])
+    if filters['cursor']:
+        clauses.append('(e.created_at, e.id) < (?, ?)')
+        params.extend(filters['cursor'])
+    params.append(filters['limit'] + 1)
+
+    rows = conn.execute(f'''
+        SELECT e.id, e.created_at, e.currency, e.amount_minor, e.balance_after_minor,
+               t.reference, t.status, t.description, u.email,
+               CASE WHEN e.user_id = t.sender_id THEN t.recipient_id ELSE t.sender_id END
+        FROM ledger_entries e
+        JOIN transactions t ON t.id = e.transaction_id
+        LEFT JOIN users u ON u.id = CASE WHEN e.user_id = t.sender_id THEN t.recipient_id ELSE t.sender_id END
+        WHERE {' AND '.join(clauses)}
+        ORDER BY e.created_at DESC, e.id DESC
+        LIMIT ?
+    ''', params).fetchall()
+
+    has_more = len(rows) > filters['limit']
+    rows = rows[:filters['limit']]
+    next_cursor = encode_cursor(rows[-1][1], rows[-1][0]) if has_more else None
+
+    return _entries(rows, resolve_emails), next_cursor
+
+
+def fetch_entries_after(conn, user_id, after_id, limit, resolve_emails=None):
+    """Return a user's ledger entries with ids above after_id, oldest first"""
+    rows = conn.execute('''
+        SELECT e.id, e.created_at, e.currency, e.amount_minor, e.balance_after_minor,
+               t.reference, t.status, t.description, u.email,
+               CASE WHEN e.user_id = t.sender_id THEN t.recipient_id ELSE t.sender_id END
+        FROM ledger_entries e
+        JOIN transactions t ON t.id = e.transaction_id
+        LEFT JOIN users u ON u.id = CASE WHEN e.user_id = t.sender_id THEN t.recipient_id ELSE t.sender_id END
+        WHERE e.user_id = ? AND e.id > ?
+        ORDER BY e.id
+        LIMIT ?
+    ''', (user_id, after_id, limit)).fetchall()
+    return _entries(rows, resolve_emails)
+
+
+def latest_entry_id(conn, user_id):
+    """Id of a user's newest ledger entry, or 0 if there is none"""
+    return conn.execute(
+        'SELECT COALESCE(MAX(id), 0) FROM ledger_entries WHERE user_id = ?', (user_id,)
+    ).fetchone()[0]
+
+
+def _entries(rows, resolve_emails):
+    """Entries for rows, filling in counterparties missing from the local users table"""
+    missing = {row[9] for row in rows if row[8] is None and row[9] is not None}
+    emails = resolve_emails(missing) if missing and resolve_emails is not None else {}
+    return [_entry(row[:8] + (row[8] or emails.get(row[9]),)) for row in rows]
+
+
+def _entry(row):
+    """Ledger entry row as returned to callers"""
+    entry_id, created_at, currency, amount, balance_after, reference, status, description, counterparty = row
+    amount = money.from_db(amount)
+    return {
+        'entry_id': entry_id,
+        'transaction_id': reference,
+        'type': 'send' if amount < 0 else 'receive',
+        'amount': money.to_number(abs(amount), currency),
+        'currency': currency,
+        'balance_after': money.to_number(money.from_db(balance_after), currency),
+        'counterparty': counterparty,
+        'status': status,
+        'description': description,
+        'date': created_at
+    }
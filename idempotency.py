@@ -0,0 +1,333 @@
+"""
+NomadPay Backend API - Idempotency Keys
+Stores first responses for Idempotency-Key requests and replays them on retry
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+MAX_KEY_LENGTH = 255
+
+# Handlers return 503 when a payment's outcome is unknown (LedgerUnavailable:
+# the writer may still commit it), so the key is kept rather than released
+UNKNOWN_OUTCOME_STATUS = 503
+
+# Replayed for a key whose payment committed but whose response was never
+# stored (the worker died in between)
+APPLIED_BODY = json.dumps({
+    'success': False,
+    'message': 'This request was already processed; check transaction history for its result'
+})
+
+
+class IdempotencyError(Exception):
+    """Raised when a keyed request cannot be executed or replayed"""
+    status_code = 409
+
+
+class IdempotencyConflict(IdempotencyError):
+    """The key was already used for a different request body"""
+    status_code = 422
+
+
+class IdempotencyInProgress(IdempotencyError):
+    """Another request with the same key did not finish in time"""
+    status_code = 409
+
+
+def init_schema(conn):
+    """Create the stored response table"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            key TEXT PRIMARY KEY,
+            fingerprint TEXT NOT NULL,
+            state TEXT NOT NULL,
+            status INTEGER,
+            body TEXT,
+            content_type TEXT,
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires
+        ON idempotency_keys (expires_at)
+    ''')
+
+
+class Claim:
+    """A running request's hold on its key, passed to the handler"""
+
+    __slots__ = ('key', 'created_at')
+
+    def __init__(self, key, created_at):
+        self.key = key
+        self.created_at = created_at
+
+    def mark_applied(self, conn):
+        """Record inside the payment's transaction that its side effects committed.
+
+        Use as the ledger's ``on_apply`` hook: the key then moves to
+        ``applied`` atomically with the transfer, so neither a crash nor a
+        5xx response can let a retry run the payment again. Raises
+        IdempotencyInProgress (rolling the payment back) if the claim was
+        taken over after ``lock_timeout``.
+        """
+        cursor = conn.execute('''
+            UPDATE idempotency_keys SET state = 'applied'
+            WHERE key = ? AND created_at = ? AND state = 'pending'
+        ''', (self.key, self.created_at))
+        if cursor.rowcount != 1:
+            raise IdempotencyInProgress('Idempotency-Key was claimed by another request')
+
+    def release(self, conn):
+        """Give the key back inside the transaction that aborts the payment.
+
+        Use as the sharded ledger's ``on_abort`` hook: a cross-shard
+        transfer marks the key with its prepared debit, and if the transfer
+        is then aborted no money moved, so the row is deleted and a retry
+        runs the payment instead of being told it was processed.
+        """
+        conn.execute('DELETE FROM idempotency_keys WHERE key = ? AND created_at = ?',
+                     (self.key, self.created_at))
+
+
+def fingerprint(method, path, body):
+    """Hash identifying the request a key was first used for"""
+    digest = hashlib.sha256()
+    digest.update(f'{method} {path}\n'.encode())
+    digest.update(body)
+    return digest.hexdigest()
+
+
+class IdempotencyStore:
+    """Execute-once store for keyed requests.
+
+    The first request for a key claims it with a ``pending`` row, runs
+    ``handler(claim)``, and saves its status and body. Retries are served
+    from an in-process LRU (or the table, from other workers) without
+    running the handler. Duplicates that arrive while the first is still
+    running wait for it: in the same worker on an Event, across workers by
+    polling the row.
+
+    Handlers that move money pass ``claim.mark_applied`` to the ledger, so
+    the row becomes ``applied`` in the payment's own transaction. Server
+    errors (5xx) release the key for a retry only while it is still
+    ``pending``; a 503 (UNKNOWN_OUTCOME_STATUS) keeps it, since the payment
+    may still commit, and an applied key stores APPLIED_BODY instead of the
+    error. Pending rows older than ``lock_timeout`` are treated as
+    abandoned and can be claimed again; the claim's ``created_at`` fences
+    the old owner, whose ``mark_applied`` then fails. Applied rows left
+    without a response by a crash are answered with APPLIED_BODY.
+    """
+
+    def __init__(self, pool, ttl=86400.0, wait_timeout=10.0, lock_timeout=30.0,
+                 hot_size=10000, sweep_interval=60.0, sweep_batch=1000):
+        self.pool = pool
+        self.ttl = ttl
+        self.wait_timeout = wait_timeout
+        self.lock_timeout = lock_timeout
+        self.hot_size = hot_size
+        self.sweep_interval = sweep_interval
+        self.sweep_batch = sweep_batch
+        self._lock = threading.Lock()
+        self._hot = OrderedDict()
+        self._inflight = {}
+        self._sweeper_pid = None
+        self._stats = {'executed': 0, 'replayed': 0, 'waited': 0, 'conflicts': 0,
+                       'released': 0, 'unknown': 0, 'swept': 0}
+
+    def execute(self, key, request_fingerprint, handler):
+        """Run handler(claim) at most once per key; returns (status, body, content_type, replayed)"""
+        self._ensure_sweeper()
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            stored = self._hot_get(key)
+            if stored is not None:
+                return self._replay(stored, request_fingerprint)
+
+            with self._lock:
+                event = self._inflight.get(key)
+                if event is None:
+                    event = self._inflight[key] = threading.Event()
+                    owner = True
+                else:
+                    owner = False
+            if not owner:
+                self._count('waited')
+                if not event.wait(max(0.0, deadline - time.monotonic())):
+                    raise IdempotencyInProgress('A request with this Idempotency-Key is still in progress')
+                continue
+
+            try:
+                stored = self._claim(key, request_fingerprint)
+                if isinstance(stored, Claim):
+                    return self._run(stored, request_fingerprint, handler)
+            finally:
+                with self._lock:
+                    self._inflight.pop(key, None)
+                event.set()
+
+            if stored != 'pending':
+                self._hot_put(key, stored)
+                return self._replay(stored, request_fingerprint)
+
+            # Another worker owns the key; poll until it stores a result
+            self._count('waited')
+            if time.monotonic() >= deadline:
+                raise IdempotencyInProgress('A request with this Idempotency-Key is still in progress')
+            time.sleep(0.05)
+
+    def _claim(self, key, request_fingerprint):
+        """Insert a pending row; returns a Claim, 'pending' or the stored response"""
+        now = time.time()
+        with self.pool.transaction() as conn:
+            row = conn.execute(
+                'SELECT fingerprint, state, status, body, content_type, created_at, expires_at '
+                'FROM idempotency_keys WHERE key = ?',
+                (key,)
+            ).fetchone()
+            if row is not None and row[6] > now:
+                if row[1] == 'done':
+                    return row[:5]
+                if now - row[5] < self.lock_timeout:
+                    return 'pending'
+                if row[1] == 'applied':
+                    return row[0], 'done', 409, APPLIED_BODY, 'application/json'
+            conn.execute('''
+                INSERT OR REPLACE INTO idempotency_keys (key, fingerprint, state, created_at, expires_at)
+                VALUES (?, ?, 'pending', ?, ?)
+            ''', (key, request_fingerprint, now, now + self.ttl))
+        return Claim(key, now)
+
+    def _run(self, claim, request_fingerprint, handler):
+        """Execute the handler for a claimed key and store the outcome"""
+        try:
+            status, body, content_type = handler(claim)
+        except BaseException:
+            self._settle(claim, None, None, None)
+            raise
+        self._count('executed')
+        stored = self._settle(claim, status, body, content_type)
+        if stored is not None:
+            self._hot_put(claim.key, (request_fingerprint, 'done') + stored)
+        return status, body, content_type, False
+
+    def _settle(self, claim, status, body, content_type):
+        """Store the response, keep the key or release it; returns what was stored, if anything"""
+        with self.pool.transaction() as conn:
+            row = conn.execute(
+                'SELECT state FROM idempotency_keys WHERE key = ? AND created_at = ?',
+                (claim.key, claim.created_at)
+            ).fetchone()
+            if row is None:
+                # Taken over after lock_timeout (the new owner decides) or
+                # released by an aborted payment
+                return None
+            if status is None or status >= 500:
+                if row[0] == 'applied':
+                    # The money moved but the response is an error: retries
+                    # are told it was processed instead of seeing the error
+                    status, body, content_type = 409, APPLIED_BODY, 'application/json'
+                elif status == UNKNOWN_OUTCOME_STATUS:
+                    # The payment may still commit: hold the key until lock_timeout
+                    self._count('unknown')
+                    return None
+                else:
+                    conn.execute('DELETE FROM idempotency_keys WHERE key = ? AND created_at = ?',
+                                 (claim.key, claim.created_at))
+                    self._count('released')
+                    return None
+            conn.execute('''
+                UPDATE idempotency_keys SET state = 'done', status = ?, body = ?, content_type = ?
+                WHERE key = ? AND created_at = ?
+            ''', (status, body, content_type, claim.key, claim.created_at))
+        return status, body, content_type
+
+    def _replay(self, stored, request_fingerprint):
+        """Return a stored response, refusing it for a different request"""
+        if stored[0] != request_fingerprint:
+            self._count('conflicts')
+            raise IdempotencyConflict('Idempotency-Key was already used for a different request')
+        self._count('replayed')
+        return stored[2], stored[3], stored[4], True
+
+    def _hot_get(self, key):
+        """Look up a completed response in the in-process cache"""
+        with self._lock:
+            entry = self._hot.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._hot[key]
+                return None
+            self._hot.move_to_end(key)
+            return entry[1]
+
+    def _hot_put(self, key, stored):
+        """Cache a completed response"""
+        with self._lock:
+            self._hot[key] = (time.monotonic() + self.ttl, stored)
+            self._hot.move_to_end(key)
+            while len(self._hot) > self.hot_size:
+                self._hot.popitem(last=False)
+
+    def sweep(self):
+        """Delete expired keys in batches; returns the number removed"""
+        removed = 0
+        now = time.time()
+        while True:
+            with self.pool.transaction() as conn:
+                cursor = conn.execute('''
+                    DELETE FROM idempotency_keys WHERE key IN (
+                        SELECT key FROM idempotency_keys WHERE expires_at < ? LIMIT ?
+                    )
+                ''', (now, self.sweep_batch))
+                deleted = cursor.rowcount
+            removed += deleted
+            if deleted < self.sweep_batch:
+                break
+            # Let request writers in between batches
+            time.sleep(0.01)
+        with self._lock:
+            self._stats['swept'] += removed
+        return removed
+
+    def _ensure_sweeper(self):
+        """Start the background sweeper once per worker process"""
+        if self._sweeper_pid == os.getpid():
+            return
+        with self._lock:
+            if self._sweeper_pid == os.getpid():
+                return
+            self._sweeper_pid = os.getpid()
+        threading.Thread(target=self._sweep_loop, name='idempotency-sweeper', daemon=True).start()
+
+    def _sweep_loop(self):
+        """Periodically purge expired keys"""
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception('Idempotency key sweep failed')
+
+    def _count(self, name):
+        """Increment a counter"""
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self):
+        """Snapshot of idempotency counters"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['hot_entries'] = len(self._hot)
+            stats['in_flight'] = len(self._inflight)
+        return stats
@@ -0,0 +1,391 @@
+"""
+NomadPay Backend API - Background Jobs
+Durable SQLite job queue with priority lanes, retries and an in-process worker pool
+"""
+
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Lane name -> priority (lower runs first)
+LANES = {
+    'high': 0,
+    'default': 1,
+    'low': 2
+}
+
+
+class JobError(Exception):
+    """Raised for jobs that cannot be enqueued or retried"""
+    status_code = 400
+
+
+def init_schema(conn):
+    """Create the job table and the indexes the dispatcher claims from"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            priority INTEGER NOT NULL DEFAULT 1,
+            state TEXT NOT NULL DEFAULT 'ready',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 5,
+            run_at REAL NOT NULL,
+            locked_until REAL,
+            created_at REAL NOT NULL,
+            last_error TEXT
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_jobs_ready
+        ON jobs (state, priority, run_at)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_jobs_locked
+        ON jobs (state, locked_until)
+    ''')
+
+
+def _row(kind, payload, lane, delay, max_attempts, now):
+    """Insert parameters for one job"""
+    if lane not in LANES:
+        raise JobError(f"lane must be one of: {', '.join(LANES)}")
+    return (kind, json.dumps(payload, separators=(',', ':')), LANES[lane], now + delay, max_attempts, now)
+
+
+_INSERT = '''
+    INSERT INTO jobs (kind, payload, priority, run_at, max_attempts, created_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+
+def enqueue(conn, kind, payload, lane='default', delay=0.0, max_attempts=5):
+    """Add a job inside the caller's transaction, so it commits (or not) with the caller's writes"""
+    conn.execute(_INSERT, _row(kind, payload, lane, delay, max_attempts, time.time()))
+
+
+class JobQueue:
+    """Runs queued jobs on a pool of threads in every worker.
+
+    One dispatcher thread per worker process claims up to ``batch_size``
+    due jobs in a single write transaction, highest lane first, marking
+    them running until ``visibility_timeout`` from now. If the worker dies
+    the lock lapses and any worker claims the job again, so handlers must
+    be idempotent. A failed job is retried with exponential backoff until
+    ``max_attempts``, then left in the ``dead`` state for an operator.
+    Completions and failures are written back by the dispatcher in one
+    transaction per round.
+
+    ``enqueue(..., conn=conn)`` writes the job in the caller's transaction;
+    call ``wake()`` after it commits. Without ``conn`` the job is buffered
+    in memory and the dispatcher writes the buffer in one insert at most
+    once every ``flush_interval`` seconds, which keeps the insert off the request thread at the cost of
+    losing buffered jobs if the process crashes before the flush.
+    Handlers registered with ``batch=True`` get every claimed payload of
+    their kind in one call.
+    """
+
+    def __init__(self, pool, workers=2, batch_size=32, poll_interval=1.0, flush_interval=0.05,
+                 visibility_timeout=60.0, backoff_base=1.0, backoff_max=300.0, max_buffer=10000,
+                 depth_interval=5.0):
+        self.pool = pool
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.flush_interval = flush_interval
+        self.visibility_timeout = visibility_timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_buffer = max_buffer
+        self.depth_interval = depth_interval
+        self._handlers = {}
+        self._lock = threading.Lock()
+        self._pid = None
+        self._wakeup = None
+        self._executor = None
+        self._buffer = []
+        self._outcomes = []
+        self._running = 0
+        self._depth = None
+        self._depth_at = 0.0
+        self._stats = {
+            'enqueued': 0, 'claimed': 0, 'completed': 0, 'retried': 0, 'dead': 0, 'reclaimed': 0,
+            'wait_ms_total': 0.0, 'wait_ms_max': 0.0, 'run_ms_total': 0.0, 'run_ms_max': 0.0
+        }
+
+    def handler(self, kind, batch=False):
+        """Register the function that runs jobs of this kind"""
+        def register(fn):
+            self._handlers[kind] = (fn, batch)
+            return fn
+        return register
+
+    def enqueue(self, kind, payload, lane='default', conn=None, delay=0.0, max_attempts=5):
+        """Queue a job; see the class docstring for conn"""
+        if kind not in self._handlers:
+            raise JobError(f'Unknown job kind: {kind}')
+        row = _row(kind, payload, lane, delay, max_attempts, time.time())
+        if conn is not None:
+            conn.execute(_INSERT, row)
+            self._count('enqueued')
+            return
+        self._start()
+        with self._lock:
+            first = not self._buffer
+            self._buffer.append(row)
+            self._stats['enqueued'] += 1
+            overflow = len(self._buffer) >= self.max_buffer
+        if overflow:
+            # Dispatcher is behind; pay for the insert here rather than grow without bound
+            self._flush()
+        if first:
+            self._wakeup.set()
+
+    def wake(self):
+        """Claim newly committed jobs now instead of at the next poll"""
+        self._start()
+        self._wakeup.set()
+
+    def _start(self):
+        """Start the dispatcher and worker pool once per worker process"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._wakeup = threading.Event()
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='jobs')
+            self._buffer = []
+            self._outcomes = []
+            self._running = 0
+        threading.Thread(target=self._dispatch_loop, name='jobs-dispatcher', daemon=True).start()
+
+    def _dispatch_loop(self):
+        """Flush, record outcomes and claim work until the process exits"""
+        last_flush = 0.0
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            with self._lock:
+                buffered = bool(self._buffer)
+            if buffered:
+                # Let jobs from concurrent requests accumulate into one insert
+                remaining = last_flush + self.flush_interval - time.monotonic()
+                if remaining > 0:
+                    time.sleep(remaining)
+                last_flush = time.monotonic()
+            try:
+                self._flush()
+                self._record_outcomes()
+                self._claim_and_run()
+            except Exception:
+                logger.exception('Job dispatch failed')
+                time.sleep(self.poll_interval)
+
+    def _flush(self):
+        """Write buffered jobs in one transaction"""
+        with self._lock:
+            rows, self._buffer = self._buffer, []
+        if not rows:
+            return
+        try:
+            with self.pool.transaction() as conn:
+                conn.executemany(_INSERT, rows)
+        except Exception:
+            with self._lock:
+                self._buffer[:0] = rows
+            raise
+
+    def _claim_and_run(self):
+        """Claim due jobs up to the free capacity of the pool and submit them"""
+        with self._lock:
+            capacity = min(self.batch_size, self.workers * 2 - self._running)
+        if capacity <= 0:
+            return
+        now = time.time()
+        with self.pool.transaction() as conn:
+            reclaimed = conn.execute(
+                "UPDATE jobs SET state = 'ready', run_at = ? WHERE state = 'running' AND locked_until < ?",
+                (now, now)
+            ).rowcount
+            rows = conn.execute('''
+                SELECT id, kind, payload, attempts, max_attempts, run_at
+                FROM jobs WHERE state = 'ready' AND run_at <= ?
+                ORDER BY priority, run_at LIMIT ?
+            ''', (now, capacity)).fetchall()
+            if rows:
+                conn.executemany(
+                    "UPDATE jobs SET state = 'running', attempts = attempts + 1, locked_until = ? WHERE id = ?",
+                    [(now + self.visibility_timeout, row[0]) for row in rows]
+                )
+        if reclaimed:
+            self._count('reclaimed', reclaimed)
+        if not rows:
+            return
+
+        groups = {}
+        for job_id, kind, payload, attempts, max_attempts, run_at in rows:
+            job = (job_id, json.loads(payload), attempts + 1, max_attempts)
+            if kind not in self._handlers:
+                # Queued by a different release; fail it into the retry path
+                with self._lock:
+                    self._outcomes.append((job, JobError(f'No handler for {kind}'), 0.0))
+                continue
+            wait_ms = max(now - run_at, 0.0) * 1000
+            with self._lock:
+                self._stats['claimed'] += 1
+                self._stats['wait_ms_total'] += wait_ms
+                self._stats['wait_ms_max'] = max(self._stats['wait_ms_max'], wait_ms)
+            fn, batch = self._handlers[kind]
+            if batch:
+                groups.setdefault(kind, []).append(job)
+            else:
+                self._submit(fn, [job], batch=False)
+        for kind, group in groups.items():
+            self._submit(self._handlers[kind][0], group, batch=True)
+        if self._outcomes:
+            self._wakeup.set()
+
+    def _submit(self, fn, group, batch):
+        """Run one job (or one batch of a kind) on the pool"""
+        with self._lock:
+            self._running += 1
+        self._executor.submit(self._run, fn, group, batch)
+
+    def _run(self, fn, group, batch):
+        """Call the handler and queue the outcome for the dispatcher"""
+        started = time.perf_counter()
+        error = None
+        try:
+            if batch:
+                fn([job[1] for job in group])
+            else:
+                fn(group[0][1])
+        except Exception as e:
+            error = e
+        run_ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            self._running -= 1
+            self._outcomes.extend((job, error, run_ms) for job in group)
+        self._wakeup.set()
+
+    def _record_outcomes(self):
+        """Delete finished jobs and schedule retries in one transaction"""
+        with self._lock:
+            outcomes, self._outcomes = self._outcomes, []
+        if not outcomes:
+            return
+        done, retry, dead = [], [], []
+        now = time.time()
+        for (job_id, _, attempts, max_attempts), error, run_ms in outcomes:
+            if error is None:
+                done.append((job_id,))
+                continue
+            message = f'{type(error).__name__}: {error}'[:1000]
+            if attempts >= max_attempts:
+                logger.error(f'Job {job_id} failed permanently after {attempts} attempts: {message}')
+                dead.append((message, job_id))
+            else:
+                delay = min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1))
+                retry.append((now + delay * random.uniform(0.5, 1.0), message, job_id))
+        try:
+            with self.pool.transaction() as conn:
+                conn.executemany('DELETE FROM jobs WHERE id = ?', done)
+                conn.executemany(
+                    "UPDATE jobs SET state = 'ready', run_at = ?, locked_until = NULL, last_error = ? WHERE id = ?",
+                    retry
+                )
+                conn.executemany(
+                    "UPDATE jobs SET state = 'dead', locked_until = NULL, last_error = ? WHERE id = ?",
+                    dead
+                )
+        except Exception:
+            with self._lock:
+                self._outcomes[:0] = outcomes
+            raise
+        with self._lock:
+            self._stats['completed'] += len(done)
+            self._stats['retried'] += len(retry)
+            self._stats['dead'] += len(dead)
+            for _, error, run_ms in outcomes:
+                self._stats['run_ms_total'] += run_ms
+                self._stats['run_ms_max'] = max(self._stats['run_ms_max'], run_ms)
+
+    def retry_dead(self, job_id):
+        """Put a dead job back in its lane with a fresh attempt budget"""
+        with self.pool.transaction() as conn:
+            updated = conn.execute(
+                "UPDATE jobs SET state = 'ready', attempts = 0, run_at = ?, last_error = NULL "
+                "WHERE id = ? AND state = 'dead'",
+                (time.time(), job_id)
+            ).rowcount
+        if not updated:
+            raise JobError(f'Job {job_id} is not dead')
+        self.wake()
+
+    def dead_jobs(self, limit=50):
+        """Most recent jobs that exhausted their attempts"""
+        with self.pool.connection() as conn:
+            rows = conn.execute('''
+                SELECT id, kind, payload, priority, attempts, created_at, last_error
+                FROM jobs WHERE state = 'dead' ORDER BY id DESC LIMIT ?
+            ''', (limit,)).fetchall()
+        lanes = {priority: lane for lane, priority in LANES.items()}
+        return [{
+            'id': job_id,
+            'kind': kind,
+            'payload': json.loads(payload),
+            'lane': lanes.get(priority, str(priority)),
+            'attempts': attempts,
+            'created_at': created_at,
+            'last_error': last_error
+        } for job_id, kind, payload, priority, attempts, created_at, last_error in rows]
+
+    def depth(self):
+        """Queued jobs per lane and state, refreshed at most every depth_interval seconds"""
+        now = time.monotonic()
+        with self._lock:
+            if self._depth is not None and now - self._depth_at < self.depth_interval:
+                return self._depth
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                'SELECT state, priority, COUNT(*), MIN(run_at) FROM jobs GROUP BY state, priority'
+            ).fetchall()
+        lanes = {priority: lane for lane, priority in LANES.items()}
+        depth = {'ready': {}, 'running': {}, 'dead': {}, 'oldest_ready_age_s': 0.0}
+        for state, priority, count, oldest in rows:
+            depth.setdefault(state, {})[lanes.get(priority, str(priority))] = count
+            if state == 'ready' and oldest is not None:
+                depth['oldest_ready_age_s'] = max(depth['oldest_ready_age_s'], round(time.time() - oldest, 3))
+        with self._lock:
+            self._depth, self._depth_at = depth, now
+        return depth
+
+    def _count(self, name, amount=1):
+        """Increment a counter"""
+        with self._lock:
+            self._stats[name] += amount
+
+    def stats(self):
+        """Snapshot of queue counters and latency for this worker"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['buffered'] = len(self._buffer)
+            stats['running'] = self._running
+        claimed = stats.pop('claimed')
+        finished = stats['completed'] + stats['retried'] + stats['dead']
+        stats['claimed'] = claimed
+        stats['wait_ms_avg'] = round(stats.pop('wait_ms_total') / claimed, 3) if claimed else 0.0
+        stats['run_ms_avg'] = round(stats.pop('run_ms_total') / finished, 3) if finished else 0.0
+        stats['wait_ms_max'] = round(stats['wait_ms_max'], 3)
+        stats['run_ms_max'] = round(stats['run_ms_max'], 3)
+        stats['workers'] = self.workers
+        return stats
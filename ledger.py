@@ -0,0 +1,449 @@
+"""
+NomadPay Backend API - Double-Entry Ledger
+Atomic wallet transfers with group commit of concurrent payments
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from datetime import datetime
+import money
+from money import CURRENCY_SCALES, InvalidAmount
+from cache import record_balance_change
+from analytics import record_transfer
+
+logger = logging.getLogger(__name__)
+
+
+class LedgerError(Exception):
+    """Base class for transfer failures reported back to the client"""
+    status_code = 400
+
+
+class InvalidTransfer(LedgerError):
+    """The transfer request itself is malformed"""
+    status_code = 400
+
+
+class WalletNotFound(LedgerError):
+    """Sender or recipient has no wallet in the requested currency"""
+    status_code = 404
+
+
+class InsufficientFunds(LedgerError):
+    """Sender balance does not cover the amount"""
+    status_code = 422
+
+
+class LedgerUnavailable(LedgerError):
+    """The transfer could not be committed in time"""
+    status_code = 503
+
+
+def init_schema(conn):
+    """Create ledger tables and the wallet lookup index"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            reference TEXT UNIQUE NOT NULL,
+            sender_id INTEGER,
+            recipient_id INTEGER,
+            currency TEXT NOT NULL,
+            amount_minor NOT NULL,
+            type TEXT NOT NULL DEFAULT 'transfer',
+            status TEXT NOT NULL DEFAULT 'completed',
+            description TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (sender_id) REFERENCES users (id),
+            FOREIGN KEY (recipient_id) REFERENCES users (id)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS ledger_entries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            transaction_id INTEGER NOT NULL,
+            wallet_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            currency TEXT NOT NULL,
+            amount_minor NOT NULL,
+            balance_after_minor NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (transaction_id) REFERENCES transactions (id),
+            FOREIGN KEY (wallet_id) REFERENCES wallets (id)
+        )
+    ''')
+    # Databases created before minor units stored REAL amounts
+    money.migrate_column(conn, 'wallets', 'balance', 'balance_minor')
+    money.migrate_column(conn, 'transactions', 'amount', 'amount_minor')
+    money.migrate_column(conn, 'ledger_entries', 'amount', 'amount_minor')
+    money.migrate_column(conn, 'ledger_entries', 'balance_after', 'balance_after_minor')
+    conn.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_wallets_user_currency
+        ON wallets (user_id, currency)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_ledger_entries_transaction
+        ON ledger_entries (transaction_id)
+    ''')
+
+
+def parse_amount(amount, currency):
+    """Validate a client-supplied amount and return it in minor units"""
+    if currency not in CURRENCY_SCALES:
+        raise InvalidTransfer(f'Unsupported currency: {currency}')
+    try:
+        units = money.to_units(amount, currency)
+    except InvalidAmount as e:
+        raise InvalidTransfer(str(e))
+    if units <= 0:
+        raise InvalidTransfer('Amount must be greater than zero')
+    return units
+
+
+def _result(transaction_id, reference, sender_id, recipient_id, currency, units,
+            sender_balance, recipient_balance, created_at):
+    """Committed transfer as returned to callers (amounts as JSON numbers)"""
+    return {
+        'id': transaction_id,
+        'reference': reference,
+        'sender_id': sender_id,
+        'recipient_id': recipient_id,
+        'currency': currency,
+        'amount': money.to_number(units, currency),
+        'amount_minor': units,
+        'sender_balance': money.to_number(sender_balance, currency),
+        'recipient_balance': money.to_number(recipient_balance, currency),
+        'status': 'completed',
+        'created_at': created_at
+    }
+
+
+def apply_transfer(conn, sender_id, recipient_id, currency, amount, description=None, on_apply=None,
+                   on_applied=None):
+    """Debit sender and credit recipient inside the caller's transaction
+
+    ``amount`` is in minor units. Both wallets are read in one query and
+    the balance check and arithmetic run on Python ints; the caller's write
+    transaction keeps the rows stable in between.
+    ``on_apply(conn)`` runs first in the same transaction, so side records
+    (for example a consumed QR nonce) commit or roll back with the transfer.
+    ``on_applied(conn, [result])`` runs last, for side records that need
+    the transfer's reference (audit jobs).
+    """
+    if sender_id == recipient_id:
+        raise InvalidTransfer('Cannot send money to yourself')
+    if on_apply is not None:
+        on_apply(conn)
+
+    wallets = {
+        user_id: (wallet_id, money.from_db(balance))
+        for user_id, wallet_id, balance in conn.execute(
+            'SELECT user_id, id, balance_minor FROM wallets WHERE currency = ? AND user_id IN (?, ?)',
+            (currency, sender_id, recipient_id)
+        )
+    }
+    if sender_id not in wallets:
+        raise WalletNotFound(f'No {currency} wallet for sender')
+    if wallets[sender_id][1] < amount:
+        raise InsufficientFunds(f'Insufficient {currency} balance')
+    if recipient_id not in wallets:
+        raise WalletNotFound(f'Recipient has no {currency} wallet')
+
+    sender_wallet, sender_balance = wallets[sender_id]
+    recipient_wallet, recipient_balance = wallets[recipient_id]
+    sender_balance -= amount
+    recipient_balance += amount
+    conn.executemany('UPDATE wallets SET balance_minor = ? WHERE id = ?', (
+        (money.to_db(sender_balance), sender_wallet),
+        (money.to_db(recipient_balance), recipient_wallet)
+    ))
+
+    reference = 'tx_' + uuid.uuid4().hex
+    created_at = datetime.utcnow().isoformat()
+    stored = money.to_db(amount)
+    cursor = conn.execute('''
+        INSERT INTO transactions (reference, sender_id, recipient_id, currency, amount_minor, description, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (reference, sender_id, recipient_id, currency, stored, description, created_at))
+    transaction_id = cursor.lastrowid
+
+    conn.execute('''
+        INSERT INTO ledger_entries
+            (transaction_id, wallet_id, user_id, currency, amount_minor, balance_after_minor, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?), (?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        transaction_id, sender_wallet, sender_id, currency, money.to_db(-amount), money.to_db(sender_balance), created_at,
+        transaction_id, recipient_wallet, recipient_id, currency, stored, money.to_db(recipient_balance), created_at
+    ))
+    record_balance_change(conn, (sender_id, recipient_id))
+    record_transfer(conn, currency, amount, created_at)
+
+    result = _result(transaction_id, reference, sender_id, recipient_id, currency, amount,
+                     sender_balance, recipient_balance, created_at)
+    if on_applied is not None:
+        on_applied(conn, [result])
+    return result
+
+
+def apply_batch(conn, sender_id, items, atomic=True, on_apply=None, on_applied=None):
+    """Apply many transfers from one sender inside the caller's transaction
+
+    ``items`` is a list of (recipient_id, currency, amount, description)
+    with amounts in minor units.
+    Every wallet involved is read once and running balances are checked in
+    memory (the caller's write transaction keeps them stable), then the
+    accepted transfers are written with one ``executemany`` per statement.
+    Returns one result dict or LedgerError per item. With ``atomic=True``
+    nothing is written if any item fails, and accepted items are None.
+    ``on_apply(conn)`` runs just before the writes, only if something is
+    written, and ``on_applied(conn, results)`` right after them.
+    """
+    user_ids = sorted({sender_id} | {item[0] for item in items})
+    wallets = {}
+    for start in range(0, len(user_ids), 500):
+        chunk = user_ids[start:start + 500]
+        rows = conn.execute(f'''
+            SELECT id, user_id, currency, balance_minor FROM wallets
+            WHERE user_id IN ({', '.join('?' * len(chunk))})
+        ''', chunk)
+        for wallet_id, user_id, currency, balance in rows:
+            wallets[(user_id, currency)] = [wallet_id, money.from_db(balance)]
+
+    outcomes = []
+    accepted = []
+    for recipient_id, currency, amount, description in items:
+        sender = wallets.get((sender_id, currency))
+        recipient = wallets.get((recipient_id, currency))
+        if recipient_id == sender_id:
+            outcomes.append(InvalidTransfer('Cannot send money to yourself'))
+        elif sender is None:
+            outcomes.append(WalletNotFound(f'No {currency} wallet for sender'))
+        elif recipient is None:
+            outcomes.append(WalletNotFound(f'Recipient has no {currency} wallet'))
+        elif sender[1] < amount:
+            outcomes.append(InsufficientFunds(f'Insufficient {currency} balance'))
+        else:
+            sender[1] -= amount
+            recipient[1] += amount
+            outcomes.append(None)
+            accepted.append((len(outcomes) - 1, recipient_id, currency, amount, description,
+                             sender[0], sender[1], recipient[0], recipient[1]))
+    if not accepted or (atomic and len(accepted) < len(items)):
+        return outcomes
+    if on_apply is not None:
+        on_apply(conn)
+
+    # Explicit ids (we hold the write lock) so ledger entries need no lookups
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'transactions'").fetchone()
+    next_id = (row[0] if row else 0) + 1
+    created_at = datetime.utcnow().isoformat()
+    touched = {}
+    transactions = []
+    entries = []
+    volumes = {}
+    for offset, (index, recipient_id, currency, amount, description,
+                 sender_wallet, sender_balance, recipient_wallet, recipient_balance) in enumerate(accepted):
+        transaction_id = next_id + offset
+        stored = money.to_db(amount)
+        reference = 'tx_' + uuid.uuid4().hex
+        touched[sender_wallet] = sender_balance
+        touched[recipient_wallet] = recipient_balance
+        transactions.append((transaction_id, reference, sender_id, recipient_id, currency, stored, description, created_at))
+        entries.append((transaction_id, sender_wallet, sender_id, currency,
+                        money.to_db(-amount), money.to_db(sender_balance), created_at))
+        entries.append((transaction_id, recipient_wallet, recipient_id, currency,
+                        stored, money.to_db(recipient_balance), created_at))
+        count, volume = volumes.get(currency, (0, 0))
+        volumes[currency] = (count + 1, volume + amount)
+        outcomes[index] = _result(transaction_id, reference, sender_id, recipient_id, currency, amount,
+                                  sender_balance, recipient_balance, created_at)
+
+    # Final balances only: a wallet paid several times is updated once
+    conn.executemany('UPDATE wallets SET balance_minor = ? WHERE id = ?',
+                     [(money.to_db(balance), wallet_id) for wallet_id, balance in touched.items()])
+    conn.executemany('''
+        INSERT INTO transactions (id, reference, sender_id, recipient_id, currency, amount_minor, description, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', transactions)
+    conn.executemany('''
+        INSERT INTO ledger_entries
+            (transaction_id, wallet_id, user_id, currency, amount_minor, balance_after_minor, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', entries)
+    record_balance_change(conn, [sender_id] + [item[1] for item in accepted])
+    for currency, (count, volume) in volumes.items():
+        record_transfer(conn, currency, volume, created_at, count)
+    if on_applied is not None:
+        on_applied(conn, [outcome for outcome in outcomes if isinstance(outcome, dict)])
+    return outcomes
+
+
+class _PendingTransfer:
+    """A transfer waiting for the group committer"""
+
+    __slots__ = ('args', 'done', 'result', 'error')
+
+    def __init__(self, args):
+        self.args = args
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Ledger:
+    """Transfer service that batches concurrent writes into one commit.
+
+    Request threads enqueue transfers and block until a single writer
+    thread has committed them. Each transfer runs under its own SAVEPOINT,
+    so a failed balance check only rolls back that transfer while the rest
+    of the batch commits together. With ``group_commit=False`` every
+    transfer gets its own transaction on the calling thread.
+    """
+
+    def __init__(self, pool, group_commit=True, max_batch=64, max_wait_ms=0.0, timeout=10.0):
+        self.pool = pool
+        self.group_commit = group_commit
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._stats = {'transfers': 0, 'failed': 0, 'commits': 0, 'batched_max': 0}
+        self._commit_hooks = []
+
+    def on_commit(self, callback):
+        """Register callback(results) to run after each successful commit"""
+        self._commit_hooks.append(callback)
+        return callback
+
+    def _run_commit_hooks(self, results):
+        """Notify listeners (caches, rollups) about committed transfers"""
+        if not results:
+            return
+        for callback in self._commit_hooks:
+            try:
+                callback(results)
+            except Exception:
+                logger.exception('Ledger commit hook failed')
+
+    def transfer(self, sender_id, recipient_id, currency, amount, description=None, on_apply=None,
+                 on_applied=None, on_abort=None):
+        """Move amount from sender to recipient; returns the committed transaction
+
+        Both hooks run in the writer's transaction (see apply_transfer),
+        possibly on the writer thread. ``on_abort`` is accepted for
+        ShardedLedger parity and never runs: a transfer here cannot be
+        aborted once ``on_apply`` has committed.
+        """
+        args = (sender_id, recipient_id, currency, amount, description, on_apply, on_applied)
+        if not self.group_commit:
+            try:
+                with self.pool.transaction() as conn:
+                    result = apply_transfer(conn, *args)
+            except LedgerError:
+                self._record(failed=1)
+                raise
+            self._record(transfers=1, commits=1, batch=1)
+            self._run_commit_hooks([result])
+            return result
+
+        pending = _PendingTransfer(args)
+        self._get_queue().put(pending)
+        if not pending.done.wait(self.timeout):
+            raise LedgerUnavailable('Transfer is still pending; check transaction history before retrying')
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def transfer_batch(self, sender_id, items, atomic=True, on_apply=None, on_applied=None, on_abort=None):
+        """Apply a payout batch in one transaction; returns a result or LedgerError per item"""
+        try:
+            with self.pool.transaction() as conn:
+                outcomes = apply_batch(conn, sender_id, items, atomic=atomic, on_apply=on_apply,
+                                       on_applied=on_applied)
+        except Exception as e:
+            logger.error(f'Batch transfer failed: {e}')
+            raise LedgerUnavailable('Batch could not be committed; check transaction history before retrying')
+        results = [outcome for outcome in outcomes if isinstance(outcome, dict)]
+        self._record(transfers=len(results), failed=len(items) - len(results), commits=1 if results else 0,
+                     batch=len(results))
+        self._run_commit_hooks(results)
+        return outcomes
+
+    def _get_queue(self):
+        """Start the writer thread lazily so each forked worker has its own"""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._queue = queue.Queue()
+                threading.Thread(
+                    target=self._writer_loop,
+                    args=(self._queue,),
+                    name='ledger-writer',
+                    daemon=True
+                ).start()
+            return self._queue
+
+    def _collect(self, work):
+        """Gather the next batch: block for one transfer, then drain the queue"""
+        batch = [work.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(work.get(timeout=remaining))
+                else:
+                    batch.append(work.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _writer_loop(self, work):
+        """Apply batches of transfers, one write transaction per batch"""
+        while True:
+            batch = self._collect(work)
+            failed = 0
+            try:
+                with self.pool.transaction() as conn:
+                    for pending in batch:
+                        conn.execute('SAVEPOINT transfer')
+                        try:
+                            pending.result = apply_transfer(conn, *pending.args)
+                            conn.execute('RELEASE transfer')
+                        except Exception as e:
+                            conn.execute('ROLLBACK TO transfer')
+                            conn.execute('RELEASE transfer')
+                            pending.result = None
+                            pending.error = e if isinstance(e, LedgerError) else LedgerUnavailable(str(e))
+                            failed += 1
+            except Exception as e:
+                for pending in batch:
+                    pending.result = None
+                    pending.error = LedgerUnavailable(f'Transfer could not be committed: {e}')
+                failed = len(batch)
+            self._record(transfers=len(batch) - failed, failed=failed, commits=1, batch=len(batch))
+            self._run_commit_hooks([pending.result for pending in batch if pending.result is not None])
+            for pending in batch:
+                pending.done.set()
+
+    def _record(self, transfers=0, failed=0, commits=0, batch=0):
+        """Update counters"""
+        with self._lock:
+            self._stats['transfers'] += transfers
+            self._stats['failed'] += failed
+            self._stats['commits'] += commits
+            if batch > self._stats['batched_max']:
+                self._stats['batched_max'] = batch
+
+    def stats(self):
+        """Snapshot of ledger throughput counters"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats['group_commit'] = self.group_commit
+        stats['avg_batch'] = round((stats['transfers'] + stats['failed']) / stats['commits'], 2) if stats['commits'] else 0.0
+        return stats
@@ -0,0 +1,398 @@
+"""
+NomadPay Backend API - Metrics
+Per-route request histograms, SQL timing and Prometheus exposition across workers
+"""
+
+import bisect
+import glob
+import logging
+import mmap
+import os
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Request latency histogram upper bounds (seconds)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Metric families: name -> (type, help)
+FAMILIES = {
+    'nomadpay_http_requests_total': ('counter', 'HTTP requests by route, method and status class'),
+    'nomadpay_http_request_duration_seconds': ('histogram', 'HTTP request latency by route'),
+    'nomadpay_sql_statements_total': ('counter', 'SQLite statements executed by request route'),
+    'nomadpay_sql_duration_seconds_total': ('counter', 'Time spent executing SQLite statements by request route'),
+}
+
+_SEP = '\x1f'
+_HEADER = struct.Struct('<Q')
+_LENGTH = struct.Struct('<I')
+_VALUE = struct.Struct('<d')
+
+
+class MmapValues:
+    """Append-only map of series key -> float64 in a file owned by one process.
+
+    Layout: an 8-byte used-length header followed by entries of
+    ``[u32 key length][key, padded to 8 bytes][f64 value]``. New entries
+    are written before the header is advanced, so a concurrent reader in
+    another process never sees a half-written key. Values are aligned
+    8-byte stores, which readers see either old or new.
+    """
+
+    INITIAL_SIZE = 64 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'a+b')
+        size = os.fstat(self._file.fileno()).st_size
+        if size < self.INITIAL_SIZE:
+            self._file.truncate(self.INITIAL_SIZE)
+            size = self.INITIAL_SIZE
+        self._map = mmap.mmap(self._file.fileno(), size)
+        self._positions = {}
+        self._values = {}
+        used = _HEADER.unpack_from(self._map, 0)[0]
+        if used == 0:
+            used = _HEADER.size
+            _HEADER.pack_into(self._map, 0, used)
+        for key, value, position in _entries(self._map, used):
+            self._positions[key] = position
+            self._values[key] = value
+        self._used = used
+
+    def _position(self, key):
+        """Offset of key's value, appending a new entry if needed"""
+        position = self._positions.get(key)
+        if position is not None:
+            return position
+        encoded = key.encode()
+        padded = (_LENGTH.size + len(encoded) + 7) // 8 * 8
+        needed = self._used + padded + _VALUE.size
+        if needed > len(self._map):
+            size = len(self._map)
+            while size < needed:
+                size *= 2
+            self._file.truncate(size)
+            self._map.close()
+            self._map = mmap.mmap(self._file.fileno(), size)
+        _LENGTH.pack_into(self._map, self._used, len(encoded))
+        self._map[self._used + _LENGTH.size:self._used + _LENGTH.size + len(encoded)] = encoded
+        position = self._used + padded
+        _VALUE.pack_into(self._map, position, 0.0)
+        self._used = needed
+        _HEADER.pack_into(self._map, 0, self._used)
+        self._positions[key] = position
+        self._values[key] = 0.0
+        return position
+
+    def add(self, key, amount):
+        """Increment a value"""
+        position = self._position(key)
+        value = self._values[key] + amount
+        self._values[key] = value
+        _VALUE.pack_into(self._map, position, value)
+
+    def set(self, key, value):
+        """Overwrite a value"""
+        position = self._position(key)
+        self._values[key] = value
+        _VALUE.pack_into(self._map, position, value)
+
+    def close(self):
+        """Release the mapping"""
+        self._map.close()
+        self._file.close()
+
+
+def _entries(buffer, used):
+    """Yield (key, value, value offset) for every entry below used"""
+    position = _HEADER.size
+    while position < used:
+        length = _LENGTH.unpack_from(buffer, position)[0]
+        key = bytes(buffer[position + _LENGTH.size:position + _LENGTH.size + length]).decode()
+        position += (_LENGTH.size + length + 7) // 8 * 8
+        yield key, _VALUE.unpack_from(buffer, position)[0], position
+        position += _VALUE.size
+
+
+def read_values(path):
+    """Read every series from another worker's file"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < _HEADER.size:
+        return []
+    used = min(_HEADER.unpack_from(data, 0)[0], len(data))
+    return [(key, value) for key, value, _ in _entries(data, used)]
+
+
+def _alive(pid):
+    """True if a worker process still exists"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _labels(**labels):
+    """Prometheus label string"""
+    return ','.join(f'{name}="{str(value)}"' for name, value in labels.items())
+
+
+class _SQLTimer(threading.local):
+    """Statement count and time for the request running on this thread"""
+    statements = 0
+    seconds = 0.0
+    trace = None
+
+
+_sql = _SQLTimer()
+
+
+def start_sql_trace():
+    """Also record (sql, seconds) for each statement on this thread until stop_sql_trace()"""
+    _sql.trace = []
+
+
+def stop_sql_trace():
+    """Stop recording statements; returns the recorded list"""
+    trace, _sql.trace = _sql.trace, None
+    return trace or []
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that adds statement execution and fetch time to the current request"""
+
+    def execute(self, *args):
+        started = time.perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            elapsed = time.perf_counter() - started
+            _sql.statements += 1
+            _sql.seconds += elapsed
+            if _sql.trace is not None:
+                _sql.trace.append((args[0], elapsed))
+
+    def executemany(self, *args):
+        started = time.perf_counter()
+        try:
+            return super().executemany(*args)
+        finally:
+            elapsed = time.perf_counter() - started
+            _sql.statements += 1
+            _sql.seconds += elapsed
+            if _sql.trace is not None:
+                _sql.trace.append((args[0], elapsed))
+
+    def fetchall(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            _sql.seconds += time.perf_counter() - started
+
+    def fetchmany(self, *args):
+        started = time.perf_counter()
+        try:
+            return super().fetchmany(*args)
+        finally:
+            _sql.seconds += time.perf_counter() - started
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose statements are timed through TimedCursor (pool factory)"""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+
+class Metrics:
+    """Process-local recording with cross-worker exposition.
+
+    Every worker writes its own ``worker-<pid>.db`` file in ``directory``
+    through a memory map, so recording is a dict lookup and an 8-byte
+    store with no cross-process locking. ``render()`` reads every file in
+    the directory and sums counters, so any worker can answer a scrape
+    for all of them. Counters from exited workers are kept (so totals
+    never go backwards); gauges carry a ``pid`` label and are only
+    reported for live workers. Gauge callbacks run every
+    ``gauge_interval`` seconds and before each scrape.
+    """
+
+    def __init__(self, directory=None, gauge_interval=5.0):
+        self._directory = directory
+        self.gauge_interval = gauge_interval
+        self._lock = threading.Lock()
+        self._pid = None
+        self._store = None
+        self._gauges = []
+        self._request_keys = {}
+
+    @property
+    def directory(self):
+        """Shared metrics directory; defaults to one per gunicorn arbiter"""
+        if self._directory:
+            return self._directory
+        return os.path.join(tempfile.gettempdir(), f'nomadpay-metrics-{os.getppid()}')
+
+    def _get_store(self):
+        """This worker's value file, created after fork"""
+        if self._pid == os.getpid():
+            return self._store
+        with self._lock:
+            if self._pid != os.getpid():
+                os.makedirs(self.directory, exist_ok=True)
+                self._store = MmapValues(os.path.join(self.directory, f'worker-{os.getpid()}.db'))
+                self._request_keys = {}
+                self._pid = os.getpid()
+                if self._gauges:
+                    threading.Thread(target=self._gauge_loop, name='metrics-gauges', daemon=True).start()
+        return self._store
+
+    def register_gauges(self, callback):
+        """Register callback() -> iterable of (name, help, value) gauges for this worker"""
+        self._gauges.append(callback)
+        return callback
+
+    def start_request(self):
+        """Reset the SQL timer for the request on this thread"""
+        _sql.statements = 0
+        _sql.seconds = 0.0
+
+    def observe_request(self, route, method, status, duration):
+        """Record one finished request and the SQL it ran"""
+        store = self._get_store()
+        status_class = f'{status // 100}xx'
+        keys = self._request_keys.get((route, method, status_class))
+        if keys is None:
+            keys = self._request_key_set(route, method, status_class)
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, duration)
+        with self._lock:
+            store.add(keys[0], 1.0)
+            store.add(keys[1][bucket], 1.0)
+            store.add(keys[2], duration)
+            store.add(keys[3], 1.0)
+            if _sql.statements:
+                store.add(keys[4], _sql.statements)
+                store.add(keys[5], _sql.seconds)
+
+    def _request_key_set(self, route, method, status_class):
+        """Series keys for a route/method/status combination, built once"""
+        labels = _labels(route=route, method=method)
+        histogram = 'nomadpay_http_request_duration_seconds'
+        keys = (
+            f'nomadpay_http_requests_total{_SEP}{labels},status="{status_class}"',
+            [f'{histogram}_bucket{_SEP}{labels}{_SEP}{le}' for le in LATENCY_BUCKETS + ('+Inf',)],
+            f'{histogram}_sum{_SEP}{labels}',
+            f'{histogram}_count{_SEP}{labels}',
+            f'nomadpay_sql_statements_total{_SEP}{_labels(route=route)}',
+            f'nomadpay_sql_duration_seconds_total{_SEP}{_labels(route=route)}',
+        )
+        self._request_keys[(route, method, status_class)] = keys
+        return keys
+
+    def update_gauges(self):
+        """Write this worker's gauges to its file"""
+        store = self._get_store()
+        pid = _labels(pid=os.getpid())
+        for callback in self._gauges:
+            try:
+                gauges = list(callback())
+            except Exception:
+                logger.exception('Metrics gauge callback failed')
+                continue
+            with self._lock:
+                for name, help_text, value in gauges:
+                    FAMILIES.setdefault(name, ('gauge', help_text))
+                    store.set(f'{name}{_SEP}{pid}', float(value))
+
+    def _gauge_loop(self):
+        """Refresh gauges periodically so idle workers stay current"""
+        while True:
+            time.sleep(self.gauge_interval)
+            try:
+                self.update_gauges()
+            except Exception:
+                logger.exception('Metrics gauge update failed')
+
+    def collect(self):
+        """Sum series across every worker file; returns {(name, labels, le): value}"""
+        self.update_gauges()
+        series = {}
+        for path in glob.glob(os.path.join(self.directory, 'worker-*.db')):
+            try:
+                pid = int(os.path.basename(path)[7:-3])
+                values = read_values(path)
+            except (OSError, ValueError):
+                continue
+            live = _alive(pid)
+            for key, value in values:
+                parts = key.split(_SEP)
+                name = parts[0]
+                if FAMILIES.get(name, ('gauge',))[0] == 'gauge' and not live:
+                    continue
+                index = (name, parts[1] if len(parts) > 1 else '', parts[2] if len(parts) > 2 else None)
+                series[index] = series.get(index, 0.0) + value
+        return series
+
+    def render(self):
+        """Prometheus text exposition of all workers"""
+        series = self.collect()
+        families = {}
+        for (name, labels, le), value in series.items():
+            family = name
+            for suffix in ('_bucket', '_sum', '_count'):
+                if name.endswith(suffix) and name[:-len(suffix)] in FAMILIES:
+                    family = name[:-len(suffix)]
+            families.setdefault(family, []).append((name, labels, le, value))
+
+        lines = []
+        for family in sorted(families):
+            metric_type, help_text = FAMILIES.get(family, ('untyped', family))
+            lines.append(f'# HELP {family} {help_text}')
+            lines.append(f'# TYPE {family} {metric_type}')
+            rows = families[family]
+            if metric_type == 'histogram':
+                lines.extend(_histogram_lines(family, rows))
+                continue
+            for name, labels, _, value in sorted(rows):
+                lines.append(f'{name}{{{labels}}} {_format(value)}' if labels else f'{name} {_format(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def _histogram_lines(family, rows):
+    """Cumulative bucket, sum and count lines (buckets are stored per bucket)"""
+    buckets = {}
+    totals = []
+    for name, labels, le, value in rows:
+        if le is None:
+            totals.append((name, labels, value))
+        else:
+            buckets.setdefault(labels, {})[le] = value
+    lines = []
+    for labels in sorted(buckets):
+        running = 0.0
+        for le in LATENCY_BUCKETS + ('+Inf',):
+            running += buckets[labels].get(str(le), 0.0)
+            lines.append(f'{family}_bucket{{{labels},le="{le}"}} {_format(running)}')
+    for name, labels, value in sorted(totals):
+        lines.append(f'{name}{{{labels}}} {_format(value)}')
+    return lines
+
+
+def _format(value):
+    """Integral values without a trailing .0"""
+    return str(int(value)) if value == int(value) else repr(value)
@@ -0,0 +1,153 @@
+"""
+NomadPay Backend API - Fixed-Point Money
+Integer minor units with a per-currency scale table
+"""
+
+from decimal import Decimal, ROUND_HALF_EVEN
+
+# Decimal places (minor units per major unit = 10 ** scale) per currency
+CURRENCY_SCALES = {
+    'USD': 2,
+    'EUR': 2,
+    'BTC': 8,
+    'ETH': 18
+}
+
+# Values outside SQLite's signed 64-bit range are stored as decimal text
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+# Largest accepted amount: at most this many digits before the decimal point
+MAX_AMOUNT_DIGITS = 18
+
+# Significant digits a float (and so a JSON number) always round-trips
+FLOAT_DIGITS = 15
+
+
+class InvalidAmount(ValueError):
+    """Raised for amounts that are not representable in a currency"""
+
+
+def to_units(value, currency):
+    """Exact minor units for a decimal amount; rejects extra decimal places.
+
+    Trailing zeros are not precision (``1.000000000000000000000`` is 1),
+    and amounts with more than MAX_AMOUNT_DIGITS integer digits are refused
+    before scaling, so exponents like ``1e999999999`` never reach the
+    arithmetic. Any other decimal failure is reported as InvalidAmount.
+    """
+    scale = CURRENCY_SCALES[currency]
+    try:
+        amount = Decimal(str(value))
+        if not amount.is_finite():
+            raise InvalidAmount('Amount must be a number')
+        if not amount:
+            return 0
+        if amount.adjusted() >= MAX_AMOUNT_DIGITS:
+            raise InvalidAmount('Amount is too large')
+        sign, digits, exponent = amount.as_tuple()
+        # Strip trailing zeros exactly (normalize() would round to the context precision)
+        significant = len(digits)
+        while digits[significant - 1] == 0:
+            significant -= 1
+        exponent += len(digits) - significant
+        if exponent < -scale:
+            raise InvalidAmount(f'{currency} supports at most {scale} decimal places')
+        units = int(''.join(map(str, digits[:significant]))) * 10 ** (exponent + scale)
+    except (ArithmeticError, ValueError) as e:
+        if isinstance(e, InvalidAmount):
+            raise
+        raise InvalidAmount('Amount must be a number')
+    return -units if sign else units
+
+
+def from_units(units, currency):
+    """Exact Decimal amount for minor units"""
+    return Decimal(units).scaleb(-CURRENCY_SCALES[currency])
+
+
+def to_number(units, currency):
+    """JSON value for minor units: a number when a float holds it exactly.
+
+    That is what API clients have always received. Amounts with more than
+    FLOAT_DIGITS significant digits (most 18-decimal ETH values in wei)
+    are returned as the exact decimal string from ``to_string`` instead.
+    """
+    if len(str(abs(units)).rstrip('0')) > FLOAT_DIGITS:
+        return to_string(units, currency)
+    return float(from_units(units, currency))
+
+
+def to_string(units, currency):
+    """Shortest exact decimal string for minor units (no exponent)"""
+    return format(from_units(units, currency).normalize(), 'f')
+
+
+def to_db(units):
+    """SQLite value for minor units: INTEGER when it fits, decimal text otherwise"""
+    return units if INT64_MIN <= units <= INT64_MAX else str(units)
+
+
+def from_db(value):
+    """Minor units from a value written by to_db"""
+    return int(value) if value is not None else 0
+
+
+def add(a, b):
+    """Overflow-safe sum of two stored values (SQL: money_add)"""
+    if type(a) is int and type(b) is int:
+        total = a + b
+        if INT64_MIN <= total <= INT64_MAX:
+            return total
+        return str(total)
+    return to_db(from_db(a) + from_db(b))
+
+
+class MoneySum:
+    """Overflow-safe SUM over stored values (SQL: money_sum)"""
+
+    def __init__(self):
+        self.total = 0
+
+    def step(self, value):
+        if value is not None:
+            self.total += int(value)
+
+    def finalize(self):
+        return to_db(self.total)
+
+
+def register(conn):
+    """Install money_add/money_sum on a new connection"""
+    conn.create_function('money_add', 2, add, deterministic=True)
+    conn.create_aggregate('money_sum', 1, MoneySum)
+
+
+def legacy_to_units(value, currency):
+    """Minor units for a legacy REAL amount, rounding away float noise"""
+    if value is None:
+        return 0
+    scale = CURRENCY_SCALES.get(currency, 8)
+    return int(Decimal(repr(float(value))).scaleb(scale).to_integral_value(ROUND_HALF_EVEN))
+
+
+def migrate_column(conn, table, legacy, column, currency_column='currency'):
+    """Replace a legacy REAL money column with an integer minor-unit column.
+
+    The new column has no declared type so it keeps INTEGER values as-is
+    and stores the rare out-of-range value as exact decimal text. Rows are
+    converted in Python (an 18-decimal scale overflows SQL arithmetic) and
+    the legacy column is dropped afterwards. A no-op once migrated.
+    """
+    columns = {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+    if legacy not in columns:
+        return 0
+    if column not in columns:
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} NOT NULL DEFAULT 0')
+    rows = conn.execute(f'SELECT rowid, {currency_column}, {legacy} FROM {table}').fetchall()
+    conn.executemany(
+        f'UPDATE {table} SET {column} = ? WHERE rowid = ?',
+        [(to_db(legacy_to_units(value, currency)), rowid) for rowid, currency, value in rows]
+    )
+    conn.execute(f'ALTER TABLE {table} DROP COLUMN {legacy}')
+    return len(rows)
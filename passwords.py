@@ -0,0 +1,100 @@
+"""
+NomadPay Backend API - Password Hashing Pool
+Runs PBKDF2 hashing on a bounded worker pool off the request thread
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class HashingUnavailable(Exception):
+    """Raised when the hashing pool is saturated or a job times out"""
+
+
+class PasswordHasher:
+    """Bounded thread pool for password hashing and verification.
+
+    ``hashlib.pbkdf2_hmac`` releases the GIL, so hashing on a small pool
+    of threads keeps request threads (and health checks on threaded
+    workers) responsive while capping the CPU spent on authentication.
+    At most ``max_workers + max_queue`` jobs are admitted; beyond that
+    callers are rejected immediately instead of piling up.
+    """
+
+    def __init__(self, iterations=600000, algorithm='sha256', salt_length=16,
+                 max_workers=2, max_queue=32, timeout=5.0):
+        self.method = f'pbkdf2:{algorithm}:{int(iterations)}'
+        self.salt_length = salt_length
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._pid = None
+        self._executor = None
+        self._slots = None
+        self._stats = {'submitted': 0, 'rejected': 0, 'timeouts': 0, 'rehashed': 0}
+
+    def _get_executor(self):
+        """Create the pool lazily so each forked worker gets its own threads"""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix='pwhash'
+                )
+                self._slots = threading.BoundedSemaphore(self.max_workers + self.max_queue)
+            return self._executor, self._slots
+
+    def _run(self, fn, *args):
+        """Run fn on the pool, enforcing the queue-depth limit and timeout"""
+        executor, slots = self._get_executor()
+        if not slots.acquire(blocking=False):
+            with self._lock:
+                self._stats['rejected'] += 1
+            raise HashingUnavailable('Password hashing queue is full')
+        try:
+            future = executor.submit(fn, *args)
+        except Exception:
+            slots.release()
+            raise
+        future.add_done_callback(lambda _: slots.release())
+        with self._lock:
+            self._stats['submitted'] += 1
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            future.cancel()
+            with self._lock:
+                self._stats['timeouts'] += 1
+            raise HashingUnavailable(f'Password hashing timed out after {self.timeout}s')
+
+    def hash(self, password):
+        """Hash a password with the configured work factor"""
+        return self._run(generate_password_hash, password, self.method, self.salt_length)
+
+    def verify(self, password_hash, password):
+        """Check a password against a stored hash"""
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """True when the stored hash was made with a different method or cost"""
+        return password_hash.split('$', 1)[0] != self.method
+
+    def record_rehash(self):
+        """Count a transparent hash upgrade"""
+        with self._lock:
+            self._stats['rehashed'] += 1
+
+    def stats(self):
+        """Snapshot of pool usage for monitoring"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update({
+            'method': self.method,
+            'max_workers': self.max_workers,
+            'max_queue': self.max_queue
+        })
+        return stats
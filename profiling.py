@@ -0,0 +1,204 @@
+"""
+NomadPay Backend API - Request Profiling
+Opt-in cProfile captures with SQL statement timings, kept in a bounded shared ring
+"""
+
+import cProfile
+import glob
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+
+from metrics import start_sql_trace, stop_sql_trace
+
+logger = logging.getLogger(__name__)
+
+# Capture ids are "<ms timestamp>-<pid>-<sequence>" so names sort by age
+CAPTURE_ID = re.compile(r'^\d{13}-\d+-\d+$')
+
+# Functions reported in a capture summary (the .prof file has all of them)
+TOP_FUNCTIONS = 25
+
+
+class ProfileSession:
+    """A request running under the profiler on the current thread"""
+
+    __slots__ = ('reason', 'profile', 'started', 'started_at')
+
+    def __init__(self, reason, profile):
+        self.reason = reason
+        self.profile = profile
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+
+
+class Profiler:
+    """Per-request profiling that is only paid for by profiled requests.
+
+    A request is profiled when ``start()`` is called for it, either because
+    an admin asked with a header or because ``sample()`` picked it. The
+    request runs under cProfile on its own thread while every SQLite
+    statement it issues is recorded with its duration (through the timed
+    connections in ``metrics``). Requested captures are always kept;
+    sampled ones only when slower than ``slow_ms``.
+
+    Captures are written to ``directory`` as a ``.prof`` file (standard
+    pstats format, readable by ``pstats``/snakeviz) plus a ``.json``
+    summary, and the directory is trimmed to the newest ``max_captures``
+    after each write, so it is a ring shared by every worker. Streamed
+    response bodies finish after the capture is taken and are not included.
+    """
+
+    def __init__(self, directory=None, sample_rate=0.0, slow_ms=200.0, max_captures=50, max_statements=500):
+        self._directory = directory
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.max_captures = max_captures
+        self.max_statements = max_statements
+        self._sequence = itertools.count(1)
+        self._lock = threading.Lock()
+        self._stats = {'started': 0, 'captured': 0, 'discarded': 0, 'busy': 0}
+
+    @property
+    def directory(self):
+        """Shared capture directory; defaults to one per gunicorn arbiter"""
+        if self._directory:
+            return self._directory
+        return os.path.join(tempfile.gettempdir(), f'nomadpay-profiles-{os.getppid()}')
+
+    def sample(self):
+        """True if this request was picked by the sampling rate"""
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def start(self, reason):
+        """Profile the rest of the request on this thread; returns a session or None"""
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler already owns the interpreter (Python 3.12+)
+            with self._lock:
+                self._stats['busy'] += 1
+            return None
+        start_sql_trace()
+        with self._lock:
+            self._stats['started'] += 1
+        return ProfileSession(reason, profile)
+
+    def finish(self, session, route, method, path, status):
+        """Stop profiling and keep the capture if wanted; returns its id or None"""
+        session.profile.disable()
+        duration_ms = (time.perf_counter() - session.started) * 1000
+        statements = stop_sql_trace()
+        if session.reason == 'sampled' and duration_ms < self.slow_ms:
+            with self._lock:
+                self._stats['discarded'] += 1
+            return None
+
+        session.profile.create_stats()
+        capture_id = f'{int(session.started_at * 1000):013d}-{os.getpid()}-{next(self._sequence)}'
+        summary = {
+            'id': capture_id,
+            'reason': session.reason,
+            'route': route,
+            'method': method,
+            'path': path,
+            'status': status,
+            'duration_ms': round(duration_ms, 3),
+            'started_at': session.started_at,
+            'pid': os.getpid(),
+            'sql_statements': len(statements),
+            'sql_ms': round(sum(seconds for _, seconds in statements) * 1000, 3),
+            'statements': [
+                {'sql': ' '.join(sql.split()), 'ms': round(seconds * 1000, 3)}
+                for sql, seconds in statements[:self.max_statements]
+            ],
+            'functions': _top_functions(session.profile.stats)
+        }
+
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            base = os.path.join(self.directory, capture_id)
+            session.profile.dump_stats(base + '.prof')
+            with open(base + '.json.tmp', 'w') as f:
+                json.dump(summary, f)
+            os.replace(base + '.json.tmp', base + '.json')
+            self._trim()
+        except OSError as e:
+            logger.error(f"Profile capture write error: {e}")
+            return None
+
+        with self._lock:
+            self._stats['captured'] += 1
+        logger.info(f"Profiled {method} {path} in {duration_ms:.1f} ms ({capture_id})")
+        return capture_id
+
+    def _trim(self):
+        """Delete the oldest captures beyond max_captures"""
+        captures = sorted(glob.glob(os.path.join(self.directory, '*.json')))
+        for path in captures[:max(len(captures) - self.max_captures, 0)]:
+            for name in (path, path[:-len('.json')] + '.prof'):
+                try:
+                    os.remove(name)
+                except FileNotFoundError:
+                    pass
+
+    def list(self):
+        """Summaries of stored captures, newest first, without statements and functions"""
+        captures = []
+        for path in sorted(glob.glob(os.path.join(self.directory, '*.json')), reverse=True):
+            summary = self._read(path)
+            if summary is not None:
+                summary.pop('statements', None)
+                summary.pop('functions', None)
+                captures.append(summary)
+        return captures
+
+    def get(self, capture_id):
+        """Full summary of one capture, or None"""
+        if not CAPTURE_ID.match(capture_id):
+            return None
+        return self._read(os.path.join(self.directory, capture_id + '.json'))
+
+    def pstats_path(self, capture_id):
+        """Path of a capture's .prof file, or None"""
+        if not CAPTURE_ID.match(capture_id):
+            return None
+        path = os.path.join(self.directory, capture_id + '.prof')
+        return path if os.path.exists(path) else None
+
+    def _read(self, path):
+        """Load a summary file; None if it was trimmed meanwhile"""
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def stats(self):
+        """Snapshot of profiling counters for this worker"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats['sample_rate'] = self.sample_rate
+        stats['slow_ms'] = self.slow_ms
+        return stats
+
+
+def _top_functions(stats, limit=TOP_FUNCTIONS):
+    """Functions with the highest cumulative time from cProfile stats"""
+    ranked = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:limit]
+    return [
+        {
+            'function': f'{filename}:{line}({name})',
+            'calls': calls,
+            'total_ms': round(total * 1000, 3),
+            'cumulative_ms': round(cumulative * 1000, 3)
+        }
+        for (filename, line, name), (_, calls, total, cumulative, _) in ranked
+    ]
@@ -0,0 +1,317 @@
+"""
+NomadPay Backend API - QR Payment Codes
+Signed compact payment payloads and a content-addressed image cache
+"""
+
+import base64
+import binascii
+import hashlib
+import hmac
+import io
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import qrcode
+from qrcode.image.pure import PyPNGImage
+from qrcode.image.svg import SvgPathImage
+
+from ledger import LedgerError
+
+logger = logging.getLogger(__name__)
+
+# Payload prefix; bump when the field layout changes
+PAYLOAD_PREFIX = 'NP1'
+
+IMAGE_FORMATS = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml'
+}
+
+SIGNATURE_BYTES = 16
+
+
+class QRError(Exception):
+    """Raised for invalid QR requests or payloads"""
+    status_code = 400
+
+
+def _b64encode(raw):
+    """Unpadded URL-safe base64"""
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def _b64decode(text):
+    """Inverse of _b64encode"""
+    return base64.urlsafe_b64decode((text + '=' * (-len(text) % 4)).encode())
+
+
+def signing_key(secret):
+    """Derive the QR signing key so it is never the raw JWT secret"""
+    return hmac.new(secret.encode(), b'nomadpay-qr-v1', hashlib.sha256).digest()
+
+
+def encode_payload(key, recipient, currency, expires_at, amount=None, memo=None, one_time=False):
+    """Build the signed payload string embedded in the QR code.
+
+    Fields use one-letter keys and are serialized deterministically, so
+    identical static codes produce identical payloads (and cache keys).
+    One-time codes add a random nonce.
+    """
+    fields = {'r': recipient, 'c': currency, 'e': int(expires_at)}
+    if amount is not None:
+        fields['a'] = str(amount)
+    if memo:
+        fields['m'] = memo
+    if one_time:
+        fields['n'] = uuid.uuid4().hex[:16]
+    body = _b64encode(json.dumps(fields, separators=(',', ':'), sort_keys=True).encode())
+    signature = hmac.new(key, f'{PAYLOAD_PREFIX}.{body}'.encode(), hashlib.sha256).digest()[:SIGNATURE_BYTES]
+    return f'{PAYLOAD_PREFIX}.{body}.{_b64encode(signature)}'
+
+
+def render(payload, fmt='png', scale=8):
+    """Encode payload as a QR image and return the file bytes"""
+    code = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_M, box_size=scale, border=4)
+    code.add_data(payload)
+    code.make(fit=True)
+    factory = PyPNGImage if fmt == 'png' else SvgPathImage
+    buffer = io.BytesIO()
+    code.make_image(image_factory=factory).save(buffer)
+    return buffer.getvalue()
+
+
+class QRImageCache:
+    """LRU cache of rendered images bounded by total bytes.
+
+    Keys are content hashes of (payload, format, scale), so a hit is
+    always byte-identical to what a fresh render would produce and the
+    key doubles as the HTTP ETag.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    @staticmethod
+    def key(payload, fmt, scale):
+        """Content address for a rendering"""
+        return hashlib.sha256(f'{payload}|{fmt}|{scale}'.encode()).hexdigest()[:32]
+
+    def get_or_render(self, payload, fmt='png', scale=8):
+        """Return (key, image bytes, cache_hit)"""
+        key = self.key(payload, fmt, scale)
+        with self._lock:
+            image = self._entries.get(key)
+            if image is not None:
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                return key, image, True
+            self._stats['misses'] += 1
+
+        image = render(payload, fmt, scale)
+
+        with self._lock:
+            if key not in self._entries and len(image) <= self.max_bytes:
+                self._entries[key] = image
+                self._bytes += len(image)
+                while self._bytes > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._bytes -= len(evicted)
+                    self._stats['evictions'] += 1
+        return key, image, False
+
+    def stats(self):
+        """Snapshot of cache counters"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        stats['max_bytes'] = self.max_bytes
+        return stats
+
+
+class QRInvalid(QRError):
+    """Payload is malformed or its signature does not verify"""
+    status_code = 400
+
+
+class QRExpired(QRError):
+    """Payload is past its expiry"""
+    status_code = 410
+
+
+class QRReplayed(LedgerError):
+    """A one-time code has already been used"""
+    status_code = 409
+
+
+def decode_payload(key, payload, now=None):
+    """Verify a payload from encode_payload and return its fields"""
+    try:
+        prefix, body, signature = payload.strip().split('.')
+    except (AttributeError, ValueError):
+        raise QRInvalid('Unrecognized QR code')
+    if prefix != PAYLOAD_PREFIX:
+        raise QRInvalid('Unsupported QR code version')
+    expected = hmac.new(key, f'{prefix}.{body}'.encode(), hashlib.sha256).digest()[:SIGNATURE_BYTES]
+    try:
+        valid = hmac.compare_digest(expected, _b64decode(signature))
+        fields = json.loads(_b64decode(body)) if valid else None
+    except (ValueError, binascii.Error):
+        raise QRInvalid('Unrecognized QR code')
+    if not valid or not isinstance(fields, dict) or not {'r', 'c', 'e'} <= fields.keys():
+        raise QRInvalid('QR code signature is invalid')
+    if fields['e'] <= (now if now is not None else time.time()):
+        raise QRExpired('QR code has expired')
+    return fields
+
+
+def init_schema(conn):
+    """Create the consumed one-time nonce table"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS qr_nonces (
+            nonce TEXT PRIMARY KEY,
+            bucket INTEGER NOT NULL,
+            used_at REAL NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_qr_nonces_bucket
+        ON qr_nonces (bucket)
+    ''')
+
+
+class NonceStore:
+    """Replay protection for one-time QR codes.
+
+    Consumed nonces are written to ``qr_nonces`` inside the payment's own
+    transaction (the primary key makes a concurrent double use fail in
+    exactly one worker) and remembered in memory, grouped by the hour the
+    code expires. Repeat scans of a used code, the usual point-of-sale
+    burst, are answered from memory with no database access. Buckets are
+    dropped wholesale once every code in them has expired, because the
+    expiry check rejects those codes before replay is even considered;
+    their rows are deleted by a background thread.
+    """
+
+    def __init__(self, pool, bucket_seconds=3600):
+        self.pool = pool
+        self.bucket_seconds = bucket_seconds
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._next_sweep = 0.0
+        self._sweeper_pid = None
+        self._stats = {'memory_hits': 0, 'db_checks': 0, 'consumed': 0, 'replays': 0, 'swept': 0}
+
+    def _bucket(self, expires_at):
+        """Time bucket a code expiring at expires_at belongs to"""
+        return int(expires_at) // self.bucket_seconds
+
+    def is_used(self, nonce, expires_at):
+        """True if the one-time nonce has been consumed by any worker"""
+        self._maybe_sweep()
+        bucket = self._bucket(expires_at)
+        with self._lock:
+            if nonce in self._buckets.get(bucket, ()):
+                self._stats['memory_hits'] += 1
+                self._stats['replays'] += 1
+                return True
+            self._stats['db_checks'] += 1
+        with self.pool.connection() as conn:
+            used = conn.execute('SELECT 1 FROM qr_nonces WHERE nonce = ?', (nonce,)).fetchone() is not None
+        if used:
+            self.remember(nonce, expires_at)
+            with self._lock:
+                self._stats['replays'] += 1
+        return used
+
+    def consume(self, conn, nonce, expires_at):
+        """Record the nonce inside the caller's transaction; raises QRReplayed if already used"""
+        try:
+            conn.execute(
+                'INSERT INTO qr_nonces (nonce, bucket, used_at) VALUES (?, ?, ?)',
+                (nonce, self._bucket(expires_at), time.time())
+            )
+        except sqlite3.IntegrityError:
+            with self._lock:
+                self._stats['replays'] += 1
+            raise QRReplayed('QR code has already been used')
+
+    def claim(self, nonce, expires_at):
+        """Consume the nonce in a transaction of its own; raises QRReplayed if already used
+
+        For payments committed in another database (a shard), where the
+        nonce cannot join the payment's transaction: ``release`` it again
+        if the payment is rejected.
+        """
+        with self.pool.transaction() as conn:
+            self.consume(conn, nonce, expires_at)
+
+    def release(self, nonce):
+        """Forget a claimed nonce whose payment was rejected"""
+        with self.pool.transaction() as conn:
+            conn.execute('DELETE FROM qr_nonces WHERE nonce = ?', (nonce,))
+
+    def remember(self, nonce, expires_at):
+        """Cache a nonce known to be consumed"""
+        with self._lock:
+            self._buckets.setdefault(self._bucket(expires_at), set()).add(nonce)
+            self._stats['consumed'] += 1
+
+    def _maybe_sweep(self):
+        """Drop expired buckets from memory (no database access)"""
+        self._ensure_sweeper()
+        now = time.time()
+        if now < self._next_sweep:
+            return
+        current = self._bucket(now)
+        with self._lock:
+            if now < self._next_sweep:
+                return
+            self._next_sweep = now + self.bucket_seconds / 4
+            for bucket in [b for b in self._buckets if b < current]:
+                del self._buckets[bucket]
+
+    def sweep(self):
+        """Delete nonces of expired buckets from SQLite; returns the number removed"""
+        with self.pool.transaction() as conn:
+            cursor = conn.execute('DELETE FROM qr_nonces WHERE bucket < ?', (self._bucket(time.time()),))
+        with self._lock:
+            self._stats['swept'] += cursor.rowcount
+        return cursor.rowcount
+
+    def _ensure_sweeper(self):
+        """Start the background sweeper once per worker process"""
+        if self._sweeper_pid == os.getpid():
+            return
+        with self._lock:
+            if self._sweeper_pid == os.getpid():
+                return
+            self._sweeper_pid = os.getpid()
+        threading.Thread(target=self._sweep_loop, name='qr-nonce-sweeper', daemon=True).start()
+
+    def _sweep_loop(self):
+        """Periodically purge nonces of expired codes"""
+        while True:
+            time.sleep(self.bucket_seconds / 4)
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception('QR nonce sweep failed')
+
+    def stats(self):
+        """Snapshot of replay-check counters"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['buckets'] = len(self._buckets)
+            stats['nonces'] = sum(len(nonces) for nonces in self._buckets.values())
+        return stats
@@ -0,0 +1,229 @@
+"""
+NomadPay Backend API - Rate Limiting
+Token buckets shared by all workers through a memory-mapped table
+"""
+
+import fcntl
+import hashlib
+import logging
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_MAGIC = b'NPRL'
+_HEADER = struct.Struct('<4sII')
+_SLOT = struct.Struct('<Qdd')
+
+# Slots examined per lookup before evicting the stalest one
+PROBE_LENGTH = 16
+
+
+class RateLimitError(Exception):
+    """Raised for malformed limit specifications"""
+    status_code = 500
+
+
+def parse_limit(spec):
+    """'N/S' (N requests per S seconds, bursts of N) -> (burst, rate per second), or None if disabled"""
+    spec = (spec or '').strip()
+    if not spec or spec == '0':
+        return None
+    try:
+        count, _, seconds = spec.partition('/')
+        burst = float(count)
+        rate = burst / float(seconds or 1)
+    except ValueError:
+        raise RateLimitError(f'Invalid rate limit: {spec!r} (expected requests/seconds)')
+    if burst <= 0 or rate <= 0:
+        raise RateLimitError(f'Invalid rate limit: {spec!r}')
+    return burst, rate
+
+
+def _key_hash(key):
+    """Non-zero 64-bit hash of a bucket key (zero marks an empty slot)"""
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') or 1
+
+
+class SharedBuckets:
+    """Fixed-size table of token buckets in a file mapped by every worker.
+
+    Each slot is ``[u64 key hash][f64 tokens][f64 updated_at]``. Slots are
+    split into ``shards`` contiguous regions; a key only lives in its
+    shard, and a take holds that shard's thread lock plus an ``fcntl``
+    byte-range lock on the region, so workers serialise per shard rather
+    than on the whole table. Lookups probe ``PROBE_LENGTH`` slots and
+    reuse the stalest one when the key is absent, so the table never
+    grows; an evicted bucket would have refilled anyway unless the table
+    is far too small for the number of active keys.
+    """
+
+    def __init__(self, path, slots=65536, shards=64):
+        self.path = path
+        self.shards = shards
+        self.shard_slots = max(slots // shards, PROBE_LENGTH)
+        self.slots = self.shard_slots * shards
+        self._locks = [threading.Lock() for _ in range(shards)]
+        size = _HEADER.size + self.slots * _SLOT.size
+        self._file = open(path, 'a+b')
+        fcntl.lockf(self._file, fcntl.LOCK_EX)
+        try:
+            header = b''
+            if os.fstat(self._file.fileno()).st_size >= size:
+                header = os.pread(self._file.fileno(), _HEADER.size, 0)
+            if len(header) != _HEADER.size or _HEADER.unpack(header) != (_MAGIC, self.slots, shards):
+                if header:
+                    logger.warning(f'Rate limit table {path} has a different layout; resetting it')
+                self._file.truncate(0)
+                self._file.truncate(size)
+                os.pwrite(self._file.fileno(), _HEADER.pack(_MAGIC, self.slots, shards), 0)
+        finally:
+            fcntl.lockf(self._file, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._file.fileno(), size)
+
+    def take(self, key, burst, rate, now=None):
+        """Take one token from key's bucket; returns seconds to wait (0.0 if allowed)"""
+        now = time.time() if now is None else now
+        key_hash = _key_hash(key)
+        shard = key_hash % self.shards
+        first = shard * self.shard_slots
+        start = (key_hash // self.shards) % self.shard_slots
+        offset = _HEADER.size + first * _SLOT.size
+        length = self.shard_slots * _SLOT.size
+
+        with self._locks[shard]:
+            fcntl.lockf(self._file, fcntl.LOCK_EX, length, offset)
+            try:
+                position, tokens = self._find(first, start, key_hash, burst, rate, now)
+                if tokens >= 1.0:
+                    _SLOT.pack_into(self._map, position, key_hash, tokens - 1.0, now)
+                    return 0.0
+                _SLOT.pack_into(self._map, position, key_hash, tokens, now)
+                return (1.0 - tokens) / rate
+            finally:
+                fcntl.lockf(self._file, fcntl.LOCK_UN, length, offset)
+
+    def _find(self, first, start, key_hash, burst, rate, now):
+        """Slot offset for key_hash and its refilled token count (shard lock held)"""
+        stalest = None
+        for i in range(PROBE_LENGTH):
+            position = _HEADER.size + (first + (start + i) % self.shard_slots) * _SLOT.size
+            slot_hash, tokens, updated_at = _SLOT.unpack_from(self._map, position)
+            if slot_hash == key_hash:
+                return position, min(burst, tokens + max(now - updated_at, 0.0) * rate)
+            if slot_hash == 0:
+                return position, burst
+            if stalest is None or updated_at < stalest[1]:
+                stalest = (position, updated_at)
+        return stalest[0], burst
+
+    def close(self):
+        """Release the mapping"""
+        self._map.close()
+        self._file.close()
+
+
+class RateLimiter:
+    """Named per-IP and per-email limits for this worker.
+
+    Decisions are made by the shared table, so a limit holds across all
+    gunicorn workers. Once a key is rejected its retry time is kept in
+    this worker's sharded in-memory map, and further attempts on it are
+    turned away from memory until then; a sustained burst against one
+    account or address therefore costs a dict lookup per request, not a
+    shared-table round trip. Errors in the shared table fail open.
+    """
+
+    SHARDS = 16
+
+    def __init__(self, limits, path=None, slots=65536, max_blocked=100000):
+        self.limits = {name: parse_limit(spec) for name, spec in limits.items()}
+        self._path = path
+        self.slots = slots
+        self.max_blocked = max_blocked
+        self._lock = threading.Lock()
+        self._pid = None
+        self._buckets = None
+        self._blocked = [{} for _ in range(self.SHARDS)]
+        self._blocked_locks = [threading.Lock() for _ in range(self.SHARDS)]
+        self._stats = {'allowed': 0, 'rejected': 0, 'rejected_local': 0, 'errors': 0}
+
+    @property
+    def path(self):
+        """Shared table file; defaults to one per gunicorn arbiter"""
+        if self._path:
+            return self._path
+        return os.path.join(tempfile.gettempdir(), f'nomadpay-ratelimit-{os.getppid()}.bin')
+
+    def _get_buckets(self):
+        """This worker's mapping of the shared table, opened after fork"""
+        if self._pid == os.getpid():
+            return self._buckets
+        with self._lock:
+            if self._pid != os.getpid():
+                self._buckets = SharedBuckets(self.path, slots=self.slots)
+                self._blocked = [{} for _ in range(self.SHARDS)]
+                self._pid = os.getpid()
+        return self._buckets
+
+    def check(self, name, subject):
+        """Take a token for subject under the named limit; returns seconds to wait (0.0 if allowed)"""
+        limit = self.limits.get(name)
+        if limit is None:
+            return 0.0
+        key = f'{name}:{subject}'
+        now = time.time()
+        shard = hash(key) % self.SHARDS
+        blocked = self._blocked[shard]
+        until = blocked.get(key)
+        if until is not None:
+            if now < until:
+                self._count('rejected_local')
+                return until - now
+            with self._blocked_locks[shard]:
+                blocked.pop(key, None)
+
+        try:
+            wait = self._get_buckets().take(key, limit[0], limit[1], now)
+        except OSError as e:
+            logger.error(f"Rate limit table error: {e}")
+            self._count('errors')
+            return 0.0
+        if not wait:
+            self._count('allowed')
+            return 0.0
+        with self._blocked_locks[shard]:
+            if len(blocked) >= self.max_blocked // self.SHARDS:
+                for stale in [k for k, t in blocked.items() if t <= now]:
+                    del blocked[stale]
+                if len(blocked) >= self.max_blocked // self.SHARDS:
+                    blocked.clear()
+            blocked[key] = now + wait
+        self._count('rejected')
+        return wait
+
+    def _count(self, counter):
+        """Increment a stats counter"""
+        with self._lock:
+            self._stats[counter] += 1
+
+    def stats(self):
+        """Snapshot of rate limit counters for this worker"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats['blocked_keys'] = sum(len(blocked) for blocked in self._blocked)
+        stats['limits'] = {
+            name: f'{limit[0]:g}/{limit[0] / limit[1]:g}s' if limit else None
+            for name, limit in self.limits.items()
+        }
+        return stats
+
+
+def retry_after(seconds):
+    """Retry-After header value (whole seconds, at least 1)"""
+    return str(max(1, math.ceil(seconds)))
@@ -0,0 +1,1023 @@
+"""
+NomadPay Backend API - User Sharding
+Users, wallets and ledger rows split across SQLite files by user, with cross-shard transfers
+
+Usage:
+    python sharding.py init --directory directory.db shard0.db shard1.db
+    python sharding.py rebalance --directory directory.db shard0.db shard1.db shard2.db
+    python sharding.py resolve --directory directory.db shard0.db shard1.db
+    python sharding.py stats --directory directory.db shard0.db shard1.db
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import money
+from analytics import record_transfer
+from cache import record_balance_change
+from database import ConnectionPool
+from ledger import Ledger, LedgerError, InvalidTransfer, WalletNotFound, InsufficientFunds, LedgerUnavailable
+
+logger = logging.getLogger(__name__)
+
+# Each shard allocates AUTOINCREMENT ids from its own range, so wallet,
+# transaction and ledger entry ids stay unique when rows move between
+# shards. Ids are unique but not ordered across shards.
+ID_SPACE = 1 << 40
+SEQUENCED_TABLES = ('wallets', 'transactions', 'ledger_entries')
+
+# Tables that admin reads see across every shard (see ShardSet.dedicated)
+UNION_TABLES = ('users', 'wallets', 'ledger_entries', 'rollup_totals', 'rollup_buckets')
+
+# SQLite's default limit on attached databases
+MAX_ATTACHED = 10
+
+# Cross-shard transfer states in the directory; the switch from
+# 'preparing' to 'committed' is the commit point
+PREPARING = 'preparing'
+COMMITTED = 'committed'
+ABORTED = 'aborted'
+DONE = 'done'
+
+
+class ShardError(Exception):
+    """Raised for directory and rebalancing problems"""
+
+
+class ShardMoving(LedgerUnavailable):
+    """The user's rows are being moved to another shard"""
+    status_code = 503
+
+
+def placement(user_id, shard_count):
+    """Home shard of a new user (rendezvous hashing).
+
+    Adding a shard changes the placement of only about 1/N of the users,
+    which is what ``rebalance`` moves.
+    """
+    return max(
+        range(shard_count),
+        key=lambda shard: hashlib.blake2b(f'{shard}:{user_id}'.encode(), digest_size=8).digest()
+    )
+
+
+def connect_shard(conn):
+    """on_connect for shard pools
+
+    The other party of a cross-shard transfer, and the users moved away
+    by ``rebalance``, live in another file, so the ``users`` foreign keys
+    of ``transactions`` cannot hold on a shard.
+    """
+    money.register(conn)
+    conn.execute('PRAGMA foreign_keys=OFF')
+
+
+def init_directory_schema(conn):
+    """Create the email directory and the cross-shard transfer log"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_directory (
+            user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT UNIQUE NOT NULL,
+            shard INTEGER,
+            moving_to INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS shard_transfers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            reference TEXT UNIQUE NOT NULL,
+            sender_id INTEGER NOT NULL,
+            recipient_id INTEGER NOT NULL,
+            sender_shard INTEGER NOT NULL,
+            recipient_shard INTEGER NOT NULL,
+            currency TEXT NOT NULL,
+            amount_minor NOT NULL,
+            description TEXT,
+            state TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL,
+            updated_at TIMESTAMP NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_shard_transfers_state
+        ON shard_transfers (state, updated_at)
+    ''')
+
+
+def init_shard_schema(conn, index):
+    """Create the prepared-transfer table and reserve the shard's id range"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS prepared_transfers (
+            reference TEXT NOT NULL,
+            role TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            currency TEXT NOT NULL,
+            amount_minor NOT NULL,
+            transaction_id INTEGER,
+            created_at TIMESTAMP NOT NULL,
+            PRIMARY KEY (reference, role)
+        )
+    ''')
+    for table in SEQUENCED_TABLES:
+        conn.execute('''
+            INSERT INTO sqlite_sequence (name, seq)
+            SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?)
+        ''', (table, index * ID_SPACE, table))
+
+
+def _wallet(conn, user_id, currency):
+    """(wallet id, balance) of a user's wallet, or None"""
+    row = conn.execute(
+        'SELECT id, balance_minor FROM wallets WHERE user_id = ? AND currency = ?', (user_id, currency)
+    ).fetchone()
+    return (row[0], money.from_db(row[1])) if row else None
+
+
+def prepare_credit(conn, reference, recipient_id, currency, amount):
+    """Phase one on the recipient's shard: check the wallet and record the pending credit"""
+    if _wallet(conn, recipient_id, currency) is None:
+        raise WalletNotFound(f'Recipient has no {currency} wallet')
+    conn.execute('''
+        INSERT INTO prepared_transfers (reference, role, user_id, currency, amount_minor, created_at)
+        VALUES (?, 'credit', ?, ?, ?, ?)
+    ''', (reference, recipient_id, currency, money.to_db(amount), datetime.utcnow().isoformat()))
+
+
+def prepare_debit(conn, reference, sender_id, recipient_id, currency, amount, description=None, on_apply=None):
+    """Phase one on the sender's shard: debit the sender into a pending transaction
+
+    The funds leave the sender's wallet now, so later transfers cannot
+    spend them twice; ``abort_debit`` returns them. Returns the pending
+    transaction's id, the sender's new balance and its timestamp.
+    """
+    if on_apply is not None:
+        on_apply(conn)
+    wallet = _wallet(conn, sender_id, currency)
+    if wallet is None:
+        raise WalletNotFound(f'No {currency} wallet for sender')
+    wallet_id, balance = wallet
+    if balance < amount:
+        raise InsufficientFunds(f'Insufficient {currency} balance')
+    balance -= amount
+    created_at = datetime.utcnow().isoformat()
+    conn.execute('UPDATE wallets SET balance_minor = ? WHERE id = ?', (money.to_db(balance), wallet_id))
+    transaction_id = conn.execute('''
+        INSERT INTO transactions
+            (reference, sender_id, recipient_id, currency, amount_minor, status, description, created_at)
+        VALUES (?, ?, ?, ?, ?, 'pending', ?, ?)
+    ''', (reference, sender_id, recipient_id, currency, money.to_db(amount), description, created_at)).lastrowid
+    conn.execute('''
+        INSERT INTO ledger_entries
+            (transaction_id, wallet_id, user_id, currency, amount_minor, balance_after_minor, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (transaction_id, wallet_id, sender_id, currency, money.to_db(-amount), money.to_db(balance), created_at))
+    conn.execute('''
+        INSERT INTO prepared_transfers (reference, role, user_id, currency, amount_minor, transaction_id, created_at)
+        VALUES (?, 'debit', ?, ?, ?, ?, ?)
+    ''', (reference, sender_id, currency, money.to_db(amount), transaction_id, created_at))
+    record_balance_change(conn, [sender_id])
+    return transaction_id, balance, created_at
+
+
+def _prepared(conn, reference, role):
+    """(user_id, currency, amount, transaction_id, created_at) of a prepared side, or None"""
+    row = conn.execute('''
+        SELECT user_id, currency, amount_minor, transaction_id, created_at
+        FROM prepared_transfers WHERE reference = ? AND role = ?
+    ''', (reference, role)).fetchone()
+    if row is None:
+        return None
+    return row[0], row[1], money.from_db(row[2]), row[3], row[4]
+
+
+def commit_credit(conn, reference, sender_id, description=None):
+    """Phase two on the recipient's shard; returns the new balance, or None if already applied"""
+    prepared = _prepared(conn, reference, 'credit')
+    if prepared is None:
+        return None
+    recipient_id, currency, amount, _, _ = prepared
+    wallet_id, balance = _wallet(conn, recipient_id, currency)
+    balance += amount
+    created_at = datetime.utcnow().isoformat()
+    conn.execute('UPDATE wallets SET balance_minor = ? WHERE id = ?', (money.to_db(balance), wallet_id))
+    # A batch sends same-shard items through two-phase commit too; their
+    # credit joins the debit's transaction row instead of duplicating it
+    row = conn.execute('SELECT id FROM transactions WHERE reference = ?', (reference,)).fetchone()
+    if row is not None:
+        transaction_id = row[0]
+    else:
+        transaction_id = conn.execute('''
+            INSERT INTO transactions (reference, sender_id, recipient_id, currency, amount_minor, description, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (reference, sender_id, recipient_id, currency, money.to_db(amount), description, created_at)).lastrowid
+    conn.execute('''
+        INSERT INTO ledger_entries
+            (transaction_id, wallet_id, user_id, currency, amount_minor, balance_after_minor, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (transaction_id, wallet_id, recipient_id, currency, money.to_db(amount), money.to_db(balance), created_at))
+    conn.execute("DELETE FROM prepared_transfers WHERE reference = ? AND role = 'credit'", (reference,))
+    record_balance_change(conn, [recipient_id])
+    return balance
+
+
+def commit_debit(conn, reference):
+    """Phase two on the sender's shard: complete the pending transaction and count it in the rollups"""
+    prepared = _prepared(conn, reference, 'debit')
+    if prepared is None:
+        return False
+    _, currency, amount, transaction_id, created_at = prepared
+    conn.execute("UPDATE transactions SET status = 'completed' WHERE id = ?", (transaction_id,))
+    conn.execute("DELETE FROM prepared_transfers WHERE reference = ? AND role = 'debit'", (reference,))
+    record_transfer(conn, currency, amount, created_at)
+    return True
+
+
+def abort_credit(conn, reference):
+    """Forget a prepared credit"""
+    conn.execute("DELETE FROM prepared_transfers WHERE reference = ? AND role = 'credit'", (reference,))
+
+
+def abort_debit(conn, reference):
+    """Return prepared funds to the sender and mark the transaction failed"""
+    prepared = _prepared(conn, reference, 'debit')
+    if prepared is None:
+        return False
+    sender_id, currency, amount, transaction_id, _ = prepared
+    wallet_id, balance = _wallet(conn, sender_id, currency)
+    balance += amount
+    conn.execute('UPDATE wallets SET balance_minor = ? WHERE id = ?', (money.to_db(balance), wallet_id))
+    conn.execute("UPDATE transactions SET status = 'failed' WHERE id = ?", (transaction_id,))
+    conn.execute('''
+        INSERT INTO ledger_entries
+            (transaction_id, wallet_id, user_id, currency, amount_minor, balance_after_minor, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (transaction_id, wallet_id, sender_id, currency, money.to_db(amount), money.to_db(balance),
+          datetime.utcnow().isoformat()))
+    conn.execute("DELETE FROM prepared_transfers WHERE reference = ? AND role = 'debit'", (reference,))
+    record_balance_change(conn, [sender_id])
+    return True
+
+
+class _BatchRejected(Exception):
+    """Rolls back an atomic batch whose items did not all prepare"""
+
+
+def _in_savepoint(conn, step, *args, keep=False, **kwargs):
+    """Run one prepare step under a SAVEPOINT; returns its LedgerError instead of raising
+
+    Without ``keep`` the step's return value is dropped (None means success).
+    """
+    conn.execute('SAVEPOINT prepare')
+    try:
+        result = step(*args, **kwargs)
+    except LedgerError as e:
+        conn.execute('ROLLBACK TO prepare')
+        conn.execute('RELEASE prepare')
+        return e
+    conn.execute('RELEASE prepare')
+    return result if keep else None
+
+
+class ShardSet:
+    """A directory database plus N shard databases, one pool each per worker.
+
+    The directory maps email -> user_id and records each user's shard; it
+    also allocates user ids, so ids are unique across shards. New users
+    are placed with ``placement``; afterwards the directory row is the
+    source of truth, which is what lets ``rebalance`` move users. Shard
+    lookups are cached for ``placement_ttl`` seconds, so a move waits at
+    least that long after flagging a user before copying their rows.
+
+    ``directory`` is a path or an existing ConnectionPool (the app passes
+    its main pool, so the directory shares the file with global tables).
+    """
+
+    def __init__(self, directory, shard_paths, placement_ttl=1.0, **pool_options):
+        if not shard_paths:
+            raise ShardError('at least one shard is required')
+        if isinstance(directory, ConnectionPool):
+            self.directory = directory
+        else:
+            self.directory = ConnectionPool(directory, **pool_options)
+        pool_options['on_connect'] = connect_shard
+        self.shards = [ConnectionPool(path, **pool_options) for path in shard_paths]
+        self.placement_ttl = placement_ttl
+        self._lock = threading.Lock()
+        self._placements = {}
+        self._stats = {'lookups': 0, 'cache_hits': 0, 'moving': 0}
+
+    def init_schema(self, create_tables):
+        """Create directory tables and, on every shard, ``create_tables(conn)`` plus shard bookkeeping"""
+        with self.directory.transaction() as conn:
+            init_directory_schema(conn)
+        for index, pool in enumerate(self.shards):
+            with pool.transaction() as conn:
+                create_tables(conn)
+                init_shard_schema(conn, index)
+
+    def create_user(self, email, insert):
+        """Allocate a user id, then run ``insert(conn, user_id)`` in a transaction on the user's shard.
+
+        Raises sqlite3.IntegrityError if the email is taken. The directory
+        row is removed again if the shard insert fails.
+        """
+        with self.directory.transaction() as conn:
+            user_id = conn.execute(
+                'INSERT INTO user_directory (email, created_at) VALUES (?, ?)',
+                (email, datetime.utcnow().isoformat())
+            ).lastrowid
+            shard = placement(user_id, len(self.shards))
+            conn.execute('UPDATE user_directory SET shard = ? WHERE user_id = ?', (shard, user_id))
+        try:
+            with self.shards[shard].transaction() as conn:
+                insert(conn, user_id)
+        except BaseException:
+            with self.directory.transaction() as conn:
+                conn.execute('DELETE FROM user_directory WHERE user_id = ?', (user_id,))
+            raise
+        return user_id
+
+    def locate(self, email):
+        """(user_id, shard) for an email (login), or None"""
+        with self.directory.connection() as conn:
+            row = conn.execute(
+                'SELECT user_id, shard, moving_to FROM user_directory WHERE email = ?', (email,)
+            ).fetchone()
+        if row is None or row[1] is None:
+            return None
+        if row[2] is not None:
+            raise ShardMoving('Account is being migrated. Please try again shortly.')
+        return row[0], row[1]
+
+    def shard_of(self, user_id):
+        """Index of the user's shard, or None for unknown users; raises ShardMoving mid-move"""
+        now = time.monotonic()
+        with self._lock:
+            self._stats['lookups'] += 1
+            cached = self._placements.get(user_id)
+            if cached is not None and cached[1] > now:
+                self._stats['cache_hits'] += 1
+                return cached[0]
+        with self.directory.connection() as conn:
+            row = conn.execute(
+                'SELECT shard, moving_to FROM user_directory WHERE user_id = ?', (user_id,)
+            ).fetchone()
+        if row is None or row[0] is None:
+            return None
+        if row[1] is not None:
+            with self._lock:
+                self._stats['moving'] += 1
+            raise ShardMoving('Account is being migrated. Please try again shortly.')
+        with self._lock:
+            self._placements[user_id] = (row[0], now + self.placement_ttl)
+        return row[0]
+
+    def pool_for(self, user_id):
+        """Connection pool of the user's shard, or None for unknown users"""
+        shard = self.shard_of(user_id)
+        return self.shards[shard] if shard is not None else None
+
+    def lookup(self, emails):
+        """{email: user_id} for the placed users among emails (recipient lookups)"""
+        emails = sorted(set(emails))
+        found = {}
+        with self.directory.connection() as conn:
+            for start in range(0, len(emails), 500):
+                chunk = emails[start:start + 500]
+                found.update(conn.execute(f'''
+                    SELECT email, user_id FROM user_directory
+                    WHERE email IN ({', '.join('?' * len(chunk))}) AND shard IS NOT NULL
+                ''', chunk).fetchall())
+        return found
+
+    def emails(self, user_ids):
+        """{user_id: email} from the directory, for counterparties on other shards"""
+        user_ids = sorted(set(user_ids))
+        found = {}
+        with self.directory.connection() as conn:
+            for start in range(0, len(user_ids), 500):
+                chunk = user_ids[start:start + 500]
+                found.update(conn.execute(
+                    f"SELECT user_id, email FROM user_directory WHERE user_id IN ({', '.join('?' * len(chunk))})",
+                    chunk
+                ).fetchall())
+        return found
+
+    @contextmanager
+    def dedicated(self):
+        """Read-only connection that sees every shard, for admin listings and analytics
+
+        Shards are attached to a fresh directory connection and TEMP views
+        named after the UNION_TABLES shadow the directory's own (empty)
+        copies, so the single-database queries run unchanged. The
+        ``transactions`` view keeps only the sender's row of a cross-shard
+        transfer (the sender's shard holds its users row). Limited to
+        MAX_ATTACHED shards.
+        """
+        if len(self.shards) > MAX_ATTACHED:
+            raise ShardError(f'cross-shard reads support at most {MAX_ATTACHED} shards')
+        with self.directory.dedicated() as conn:
+            for index, pool in enumerate(self.shards):
+                conn.execute(f'ATTACH DATABASE ? AS s{index}', (pool.path,))
+            for table in UNION_TABLES:
+                union = ' UNION ALL '.join(f'SELECT * FROM s{index}.{table}' for index in range(len(self.shards)))
+                conn.execute(f'CREATE TEMP VIEW {table} AS {union}')
+            union = ' UNION ALL '.join(
+                f'SELECT t.* FROM s{index}.transactions t '
+                f'WHERE EXISTS (SELECT 1 FROM s{index}.users u WHERE u.id = t.sender_id)'
+                for index in range(len(self.shards))
+            )
+            conn.execute(f'CREATE TEMP VIEW transactions AS {union}')
+            yield conn
+
+    def stats(self):
+        """Snapshot of lookup counters and per-shard pool usage"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['cached_placements'] = len(self._placements)
+        stats['directory'] = self.directory.stats()
+        stats['shards'] = [pool.stats() for pool in self.shards]
+        return stats
+
+
+class ShardedLedger:
+    """Transfers across a ShardSet.
+
+    Transfers between users on the same shard go through that shard's
+    ``Ledger`` (with its group commit), so shards commit independently
+    and write throughput grows with the shard count. Transfers between
+    shards use two-phase commit coordinated through ``shard_transfers``
+    in the directory: prepare the credit on the recipient's shard, debit
+    the sender into a pending transaction, flip the directory row to
+    ``committed`` (the commit point), then apply the credit and complete
+    the debit. ``resolve`` finishes committed transfers and aborts
+    stalled ones after a crash; every step is idempotent, and every
+    worker runs it on a background thread every ``resolve_interval``
+    seconds once it has made a transfer.
+    """
+
+    def __init__(self, shard_set, resolve_after=30.0, resolve_interval=10.0, **ledger_options):
+        self.shard_set = shard_set
+        self.resolve_after = resolve_after
+        self.resolve_interval = resolve_interval
+        self.ledgers = [Ledger(pool, **ledger_options) for pool in shard_set.shards]
+        for shard_ledger in self.ledgers:
+            shard_ledger.on_commit(self._run_commit_hooks)
+        self._lock = threading.Lock()
+        self._commit_hooks = []
+        self._resolver_pid = None
+        self._stats = {'cross_shard': 0, 'aborted': 0, 'resolved_committed': 0, 'resolved_aborted': 0,
+                       'resolve_errors': 0}
+
+    def on_commit(self, callback):
+        """Register callback(results) to run after transfers commit on any shard"""
+        self._commit_hooks.append(callback)
+        return callback
+
+    def _run_commit_hooks(self, results):
+        """Notify listeners about committed transfers"""
+        if not results:
+            return
+        for callback in self._commit_hooks:
+            try:
+                callback(results)
+            except Exception:
+                logger.exception('Sharded ledger commit hook failed')
+
+    def _shard(self, user_id, role):
+        """Shard index of a transfer party"""
+        shard = self.shard_set.shard_of(user_id)
+        if shard is None:
+            raise WalletNotFound(f'Unknown {role}')
+        return shard
+
+    def transfer(self, sender_id, recipient_id, currency, amount, description=None, on_apply=None,
+                 on_applied=None, on_abort=None):
+        """Move amount (minor units) from sender to recipient; returns the committed transaction
+
+        ``on_apply`` runs with the debit and ``on_applied`` when it
+        completes, both in transactions on the sender's shard. A prepared
+        transfer can still be aborted by the resolver; ``on_abort(conn)``
+        then undoes ``on_apply``'s records in a sender-shard transaction.
+        """
+        if sender_id == recipient_id:
+            raise InvalidTransfer('Cannot send money to yourself')
+        self._ensure_resolver()
+        sender_shard = self._shard(sender_id, 'sender')
+        recipient_shard = self._shard(recipient_id, 'recipient')
+        if sender_shard == recipient_shard:
+            return self.ledgers[sender_shard].transfer(sender_id, recipient_id, currency, amount,
+                                                       description, on_apply, on_applied)
+
+        reference = 'tx_' + uuid.uuid4().hex
+        now = datetime.utcnow().isoformat()
+        with self.shard_set.directory.transaction() as conn:
+            conn.execute('''
+                INSERT INTO shard_transfers (reference, sender_id, recipient_id, sender_shard, recipient_shard,
+                                             currency, amount_minor, description, state, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (reference, sender_id, recipient_id, sender_shard, recipient_shard, currency,
+                  money.to_db(amount), description, PREPARING, now, now))
+        record = (reference, sender_id, sender_shard, recipient_shard, description)
+        try:
+            with self.shard_set.shards[recipient_shard].transaction() as conn:
+                prepare_credit(conn, reference, recipient_id, currency, amount)
+            with self.shard_set.shards[sender_shard].transaction() as conn:
+                transaction_id, sender_balance, created_at = prepare_debit(
+                    conn, reference, sender_id, recipient_id, currency, amount, description, on_apply
+                )
+        except Exception as e:
+            try:
+                self._abort(record)
+            except Exception:
+                logger.exception(f'Cross-shard transfer {reference} not aborted; the resolver will retry')
+            self._record(aborted=1)
+            if isinstance(e, LedgerError):
+                raise
+            raise LedgerUnavailable(f'Transfer could not be committed: {e}')
+
+        if not self._decide(reference, COMMITTED):
+            # The resolver gave up on this transfer while it was preparing
+            self._abort_many([record])
+            self._undo_apply(sender_shard, on_abort)
+            raise LedgerUnavailable('Transfer timed out; check transaction history before retrying')
+        result = {
+            'id': transaction_id,
+            'reference': reference,
+            'sender_id': sender_id,
+            'recipient_id': recipient_id,
+            'currency': currency,
+            'amount': money.to_number(amount, currency),
+            'amount_minor': amount,
+            'sender_balance': money.to_number(sender_balance, currency),
+            'recipient_balance': None,
+            'status': 'completed',
+            'created_at': created_at
+        }
+
+        def debited(conn, balances):
+            result['recipient_balance'] = money.to_number(balances[reference] or 0, currency)
+            if on_applied is not None:
+                on_applied(conn, [result])
+        try:
+            self._finish_many([record], debited)
+        except Exception as e:
+            logger.error(f'Cross-shard transfer {reference} committed but not finished: {e}')
+            raise LedgerUnavailable('Transfer is still pending; check transaction history before retrying')
+        self._record(cross_shard=1)
+        self._run_commit_hooks([result])
+        return result
+
+    def transfer_batch(self, sender_id, items, atomic=True, on_apply=None, on_applied=None, on_abort=None):
+        """Apply a payout batch; returns a result or LedgerError per item (see ledger.apply_batch)
+
+        A batch whose recipients all share the sender's shard is one
+        transaction on that shard's Ledger. Otherwise every item goes
+        through two-phase commit, grouped so each phase is one transaction
+        per shard and the directory decides all items at once; in
+        ``atomic`` mode that decision is all or nothing. The hooks run as
+        in ``transfer``; ``on_applied`` gets the completed results, and
+        ``on_abort`` runs if no prepared item is committed.
+        """
+        self._ensure_resolver()
+        sender_shard = self._shard(sender_id, 'sender')
+        recipient_shards = [self.shard_set.shard_of(item[0]) for item in items]
+        if all(shard in (None, sender_shard) for shard in recipient_shards):
+            return self.ledgers[sender_shard].transfer_batch(sender_id, items, atomic=atomic, on_apply=on_apply,
+                                                             on_applied=on_applied)
+
+        outcomes = [None] * len(items)
+        for index, (recipient_id, currency, _, _) in enumerate(items):
+            if recipient_id == sender_id:
+                outcomes[index] = InvalidTransfer('Cannot send money to yourself')
+            elif recipient_shards[index] is None:
+                outcomes[index] = WalletNotFound(f'Recipient has no {currency} wallet')
+        if atomic and any(outcomes):
+            return outcomes
+
+        records = {}
+        now = datetime.utcnow().isoformat()
+        with self.shard_set.directory.transaction() as conn:
+            for index, (recipient_id, currency, amount, description) in enumerate(items):
+                if outcomes[index] is not None:
+                    continue
+                reference = 'tx_' + uuid.uuid4().hex
+                conn.execute('''
+                    INSERT INTO shard_transfers (reference, sender_id, recipient_id, sender_shard, recipient_shard,
+                                                 currency, amount_minor, description, state, created_at, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (reference, sender_id, recipient_id, sender_shard, recipient_shards[index], currency,
+                      money.to_db(amount), description, PREPARING, now, now))
+                records[index] = (reference, sender_id, sender_shard, recipient_shards[index], description)
+
+        debits = {}
+        try:
+            by_shard = {}
+            for index in records:
+                by_shard.setdefault(recipient_shards[index], []).append(index)
+            for recipient_shard, indexes in by_shard.items():
+                with self.shard_set.shards[recipient_shard].transaction() as conn:
+                    for index in indexes:
+                        recipient_id, currency, amount, _ = items[index]
+                        outcomes[index] = _in_savepoint(
+                            conn, prepare_credit, conn, records[index][0], recipient_id, currency, amount
+                        )
+            if not (atomic and any(outcomes)):
+                with self.shard_set.shards[sender_shard].transaction() as conn:
+                    for index, record in records.items():
+                        if outcomes[index] is not None:
+                            continue
+                        recipient_id, currency, amount, description = items[index]
+                        prepared = _in_savepoint(conn, prepare_debit, conn, record[0], sender_id, recipient_id,
+                                                 currency, amount, description, keep=True)
+                        if isinstance(prepared, LedgerError):
+                            outcomes[index] = prepared
+                        else:
+                            debits[index] = prepared
+                    if atomic and any(outcomes):
+                        raise _BatchRejected()
+                    if debits and on_apply is not None:
+                        on_apply(conn)
+        except Exception as e:
+            debits = {}
+            if not isinstance(e, _BatchRejected):
+                self._abort_many(records.values())
+                if isinstance(e, LedgerError):
+                    raise
+                logger.error(f'Cross-shard batch failed: {e}')
+                raise LedgerUnavailable('Batch could not be committed; check transaction history before retrying')
+
+        self._abort_many(record for index, record in records.items() if index not in debits)
+        if not debits:
+            return [outcome if isinstance(outcome, LedgerError) else None for outcome in outcomes]
+
+        with self.shard_set.directory.transaction() as conn:
+            conn.execute('SAVEPOINT decide')
+            decided = [
+                index for index in debits
+                if conn.execute(
+                    'UPDATE shard_transfers SET state = ?, updated_at = ? WHERE reference = ? AND state = ?',
+                    (COMMITTED, datetime.utcnow().isoformat(), records[index][0], PREPARING)
+                ).rowcount == 1
+            ]
+            if atomic and len(decided) < len(debits):
+                # The resolver aborted part of the batch; abort the rest too
+                conn.execute('ROLLBACK TO decide')
+                decided = []
+            conn.execute('RELEASE decide')
+        self._abort_many(records[index] for index in debits if index not in decided)
+        for index in debits:
+            if index not in decided:
+                outcomes[index] = LedgerUnavailable('Transfer timed out; check transaction history before retrying')
+        if not decided:
+            self._undo_apply(sender_shard, on_abort)
+            return outcomes
+
+        results = []
+
+        def debited(conn, balances):
+            for index in decided:
+                recipient_id, currency, amount, _ = items[index]
+                transaction_id, sender_balance, created_at = debits[index]
+                outcomes[index] = {
+                    'id': transaction_id,
+                    'reference': records[index][0],
+                    'sender_id': sender_id,
+                    'recipient_id': recipient_id,
+                    'currency': currency,
+                    'amount': money.to_number(amount, currency),
+                    'amount_minor': amount,
+                    'sender_balance': money.to_number(sender_balance, currency),
+                    'recipient_balance': money.to_number(balances[records[index][0]] or 0, currency),
+                    'status': 'completed',
+                    'created_at': created_at
+                }
+                results.append(outcomes[index])
+            if on_applied is not None:
+                on_applied(conn, results)
+        try:
+            self._finish_many([records[index] for index in decided], debited)
+        except Exception as e:
+            logger.error(f'Cross-shard batch committed but not finished: {e}')
+            raise LedgerUnavailable('Batch is still pending; check transaction history before retrying')
+        self._record(cross_shard=len(results))
+        self._run_commit_hooks(results)
+        return outcomes
+
+    def _abort_many(self, records):
+        """Abort prepared transfers, leaving stubborn ones to the resolver"""
+        for record in records:
+            try:
+                self._abort(record)
+            except Exception:
+                logger.exception(f'Cross-shard transfer {record[0]} not aborted; the resolver will retry')
+            self._record(aborted=1)
+
+    def _undo_apply(self, sender_shard, on_abort):
+        """Run on_abort once every debit made with on_apply is known to be aborted
+
+        A transfer that was not moved to ``committed`` never commits (the
+        resolver only aborts it), so this is safe even if some aborts were
+        left to the resolver.
+        """
+        if on_abort is None:
+            return
+        try:
+            with self.shard_set.shards[sender_shard].transaction() as conn:
+                on_abort(conn)
+        except Exception:
+            logger.exception('Abort hook failed')
+
+    def _decide(self, reference, state):
+        """Move a preparing transfer to committed or aborted; False if another process decided first"""
+        with self.shard_set.directory.transaction() as conn:
+            return conn.execute(
+                'UPDATE shard_transfers SET state = ?, updated_at = ? WHERE reference = ? AND state = ?',
+                (state, datetime.utcnow().isoformat(), reference, PREPARING)
+            ).rowcount == 1
+
+    def _finish(self, record):
+        """Apply phase two on both shards and mark the transfer done; returns the recipient's balance"""
+        return self._finish_many([record])[record[0]]
+
+    def _finish_many(self, records, on_debit=None):
+        """Phase two for many decided transfers: one transaction per shard touched.
+
+        Returns {reference: recipient balance (None if already applied)}.
+        ``on_debit(conn, balances)`` runs in each sender shard's transaction
+        after its debits complete.
+        """
+        by_shard = {}
+        for record in records:
+            by_shard.setdefault(record[3], []).append(record)
+        balances = {}
+        for recipient_shard, group in by_shard.items():
+            with self.shard_set.shards[recipient_shard].transaction() as conn:
+                for reference, sender_id, _, _, description in group:
+                    balances[reference] = commit_credit(conn, reference, sender_id, description)
+        by_shard = {}
+        for record in records:
+            by_shard.setdefault(record[2], []).append(record)
+        for sender_shard, group in by_shard.items():
+            with self.shard_set.shards[sender_shard].transaction() as conn:
+                for record in group:
+                    commit_debit(conn, record[0])
+                if on_debit is not None:
+                    on_debit(conn, balances)
+        now = datetime.utcnow().isoformat()
+        with self.shard_set.directory.transaction() as conn:
+            conn.executemany('UPDATE shard_transfers SET state = ?, updated_at = ? WHERE reference = ?',
+                             [(DONE, now, record[0]) for record in records])
+        return balances
+
+    def _abort(self, record):
+        """Undo whatever was prepared on both shards unless the transfer already committed"""
+        reference, _, sender_shard, recipient_shard, _ = record
+        self._decide(reference, ABORTED)
+        with self.shard_set.directory.connection() as conn:
+            state = conn.execute('SELECT state FROM shard_transfers WHERE reference = ?', (reference,)).fetchone()
+        if state is None or state[0] != ABORTED:
+            return False
+        with self.shard_set.shards[sender_shard].transaction() as conn:
+            abort_debit(conn, reference)
+        with self.shard_set.shards[recipient_shard].transaction() as conn:
+            abort_credit(conn, reference)
+        return True
+
+    def _set_state(self, reference, state):
+        """Record the final state of a transfer"""
+        with self.shard_set.directory.transaction() as conn:
+            conn.execute('UPDATE shard_transfers SET state = ?, updated_at = ? WHERE reference = ?',
+                         (state, datetime.utcnow().isoformat(), reference))
+
+    def resolve(self, older_than=None):
+        """Finish committed and abort stalled cross-shard transfers untouched for older_than seconds"""
+        older_than = self.resolve_after if older_than is None else older_than
+        cutoff = (datetime.utcnow() - timedelta(seconds=older_than)).isoformat()
+        with self.shard_set.directory.connection() as conn:
+            rows = conn.execute('''
+                SELECT reference, sender_id, sender_shard, recipient_shard, description, state
+                FROM shard_transfers WHERE state IN (?, ?) AND updated_at <= ?
+            ''', (PREPARING, COMMITTED, cutoff)).fetchall()
+        counts = {'committed': 0, 'aborted': 0}
+        for *record, state in rows:
+            if state == COMMITTED:
+                self._finish(record)
+                counts['committed'] += 1
+            elif self._abort(record):
+                counts['aborted'] += 1
+        self._record(resolved_committed=counts['committed'], resolved_aborted=counts['aborted'])
+        return counts
+
+    def _ensure_resolver(self):
+        """Start the background resolver once per worker process"""
+        if self._resolver_pid == os.getpid():
+            return
+        with self._lock:
+            if self._resolver_pid == os.getpid():
+                return
+            self._resolver_pid = os.getpid()
+        threading.Thread(target=self._resolve_loop, name='shard-resolver', daemon=True).start()
+
+    def _resolve_loop(self):
+        """Periodically finish or abort cross-shard transfers left behind by crashes"""
+        while True:
+            time.sleep(self.resolve_interval)
+            try:
+                self.resolve()
+            except Exception:
+                self._record(resolve_errors=1)
+                logger.exception('Cross-shard transfer resolution failed')
+
+    def _record(self, **counts):
+        """Update counters"""
+        with self._lock:
+            for name, value in counts.items():
+                self._stats[name] += value
+
+    def stats(self):
+        """Snapshot of cross-shard counters and each shard's ledger counters"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats['shards'] = [shard_ledger.stats() for shard_ledger in self.ledgers]
+        return stats
+
+
+def _columns(conn, table):
+    """Column names of a table, in declaration order"""
+    return [row[1] for row in conn.execute(f'PRAGMA main.table_info({table})')]
+
+
+def _copy_user(conn, user_id):
+    """Copy a user's rows from the attached ``src`` shard into main (idempotent)"""
+    for table, where in (('users', 'id = ?'), ('wallets', 'user_id = ?')):
+        columns = ', '.join(_columns(conn, table))
+        conn.execute(f'INSERT OR REPLACE INTO main.{table} ({columns}) '
+                     f'SELECT {columns} FROM src.{table} WHERE {where}', (user_id,))
+    # A transfer between this user and a user already on the target has a
+    # row there under the same reference (the other side of a cross-shard
+    # transfer); entries are pointed at that row instead of a copy
+    columns = ', '.join(_columns(conn, 'transactions'))
+    conn.execute(f'''
+        INSERT OR IGNORE INTO main.transactions ({columns})
+        SELECT {columns} FROM src.transactions
+        WHERE id IN (SELECT transaction_id FROM src.ledger_entries WHERE user_id = ?)
+    ''', (user_id,))
+    columns = [column for column in _columns(conn, 'ledger_entries') if column != 'transaction_id']
+    conn.execute(f'''
+        INSERT OR REPLACE INTO main.ledger_entries (transaction_id, {', '.join(columns)})
+        SELECT COALESCE((SELECT t.id FROM main.transactions t WHERE t.reference = st.reference), e.transaction_id),
+               {', '.join('e.' + column for column in columns)}
+        FROM src.ledger_entries e JOIN src.transactions st ON st.id = e.transaction_id
+        WHERE e.user_id = ?
+    ''', (user_id,))
+    # Idempotency keys are scoped "<user_id>:<key>" (app.idempotent) and
+    # live on the user's shard, so retries after the move still replay
+    prefix = f'{user_id}:'
+    conn.execute('''
+        INSERT OR REPLACE INTO main.idempotency_keys SELECT * FROM src.idempotency_keys
+        WHERE substr(key, 1, ?) = ?
+    ''', (len(prefix), prefix))
+    record_balance_change(conn, [user_id])
+
+
+def _delete_user(conn, user_id):
+    """Remove a moved user's rows from their old shard"""
+    conn.execute('DELETE FROM ledger_entries WHERE user_id = ?', (user_id,))
+    conn.execute('DELETE FROM wallets WHERE user_id = ?', (user_id,))
+    conn.execute('DELETE FROM users WHERE id = ?', (user_id,))
+    prefix = f'{user_id}:'
+    conn.execute('DELETE FROM idempotency_keys WHERE substr(key, 1, ?) = ?', (len(prefix), prefix))
+    conn.execute('''
+        DELETE FROM transactions WHERE (sender_id = ? OR recipient_id = ?)
+        AND NOT EXISTS (SELECT 1 FROM ledger_entries e WHERE e.transaction_id = transactions.id)
+    ''', (user_id, user_id))
+    record_balance_change(conn, [user_id])
+
+
+def move_users(shard_set, moves, grace):
+    """Move users to new shards; ``moves`` maps user_id -> target shard.
+
+    Users are flagged as moving (transfers touching them get
+    ShardMoving), then after ``grace`` seconds (longer than the placement
+    cache TTL plus the ledger timeout, so no stale write is in flight)
+    their rows are copied, deleted from the old shard and the directory
+    is switched. Users with an unfinished cross-shard transfer are skipped.
+    Safe to re-run after an interruption. Returns the number moved.
+    """
+    with shard_set.directory.transaction() as conn:
+        busy = {
+            row[0] for row in conn.execute(f'''
+                SELECT sender_id FROM shard_transfers WHERE state IN ('{PREPARING}', '{COMMITTED}')
+                UNION SELECT recipient_id FROM shard_transfers WHERE state IN ('{PREPARING}', '{COMMITTED}')
+            ''')
+        }
+        flagged = {}
+        for user_id, target in moves.items():
+            if user_id in busy:
+                continue
+            row = conn.execute('SELECT shard, moving_to FROM user_directory WHERE user_id = ?', (user_id,)).fetchone()
+            if row is None or row[0] == target:
+                continue
+            conn.execute('UPDATE user_directory SET moving_to = ? WHERE user_id = ?', (target, user_id))
+            flagged[user_id] = (row[0], target)
+    if not flagged:
+        return 0
+    time.sleep(grace)
+
+    by_route = {}
+    for user_id, route in flagged.items():
+        by_route.setdefault(route, []).append(user_id)
+    for (source, target), user_ids in by_route.items():
+        with shard_set.shards[target].dedicated() as conn:
+            conn.execute('ATTACH DATABASE ? AS src', (shard_set.shards[source].path,))
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                for user_id in user_ids:
+                    _copy_user(conn, user_id)
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+            conn.execute('DETACH DATABASE src')
+        # Delete before switching the directory: a re-run after a crash
+        # here copies nothing more and still finds the rows on the target
+        with shard_set.shards[source].transaction() as conn:
+            for user_id in user_ids:
+                _delete_user(conn, user_id)
+        with shard_set.directory.transaction() as conn:
+            conn.executemany(
+                'UPDATE user_directory SET shard = moving_to, moving_to = NULL WHERE user_id = ?',
+                [(user_id,) for user_id in user_ids]
+            )
+    return len(flagged)
+
+
+def rebalance(shard_set, batch_size=500, grace=15.0, progress=print):
+    """Move every user whose placement differs from their shard (after adding shards)"""
+    shard_count = len(shard_set.shards)
+    with shard_set.directory.connection() as conn:
+        rows = conn.execute(
+            'SELECT user_id, shard, moving_to FROM user_directory WHERE shard IS NOT NULL'
+        ).fetchall()
+    pending = []
+    for user_id, shard, moving_to in rows:
+        # Interrupted moves resume with their original target
+        target = moving_to if moving_to is not None else placement(user_id, shard_count)
+        if target != shard:
+            pending.append((user_id, target))
+    moved = 0
+    for start in range(0, len(pending), batch_size):
+        moved += move_users(shard_set, dict(pending[start:start + batch_size]), grace)
+        progress(f'moved {moved} of {len(pending)} users')
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(description='NomadPay shard tools')
+    parser.add_argument('command', choices=('init', 'rebalance', 'resolve', 'stats'))
+    parser.add_argument('shards', nargs='+', help='shard database files, in shard order')
+    parser.add_argument('--directory', required=True, help='directory database file')
+    parser.add_argument('--grace', type=float, default=15.0, help='seconds between flagging and moving users')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--older-than', type=float, default=30.0, help='resolve transfers idle this long')
+    args = parser.parse_args()
+
+    shard_set = ShardSet(args.directory, args.shards)
+    if args.command == 'init':
+        os.environ.setdefault('DATABASE_URL', args.directory)
+        import app as nomadpay
+        shard_set.init_schema(nomadpay.create_tables)
+        print(f'initialised directory and {len(args.shards)} shards')
+    elif args.command == 'rebalance':
+        rebalance(shard_set, batch_size=args.batch_size, grace=args.grace)
+    elif args.command == 'resolve':
+        print(json.dumps(ShardedLedger(shard_set).resolve(args.older_than)))
+    else:
+        with shard_set.directory.connection() as conn:
+            placements = conn.execute('SELECT user_id, shard, moving_to FROM user_directory').fetchall()
+            states = dict(conn.execute('SELECT state, COUNT(*) FROM shard_transfers GROUP BY state').fetchall())
+        users = {}
+        for _, shard, _ in placements:
+            users[shard] = users.get(shard, 0) + 1
+        print(json.dumps({
+            'users_per_shard': {str(index): users.get(index, 0) for index in range(len(args.shards))},
+            'misplaced': sum(1 for user_id, shard, _ in placements if placement(user_id, len(args.shards)) != shard),
+            'moving': sum(1 for _, _, moving_to in placements if moving_to is not None),
+            'cross_shard_transfers': states
+        }, indent=2))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
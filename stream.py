@@ -0,0 +1,248 @@
+"""
+NomadPay Backend API - Wallet Event Stream
+Server-Sent Events for balance changes and new transactions, fanned out per worker
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Entries replayed on reconnect before the client is told to reload instead
+MAX_REPLAY = 100
+
+
+class StreamUnavailable(Exception):
+    """Raised when this worker already holds its maximum number of streams"""
+    status_code = 503
+
+
+def format_event(event, data, event_id=None):
+    """One SSE message"""
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event}')
+    lines.append('data: ' + json.dumps(data, separators=(',', ':')))
+    return '\n'.join(lines) + '\n\n'
+
+
+def parse_event_id(value):
+    """Last-Event-ID as a ledger entry id, or None if absent or malformed"""
+    try:
+        event_id = int(value)
+    except (TypeError, ValueError):
+        return None
+    return event_id if event_id >= 0 else None
+
+
+class Subscription:
+    """One open stream; woken whenever its user's wallets may have changed"""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self._event = threading.Event()
+
+    def wake(self):
+        """Signal that there may be new entries"""
+        self._event.set()
+
+    def wait(self, timeout):
+        """Block until woken or timeout; True if woken"""
+        # Only clear after a wake: a set that lands after a timeout must
+        # still wake the next wait
+        woken = self._event.wait(timeout)
+        if woken:
+            self._event.clear()
+        return woken
+
+
+class StreamHub:
+    """Fan-out of wallet changes to the streams open in this worker.
+
+    Streams register a ``Subscription`` per connection. Commits made in
+    this worker wake their users' streams directly through ``notify``.
+    Commits made by other workers are found by one tail thread per worker
+    that reads ``balance_changes`` every ``poll_interval`` seconds, and
+    only while streams are open, so the cost of N connected clients is one
+    indexed range scan per interval instead of N polling requests. A wake
+    only means "look again": each stream reads its own new ledger entries,
+    so duplicate or dropped wakes cannot lose or repeat events.
+
+    ``pool`` may be a list of pools (one per shard); each feed is tailed.
+    """
+
+    def __init__(self, pool, poll_interval=0.25, max_connections=200):
+        self.pools = list(pool) if isinstance(pool, (list, tuple)) else [pool]
+        self.poll_interval = poll_interval
+        self.max_connections = max_connections
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._connections = 0
+        self._last_seq = {}
+        self._tail_pid = None
+        self._stats = {'opened': 0, 'rejected': 0, 'wakes': 0, 'polls': 0, 'full_wakes': 0}
+
+    def subscribe(self, user_id):
+        """Register a stream for user_id; raises StreamUnavailable when full"""
+        subscription = Subscription(user_id)
+        with self._lock:
+            if self._connections >= self.max_connections:
+                self._stats['rejected'] += 1
+                raise StreamUnavailable('Too many open streams. Please try again shortly.')
+            self._subscribers.setdefault(user_id, set()).add(subscription)
+            self._connections += 1
+            self._stats['opened'] += 1
+        self._ensure_tail()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Remove a closed stream"""
+        with self._lock:
+            subscriptions = self._subscribers.get(subscription.user_id)
+            if subscriptions is None or subscription not in subscriptions:
+                return
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._subscribers[subscription.user_id]
+            self._connections -= 1
+
+    def notify(self, user_ids):
+        """Wake streams of users whose wallets changed"""
+        with self._lock:
+            subscriptions = [s for user_id in user_ids for s in self._subscribers.get(user_id, ())]
+            self._stats['wakes'] += len(subscriptions)
+        for subscription in subscriptions:
+            subscription.wake()
+
+    def _wake_all(self):
+        """Wake every stream (change feed rows were pruned before we read them)"""
+        with self._lock:
+            subscriptions = [s for group in self._subscribers.values() for s in group]
+            self._stats['full_wakes'] += 1
+        for subscription in subscriptions:
+            subscription.wake()
+
+    def _ensure_tail(self):
+        """Start the change feed tail thread once per worker process"""
+        if self._tail_pid == os.getpid():
+            return
+        with self._lock:
+            if self._tail_pid == os.getpid():
+                return
+            self._tail_pid = os.getpid()
+            self._last_seq = {}
+        threading.Thread(target=self._tail_loop, name='stream-tail', daemon=True).start()
+
+    def _tail_loop(self):
+        """Poll balance_changes while any stream is open"""
+        while True:
+            time.sleep(self.poll_interval)
+            with self._lock:
+                idle = not self._connections
+            if idle:
+                # Nothing to wake; start from the head again on next use
+                self._last_seq = {}
+                continue
+            try:
+                self.poll()
+            except Exception:
+                logger.exception('Stream change feed poll failed')
+
+    def poll(self):
+        """Wake streams for rows appended to balance_changes since the last poll"""
+        for index, pool in enumerate(self.pools):
+            self._poll_feed(index, pool)
+        with self._lock:
+            self._stats['polls'] += 1
+
+    def _poll_feed(self, index, pool):
+        """Wake streams for one pool's new balance_changes rows"""
+        last_seq = self._last_seq.get(index)
+        with pool.connection() as conn:
+            if last_seq is None:
+                self._last_seq[index] = conn.execute(
+                    'SELECT COALESCE(MAX(seq), 0) FROM balance_changes'
+                ).fetchone()[0]
+                # Streams that opened before this point may have missed a
+                # change; let them all check once
+                self._wake_all()
+                return
+            oldest = conn.execute('SELECT MIN(seq) FROM balance_changes').fetchone()[0]
+            rows = conn.execute(
+                'SELECT seq, user_id FROM balance_changes WHERE seq > ? ORDER BY seq',
+                (last_seq,)
+            ).fetchall()
+        if oldest is not None and oldest > last_seq + 1:
+            self._wake_all()
+        elif rows:
+            self.notify({user_id for _, user_id in rows})
+        if rows:
+            self._last_seq[index] = rows[-1][0]
+
+    def stats(self):
+        """Snapshot of stream counters for this worker"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['connections'] = self._connections
+            stats['users'] = len(self._subscribers)
+        stats['max_connections'] = self.max_connections
+        return stats
+
+
+def event_stream(hub, subscription, last_id, load_entries, load_balances, latest_id,
+                 heartbeat=15.0, max_duration=300.0, retry_ms=3000, authorized=None):
+    """Generate SSE messages for one subscription until max_duration.
+
+    ``load_entries(after_id, limit)`` returns the user's ledger entries
+    with ids above after_id, oldest first; ``load_balances()`` returns the
+    current balances and ``latest_id()`` the user's newest entry id (0 if
+    none). Every message carries the id of the newest entry it reflects,
+    so a reconnect with Last-Event-ID resumes exactly where the client
+    left off. The subscription is registered before the first
+    read, so nothing committed while the stream opens is missed.
+
+    ``authorized()`` is re-checked after every wake and heartbeat; once it
+    returns False (the token was revoked or expired) the stream sends a
+    ``revoked`` event and closes instead of running to max_duration.
+    """
+    deadline = time.monotonic() + max_duration
+    try:
+        yield f'retry: {int(retry_ms)}\n\n'
+        # Every connection gets a balance snapshot; a resumed one first
+        # replays the entries it missed
+        pending = last_id is not None
+        if not pending:
+            last_id = latest_id()
+        snapshot = True
+
+        while True:
+            if pending:
+                entries = load_entries(last_id, MAX_REPLAY + 1)
+                if len(entries) > MAX_REPLAY:
+                    # Too far behind to replay; tell the client to reload history
+                    last_id = latest_id()
+                    yield format_event('reset', {'reason': 'too_far_behind'}, last_id)
+                    snapshot = True
+                else:
+                    for entry in entries:
+                        last_id = entry['entry_id']
+                        yield format_event('transaction', entry, last_id)
+                    snapshot = snapshot or bool(entries)
+            if snapshot:
+                yield format_event('balances', load_balances(), last_id)
+                snapshot = False
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            pending = subscription.wait(min(heartbeat, remaining))
+            if authorized is not None and not authorized():
+                yield format_event('revoked', {'reason': 'token_revoked'})
+                return
+            if not pending and time.monotonic() < deadline:
+                yield ': heartbeat\n\n'
+    finally:
+        hub.unsubscribe(subscription)